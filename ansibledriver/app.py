@@ -7,7 +7,9 @@ from ignition.boot.config import BootProperties
 from ansibledriver.service.ansible import AnsibleProperties
 from ansibledriver.service.process import ProcessProperties
 from ansibledriver.service.resourcedriver import AdditionalResourceDriverProperties
+from ansibledriver.service.progress_events import ProgressEventLogProperties
 from ansibledriver.service.config import AnsibleServiceConfigurator, AnsibleDriverHandlerConfigurator
+from ansibledriver.service.metricsapi import MetricsApiCapability, metrics_api_spec
 
 default_config_dir_path = str(pathlib.Path(ansibledriverconfig.__file__).parent.resolve())
 default_config_path = os.path.join(default_config_dir_path, 'ald_config.yml')
@@ -24,13 +26,18 @@ def create_app():
 
     # Using custom versions of some bootstrapped components
     boot_config = app_builder.property_groups.get_property_group(BootProperties)
+    boot_config.progress_event_log.service_enabled = False
     boot_config.progress_event_log.serializer_service_enabled = False
+    boot_config.resource_driver.driver_files_manager_service_enabled = False
 
     app_builder.add_property_group(AnsibleProperties())
     app_builder.add_property_group(ProcessProperties())
     app_builder.add_property_group(AdditionalResourceDriverProperties())
+    app_builder.add_property_group(ProgressEventLogProperties())
     app_builder.add_service_configurator(AnsibleServiceConfigurator())
     app_builder.add_service_configurator(AnsibleDriverHandlerConfigurator())
+    # served alongside the driver APIs
+    app_builder.add_api(metrics_api_spec, MetricsApiCapability)
 
     return app_builder.configure()
 
@@ -4,6 +4,7 @@ from ignition.model.failure import FailureDetails, FAILURE_CODE_INFRASTRUCTURE_E
 from ignition.locations.exceptions import InvalidDeploymentLocationError
 from ignition.utils.propvaluemap import PropValueMap
 
+import yaml
 import logging
 
 
@@ -12,10 +13,37 @@ logger = logging.getLogger(__name__)
 
 class DeploymentLocation():
     @staticmethod
-    def from_request(request):
-        return DeploymentLocation(request.get('deployment_location', None))
+    def from_request(request, kubeconfig_cache=None):
+        return DeploymentLocation(request.get('deployment_location', None), kubeconfig_cache=kubeconfig_cache)
 
-    def __init__(self, deployment_location):
+    @staticmethod
+    def endpoint(deployment_location, endpoint_property=None):
+        """
+        Returns the API endpoint of a deployment location (dict), without creating it: the value of endpoint_property if
+        given, otherwise the server of a Kubernetes location's client config or the auth URL of an OpenStack location.
+        None if the endpoint can't be found
+        """
+        properties = deployment_location.get('properties', None) or {}
+        if endpoint_property is not None:
+            return properties.get(endpoint_property, None)
+        client_config = properties.get(KubernetesDeploymentLocation.CONFIG_PROP, properties.get(KubernetesDeploymentLocation.CONFIG_ALT2_PROP, None))
+        if client_config is not None:
+            try:
+                if isinstance(client_config, str):
+                    client_config = yaml.safe_load(client_config)
+                clusters = {cluster['name']: cluster['cluster'] for cluster in client_config.get('clusters', [])}
+                contexts = {context['name']: context['context'] for context in client_config.get('contexts', [])}
+                current_context = contexts.get(client_config.get('current-context', None), None)
+                if current_context is not None and current_context.get('cluster', None) in clusters:
+                    return clusters[current_context['cluster']].get('server', None)
+                if len(clusters) > 0:
+                    return next(iter(clusters.values())).get('server', None)
+            except Exception as e:
+                logger.debug('Unable to read the server of the client config of deployment location {0}: {1}'.format(deployment_location.get('name', None), e))
+            return None
+        return properties.get('os_auth_url', None)
+
+    def __init__(self, deployment_location, kubeconfig_cache=None):
         if deployment_location is None:
             raise InvalidDeploymentLocationError('Deployment Location must be provided')
         if not isinstance(deployment_location, dict):
@@ -23,6 +51,8 @@ class DeploymentLocation():
         if 'properties' not in deployment_location:
             raise InvalidDeploymentLocationError('Deployment Location must have properties')
         self.__deployment_location = deployment_location
+        # when set, kubeconfig files are shared with other requests against the same cluster (see KubeconfigCache)
+        self.__kubeconfig_cache = kubeconfig_cache
         self.infrastructure_type = self.__deployment_location.get('type', None)
         if self.infrastructure_type is None:
             raise InvalidDeploymentLocationError('Deployment location missing \'type\' value')
@@ -32,8 +62,12 @@ class DeploymentLocation():
         if self.connection_type == 'kubectl':
           self.__kube_location = KubernetesDeploymentLocation.from_dict(deployment_location)
           if self.__kube_location is not None:
-            self.kubeconfig_file = self.__kube_location.write_config_file()
-            logger.debug(f'Created kubeconfig file at {self.kubeconfig_file}')
+            if self.__kubeconfig_cache is not None:
+              self.kubeconfig_file = self.__kubeconfig_cache.acquire(self.__kube_location)
+              logger.debug(f'Using kubeconfig file at {self.kubeconfig_file}')
+            else:
+              self.kubeconfig_file = self.__kube_location.write_config_file()
+              logger.debug(f'Created kubeconfig file at {self.kubeconfig_file}')
             self.__deployment_location['properties']['kubeconfig_path'] = self.kubeconfig_file
           else:
             raise ValueError('Unable to convert deployment location to a Kubernetes deployment location')
@@ -53,7 +87,10 @@ class DeploymentLocation():
         if self.__kube_location is not None:
             try:
                 logger.debug(f'Attempting to clean up deployment location related files')
-                self.__kube_location.clear_config_files()
+                if self.__kubeconfig_cache is not None:
+                    self.__kubeconfig_cache.release(self.kubeconfig_file, self.__kube_location)
+                else:
+                    self.__kube_location.clear_config_files()
             except Exception as e:
                 logger.exception(f'Encountered an error whilst trying to clean up deployment location related files: {e}')
 
@@ -1,17 +1,47 @@
 from ignition.model.progress_events import ResourceTransitionProgressEvent
 from collections import OrderedDict
 
-class AnsibleEvent(ResourceTransitionProgressEvent):
-    
-    def _convert_result_to_log_safe_dict(self, task_result):
-        return {
+
+class TaskResultView():
+    """
+    Log safe view of a task result, only converted when the event holding it is serialized. The number of nested
+    results and the length of msg can be capped (0 is no limit); anything left out is counted in the converted result
+    """
+    def __init__(self, task_result, max_results=0, max_msg_length=0):
+        self.task_result = task_result
+        self.max_results = max_results
+        self.max_msg_length = max_msg_length
+
+    def to_dict(self):
+        return self._convert(self.task_result)
+
+    def _convert(self, task_result):
+        converted = {
             'msg': task_result.get('msg', None),
             'changed': task_result.get('changed', None),
             'failed': task_result.get('failed', None),
             'skipped': task_result.get('skipped', None),
             'rc': task_result.get('rc', None),
-            'results': [self._convert_result_to_log_safe_dict(r) for r in task_result.get('results', [])]
+            'results': []
         }
+        msg = converted['msg']
+        if self.max_msg_length > 0 and isinstance(msg, str) and len(msg) > self.max_msg_length:
+            converted['msg'] = msg[:self.max_msg_length] + '...'
+            converted['msgTruncatedCharacters'] = len(msg) - self.max_msg_length
+        results = task_result.get('results', [])
+        if self.max_results > 0 and len(results) > self.max_results:
+            converted['resultsTruncated'] = len(results) - self.max_results
+            results = results[:self.max_results]
+        converted['results'] = [self._convert(r) for r in results]
+        return converted
+
+
+class AnsibleEvent(ResourceTransitionProgressEvent):
+    
+    def _convert_result_to_log_safe_dict(self, task_result):
+        if not isinstance(task_result, TaskResultView):
+            task_result = TaskResultView(task_result)
+        return task_result.to_dict()
 
 
 class PlaybookResultEvent(AnsibleEvent):
@@ -20,16 +50,20 @@ class PlaybookResultEvent(AnsibleEvent):
     """
     progress_event_type = 'ansible/PlaybookResult'
 
-    def __init__(self, plays, host_stats):
+    def __init__(self, plays, host_stats, timings=None):
         super().__init__()
         self.plays = plays
         self.host_stats = host_stats
+        self.timings = timings
 
     def _details(self):
-        return  {
+        details = {
             'plays': self.plays,
             'hostStats': self.host_stats
         }
+        if self.timings is not None:
+            details['timings'] = self.timings
+        return details
 
 class PlayMatchedNoNoHostsEvent(AnsibleEvent):
     """
@@ -128,6 +162,33 @@ class TaskCompletedOnHostEvent(AnsibleEvent):
             'taskResult': self._convert_result_to_log_safe_dict(self.task_result)
         }
 
+class TaskSummaryEvent(AnsibleEvent):
+    """
+    Summarises a task once it has finished on all of its hosts, in place of an event for each host. Counts the hosts
+    by result and includes the duration of the task and the range of its durations on each host, in seconds
+    """
+    progress_event_type = 'ansible/TaskSummary'
+
+    def __init__(self, task_name, host_counts, duration, host_durations=None):
+        super().__init__()
+        self.task_name = task_name
+        self.host_counts = host_counts
+        self.duration = duration
+        self.host_durations = host_durations or {}
+
+    def _details(self):
+        durations = list(self.host_durations.values())
+        return  {
+            'taskName': self.task_name,
+            'hostCounts': self.host_counts,
+            'durationSeconds': round(self.duration, 3),
+            'hostDurationSeconds': {
+                'min': round(min(durations), 3) if durations else None,
+                'mean': round(sum(durations) / len(durations), 3) if durations else None,
+                'max': round(max(durations), 3) if durations else None
+            }
+        }
+
 class TaskRetryOnHostEvent(AnsibleEvent):
     """
     Indicates a task is being retried (using "retries" and "until" on a task in a playbook). One event will be created for each retry
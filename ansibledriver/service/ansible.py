@@ -5,19 +5,17 @@ import os
 import tempfile
 import copy
 from datetime import datetime
-from tempfile import NamedTemporaryFile
 from collections import namedtuple
 from ansible.parsing.dataloader import DataLoader
 from ansible.vars.manager import VariableManager
 from ansible.inventory.manager import InventoryManager
 from ansible.executor.playbook_executor import PlaybookExecutor
 from ansible.plugins.callback import CallbackBase
-from ansible.plugins.loader import connection_loader
+from ansible.plugins.loader import connection_loader, strategy_loader, action_loader, shell_loader, become_loader, filter_loader, test_loader
 from ansible.inventory.host import Host
 from ansible.playbook.task_include import TaskInclude
 from ansible import context
 from ansible.module_utils.common.collections import ImmutableDict
-from jinja2 import Environment, FileSystemLoader
 from ignition.model.lifecycle import LifecycleExecution, STATUS_COMPLETE, STATUS_FAILED, STATUS_IN_PROGRESS
 from ignition.model.failure import FailureDetails, FAILURE_CODE_INFRASTRUCTURE_ERROR, FAILURE_CODE_INTERNAL_ERROR, FAILURE_CODE_RESOURCE_NOT_FOUND
 from ignition.service.config import ConfigurationPropertiesGroup
@@ -25,6 +23,17 @@ from ignition.service.framework import Service, Capability, interface
 from ignition.utils.propvaluemap import PropValueMap
 from ansibledriver.model.deploymentlocation import DeploymentLocation
 from ansibledriver.model.inventory import Inventory
+from ansibledriver.service.playbookcache import PlaybookCache
+from ansibledriver.service.templates import CachingTemplateRenderer, process_templates
+from ansibledriver.service.verbosity import ProgressEventFilter, FULL
+from ansibledriver.service.timings import PlaybookTimings, OK, FAILED, SKIPPED, UNREACHABLE
+from ansibledriver.service.kubeconfigcache import KubeconfigCache
+from ansibledriver.service.keyfilecache import KeyFileCache
+from ansibledriver.service.sshpool import SshControlPool
+from ansibledriver.service.forks import ForkBudget, wanted_forks
+from ansibledriver.service.executor import run_in_subprocess, IN_PROCESS, SUBPROCESS
+from ansibledriver.service.retry import UnreachableRetry, UnreachableRetryPolicy, UNREACHABLE_RETRY_STATE
+import ansibledriver.service.metrics as metrics
 from ignition.model import associated_topology
 from ignition.model.associated_topology import AssociatedTopology
 from ansibledriver.model.progress_events import *
@@ -37,11 +46,111 @@ class AnsibleProperties(ConfigurationPropertiesGroup):
     def __init__(self):
         super().__init__('ansible')
         # apply defaults (correct settings will be picked up from config file or environment variables)
+        # a request whose hosts are unreachable is retried after unreachable_sleep_seconds, then after a delay
+        # multiplied by unreachable_backoff_multiplier each attempt, up to unreachable_max_sleep_seconds. Up to
+        # unreachable_jitter (a fraction) of each delay is randomly taken off
         self.unreachable_sleep_seconds = 5 # in seconds
+        self.unreachable_backoff_multiplier = 2
+        self.unreachable_max_sleep_seconds = 300
+        self.unreachable_jitter = 0.5
         self.max_unreachable_retries = 1000
+        # no retries are scheduled this long after the first attempt of a request (0 is no deadline)
+        self.unreachable_retry_deadline_seconds = 3600
+        # retry from the task that found hosts unreachable, on those hosts only, rather than running the whole
+        # playbook again. Output properties are carried over from earlier attempts, other facts (set_fact, registered
+        # variables) and notified handlers are not, so only enable for playbooks whose tasks don't depend on them
+        self.unreachable_retry_resume = False
         self.output_prop_prefix = 'output__'
+        # forks of a playbook run: the number of its hosts, up to forks (the playbook_forks resource property, if set,
+        # overrides forks for the playbooks of a resource package). The forks of all the runs of the workers of a
+        # gunicorn worker (so a pod has NUM_PROCESSES budgets) are limited to forks_budget (0 is no limit). It is a soft
+        # limit: each run gets at least one fork, so it is exceeded by a fork for each run started once it is used up
+        self.forks = 20
+        self.forks_budget = 0
+        # run playbooks in the worker process (in_process), or each in a child process of its own (subprocess), which
+        # passes the events of the playbook back to the worker as they happen. Child processes keep the memory taken by
+        # modules and plugins out of the worker, and can be limited to playbook_process_max_memory_mb of address space
+        # and playbook_process_max_cpu_seconds of CPU time (0 is no limit), each of their Ansible processes alike. Parsed
+        # playbooks are not cached (see playbook_cache_size) when playbooks are run in child processes
+        self.playbook_executor = IN_PROCESS
+        self.playbook_process_max_memory_mb = 0
+        self.playbook_process_max_cpu_seconds = 0
         self.tmp_dir = '.'
         self.log_progress_events = True
+        # caps on the task results included in progress events (0 is no limit): the number of nested (loop item)
+        # results and the length of each msg
+        self.progress_event_max_results = 0
+        self.progress_event_max_msg_length = 0
+        # which progress events are produced: playbook, failures, summary (a summary event per task in place of
+        # the events of each host) or full
+        self.progress_event_verbosity = FULL
+        # produce the events (other than failures) of 1 in every progress_event_sample_rate tasks run on a host,
+        # including those of its loop items. The rate can be set for individual lifecycles, by lifecycle name, in
+        # progress_event_lifecycle_sample_rates
+        self.progress_event_sample_rate = 1
+        self.progress_event_lifecycle_sample_rates = {}
+        # number of the slowest tasks of a playbook attached to its LifecycleExecution (as slowest_tasks)
+        self.slowest_tasks_count = 5
+        # number of resource packages, per worker process, whose parsed playbooks are cached (0 disables the cache)
+        self.playbook_cache_size = 32
+        # keep extracted resource packages in a cache under tmp_dir, keyed by their content
+        self.package_cache_enabled = True
+        self.package_cache_max_size_mb = 512
+        # hard link the files of the cached package (other than config, which is templated) into a request's
+        # working copy instead of copying them. Only safe when playbooks never modify files of their package
+        self.package_cache_hardlinks = False
+        # number of compiled templates cached by each worker process (0 disables the cache)
+        self.template_cache_size = 256
+        # kubeconfig files of Kubernetes deployment locations are shared by the requests of a worker against the same
+        # cluster, and removed once unused for this long (0 disables the cache, each request writes its own file)
+        self.kubeconfig_cache_ttl_seconds = 300
+        # directory the private keys of key properties are written to, preferably memory backed (e.g. /dev/shm) so key
+        # material never reaches disk (None is the default temp dir)
+        self.private_key_dir = None
+        # private key files are shared by the requests of a worker using the same key, and removed once unused for
+        # this long (0 disables the cache, each key property is written to its own file)
+        self.private_key_cache_ttl_seconds = 60
+        # keep the SSH master connections of each worker open between playbook runs, one for each host, port, user and
+        # key, in a directory under ssh_control_dir (None is the default temp dir). Masters idle for
+        # ssh_control_idle_seconds, and the least recently used beyond ssh_control_max_connections, are stopped, and
+        # masters unused for ssh_control_health_check_seconds are checked before they are used again. Requires
+        # ControlMaster=auto and a ControlPersist longer than ssh_control_idle_seconds in ssh_args, without ControlPath
+        self.ssh_control_pool_enabled = False
+        self.ssh_control_dir = None
+        self.ssh_control_max_connections = 50
+        self.ssh_control_idle_seconds = 600
+        self.ssh_control_health_check_seconds = 60
+        # how the templates of a resource package are rendered: sequential, threads or processes
+        self.template_rendering_mode = 'sequential'
+        # number of threads or processes used to render templates when template_rendering_mode is not sequential
+        self.template_parallelism = 4
+        # packages with fewer template files than this are always rendered sequentially
+        self.template_parallel_threshold = 100
+
+
+# plugins used by (almost) every playbook run, loaded up front by warm_up_plugins
+WARM_UP_PLUGINS = [
+  (connection_loader, ['ssh', 'local', 'paramiko_ssh']),
+  (strategy_loader, ['linear', 'free']),
+  (shell_loader, ['sh']),
+  (become_loader, ['sudo', 'su']),
+  (action_loader, ['normal', 'command', 'shell', 'copy', 'template', 'set_fact', 'debug', 'gather_facts'])
+]
+
+
+def warm_up_plugins():
+  """
+  Load the Ansible plugins used by playbook runs into the plugin loader caches of this process
+  """
+  for plugin_loader, plugin_names in WARM_UP_PLUGINS:
+    for plugin_name in plugin_names:
+      try:
+        plugin_loader.get(plugin_name, class_only=True)
+      except Exception as e:
+        logger.debug('Unable to pre-load {0} plugin {1}: {2}'.format(plugin_loader.package, plugin_name, e))
+  # Jinja2 filters and tests are discovered as a whole by the templating engine
+  list(filter_loader.all(class_only=True))
+  list(test_loader.all(class_only=True))
 
 
 class AnsibleClientCapability(Capability):
@@ -50,6 +159,26 @@ class AnsibleClientCapability(Capability):
     def run_lifecycle_playbook(self, request):
       pass
 
+    @interface
+    def warm_up(self):
+      pass
+
+    @interface
+    def remove_driver_files(self, request):
+      pass
+
+    @interface
+    def worker_started(self):
+      pass
+
+    @interface
+    def playbook_process_exited(self):
+      pass
+
+    @interface
+    def close(self):
+      pass
+
 
 class AnsibleClient(Service, AnsibleClientCapability):
   def __init__(self, configuration, **kwargs):
@@ -63,6 +192,20 @@ class AnsibleClient(Service, AnsibleClientCapability):
     if 'event_logger' not in kwargs:
       raise ValueError('event_logger argument not provided')
     self.event_logger = kwargs.get('event_logger')
+    self.playbook_cache = PlaybookCache(self.ansible_properties.playbook_cache_size)
+    self.template_renderer = CachingTemplateRenderer(self.templating, self.ansible_properties.template_cache_size)
+    self.kubeconfig_cache = KubeconfigCache(self.ansible_properties.kubeconfig_cache_ttl_seconds)
+    self.key_file_cache = KeyFileCache(self.ansible_properties.private_key_dir, self.ansible_properties.private_key_cache_ttl_seconds)
+    self.ssh_control_pool = None
+    if self.ansible_properties.ssh_control_pool_enabled:
+      self.ssh_control_pool = SshControlPool(self.ansible_properties.ssh_control_dir,
+        max_connections=self.ansible_properties.ssh_control_max_connections,
+        idle_seconds=self.ansible_properties.ssh_control_idle_seconds,
+        health_check_seconds=self.ansible_properties.ssh_control_health_check_seconds)
+    self.cli_args = {}
+    # created before the workers are forked, so shared by all of them
+    self.fork_budget = ForkBudget(self.ansible_properties.forks_budget)
+    self.retry_policy = UnreachableRetryPolicy(self.ansible_properties)
 
     try:
         from ansible.plugins.loader import init_plugin_loader
@@ -72,25 +215,24 @@ class AnsibleClient(Service, AnsibleClientCapability):
     except ImportError:
         pass
     
-  def run_playbook(self, request_id, connection_type, inventory_path, playbook_path, lifecycle, all_properties):
-    Options = namedtuple('Options', ['connection',
-                                     'forks',
-                                     'become',
-                                     'become_method',
-                                     'become_user',
-                                     'listhosts',
-                                     'listtasks',
-                                     'listtags',
-                                     'syntax',
-                                     'module_path',
-                                     'check',
-                                     'diff'])
-    # initialize needed objects
-    loader = DataLoader()
-    
-    context.CLIARGS = ImmutableDict(connection=connection_type, 
+  def warm_up(self):
+    """
+    Prepare this process to act as a template for Ansible worker processes: workers forked from it
+    start with Ansible's plugins already loaded
+    """
+    warm_up_plugins()
+
+  def get_cli_args(self, connection_type, start_at_task=None, forks=None):
+    if start_at_task is not None or forks is not None:
+      overrides = {'start_at_task': start_at_task} if start_at_task is not None else {}
+      if forks is not None:
+        overrides['forks'] = forks
+      return ImmutableDict(self.get_cli_args(connection_type), **overrides)
+    # the arguments only vary by connection type, so build them once
+    if connection_type not in self.cli_args:
+      self.cli_args[connection_type] = ImmutableDict(connection=connection_type, 
                                     module_path=None, 
-                                    forks=20, 
+                                    forks=self.ansible_properties.forks, 
                                     become=None,
                                     become_method='sudo', 
                                     become_user='root', 
@@ -102,34 +244,127 @@ class AnsibleClient(Service, AnsibleClientCapability):
                                     syntax=None,
                                     start_at_task=None, 
                                     verbosity=1)
+    return self.cli_args[connection_type]
+
+  def run_playbook(self, request_id, connection_type, inventory_path, playbook_path, lifecycle, all_properties, resume=None, resource_properties=None):
+    """
+    Runs the playbook, from the task and on the hosts of the resume point (see ResultCallback.resume_point) if given.
+    The run's forks are taken from the fork budget, by the number of hosts and the resource_properties (see wanted_forks)
+    """
+    callback = ResultCallback(self.ansible_properties, request_id, lifecycle, self.event_logger, resume=resume)
+    if self.ansible_properties.playbook_executor == SUBPROCESS:
+      # the events of the playbook are passed to the callback as they happen
+      start_at_done = run_in_subprocess(
+        lambda stdout_callback: self.execute_playbook(stdout_callback, connection_type, inventory_path, playbook_path, all_properties, resume=resume, resource_properties=resource_properties),
+        callback, max_memory_mb=self.ansible_properties.playbook_process_max_memory_mb,
+        max_cpu_seconds=self.ansible_properties.playbook_process_max_cpu_seconds)
+      self.playbook_process_exited()
+    else:
+      start_at_done = self.execute_playbook(callback, connection_type, inventory_path, playbook_path, all_properties, resume=resume, resource_properties=resource_properties)
+    if resume is not None:
+      # false if the task to start at was not found, so nothing was run
+      callback.resumed = start_at_done
+    return callback
+
+  def execute_playbook(self, stdout_callback, connection_type, inventory_path, playbook_path, all_properties, resume=None, resource_properties=None):
+    """
+    Runs the playbook in this process, returning whether the task to start at (of the resume point) was found
+    """
+    # initialize needed objects
+    loader = DataLoader()
+    # skip parsing the playbooks if this package has been run before (not in a playbook process, whose cache would be
+    # thrown away with it)
+    scripts_path = os.path.dirname(os.path.abspath(playbook_path))
+    playbook_cache_key = None
+    if self.ansible_properties.playbook_executor != SUBPROCESS:
+      playbook_cache_key = self.playbook_cache.load(loader, scripts_path)
 
     passwords = {'become_pass': ''}
 
     # create inventory and pass to var manager
     inventory = InventoryManager(loader=loader, sources=inventory_path)
-    variable_manager = VariableManager(loader=loader, inventory=inventory)
-    variable_manager._extra_vars = all_properties
-    # Setup playbook executor, but don't run until run() called
-    pbex = PlaybookExecutor(
-        playbooks=[playbook_path],
-        inventory=inventory,
-        variable_manager=variable_manager,
-        loader=loader,
-        passwords=passwords
-    )
-
-    callback = ResultCallback(self.ansible_properties, request_id, lifecycle, self.event_logger)
-    pbex._tqm._stdout_callback = callback
-
-    pbex.run()
+    if resume is not None:
+      inventory.subset(resume['hosts'])
+
+    wanted = wanted_forks(self.ansible_properties.forks, len(inventory.get_hosts()), resource_properties)
+    control_paths = []
+    # the forks are given back however the run ends, or they would be lost to the budget of every worker
+    forks = self.fork_budget.acquire(wanted)
+    metrics.ansible_forks.inc(forks)
+    try:
+      context.CLIARGS = self.get_cli_args(connection_type, start_at_task=resume['task'] if resume is not None else None, forks=forks)
+      variable_manager = VariableManager(loader=loader, inventory=inventory)
+      variable_manager._extra_vars = all_properties
+      # Setup playbook executor, but don't run until run() called
+      pbex = PlaybookExecutor(
+          playbooks=[playbook_path],
+          inventory=inventory,
+          variable_manager=variable_manager,
+          loader=loader,
+          passwords=passwords
+      )
+
+      pbex._tqm._stdout_callback = stdout_callback
+
+      if self.ssh_control_pool is not None:
+        control_paths = self.ssh_control_pool.prepare(inventory, variable_manager, loader, connection_type)
+      pbex.run()
+    finally:
+      if self.ssh_control_pool is not None:
+        self.ssh_control_pool.release(control_paths)
+      self.fork_budget.release(forks)
+      metrics.ansible_forks.dec(forks)
     logger.debug(f'Playbook finished {playbook_path}')
+    self.playbook_cache.save(playbook_cache_key, loader, scripts_path)
 
-    return callback
+    return pbex._tqm._start_at_done
+
+  def worker_started(self):
+    """
+    Called by a worker when it starts, so that it (rather than the process it was forked from) owns the caches
+    """
+    self.playbook_cache.claim()
+    self.kubeconfig_cache.claim()
+    self.key_file_cache.claim()
+    if self.ssh_control_pool is not None:
+      self.ssh_control_pool.claim()
+
+  def playbook_process_exited(self):
+    """
+    Called by a worker once a process it forked to run a playbook has exited, stops the SSH masters left idle or beyond
+    max_connections (which the playbook process leaves to the worker)
+    """
+    if self.ssh_control_pool is not None:
+      self.ssh_control_pool.evict()
+
+  def close(self):
+    """
+    Removes the files cached by this process, and closes its SSH master connections, called when a worker stops
+    """
+    self.kubeconfig_cache.clear()
+    self.key_file_cache.clear()
+    if self.ssh_control_pool is not None:
+      self.ssh_control_pool.close()
+
+  def remove_driver_files(self, request):
+    driver_files = request.get('driver_files', None)
+    if not request.get('keep_files', False) and driver_files is not None:
+      try:
+        logger.debug('Attempting to remove lifecycle scripts at {0}'.format(driver_files.root_path))
+        driver_files.remove_all()
+      except Exception as e:
+        logger.exception('Encountered an error whilst trying to clear out lifecycle scripts directory {0}: {1}'.format(driver_files.root_path, str(e)))
 
   def run_lifecycle_playbook(self, request):
+    """
+    Runs the playbook of the request once. Returns its LifecycleExecution or, if a host was unreachable and the request
+    should be retried, an UnreachableRetry. The request is retried by calling this method again, with the state of its
+    retries (the UnreachableRetry's retry_state()) under UNREACHABLE_RETRY_STATE
+    """
     driver_files = request['driver_files']
     key_property_processor = None
     location = None
+    retry = None
 
     try:
       request_id = request['request_id']
@@ -139,12 +374,12 @@ class AnsibleClient(Service, AnsibleClientCapability):
       request_properties = request.get('request_properties', {})
       associated_topology = request.get('associated_topology', None)
       sys_props = PropValueMap(system_properties)
-      location = DeploymentLocation.from_request(request)
+      location = DeploymentLocation.from_request(request, kubeconfig_cache=self.kubeconfig_cache)
 
       config_path = driver_files.get_directory_tree('config')
       scripts_path = driver_files.get_directory_tree('scripts')
 
-      key_property_processor = KeyPropertyProcessor(resource_properties, system_properties, location.properties())
+      key_property_processor = KeyPropertyProcessor(resource_properties, system_properties, location.properties(), key_file_cache=self.key_file_cache)
 
       playbook_path = get_lifecycle_playbook_path(scripts_path, lifecycle)
       if playbook_path is not None:
@@ -161,27 +396,35 @@ class AnsibleClient(Service, AnsibleClientCapability):
 
         all_properties = self.render_context_service.build(system_properties, resource_properties, request_properties, location.deployment_location(), associated_topology)
 
-        process_templates(config_path, self.templating, all_properties)
-
-        # always retry on unreachable
-        num_retries = self.ansible_properties.max_unreachable_retries
-
-        for i in range(0, num_retries):
-          if i>0:
-            logger.debug('Playbook {0}, unreachable retry attempt {1}/{2}'.format(playbook_path, i+1, num_retries))
-          start_time = datetime.now()
-          ret = self.run_playbook(request_id, location.connection_type, inventory.get_inventory_path(), playbook_path, lifecycle, all_properties)
-          if not ret.host_unreachable:
-            break
-          end_time = datetime.now()
-          if self.ansible_properties.unreachable_sleep_seconds > 0:
-            # Factor in that the playbook may have taken some time to determine is was unreachable
-            # by using the unreachable_sleep_seconds value as a minimum amount of time for the delay 
-            delta = end_time - start_time
-            retry_seconds = max(0, self.ansible_properties.unreachable_sleep_seconds-int(delta.total_seconds()))
-            time.sleep(retry_seconds)
-
-        return ret.get_result()
+        retry_state = request.get(UNREACHABLE_RETRY_STATE, None)
+        if retry_state is None:
+          attempt = 1
+          with metrics.template_rendering_seconds.time():
+            process_templates(config_path, self.template_renderer, all_properties,
+              mode=self.ansible_properties.template_rendering_mode,
+              parallelism=self.ansible_properties.template_parallelism,
+              parallel_threshold=self.ansible_properties.template_parallel_threshold)
+        else:
+          # the templates were rendered (in place) by the first attempt
+          attempt = retry_state['attempt'] + 1
+          logger.debug('Playbook {0}, unreachable retry attempt {1}/{2}'.format(playbook_path, attempt, self.ansible_properties.max_unreachable_retries))
+
+        started_at = time.time()
+        first_attempt_at = started_at if retry_state is None else retry_state['first_attempt_at']
+        resume = retry_state.get('resume', None) if retry_state is not None else None
+        ret = self.run_playbook(request_id, location.connection_type, inventory.get_inventory_path(), playbook_path, lifecycle, all_properties, resume=resume, resource_properties=resource_properties)
+        if resume is not None and not ret.resumed:
+          logger.warning('Task \'{0}\' not found to resume playbook {1} from, running the whole playbook'.format(resume['task'], playbook_path))
+          ret = self.run_playbook(request_id, location.connection_type, inventory.get_inventory_path(), playbook_path, lifecycle, all_properties, resource_properties=resource_properties)
+        result = ret.get_result()
+        if ret.host_unreachable:
+          # always retry on unreachable, within the limits of the retry policy
+          delay = self.retry_policy.next_delay(attempt, first_attempt_at, started_at)
+          if delay is not None:
+            resume = ret.resume_point() if self.ansible_properties.unreachable_retry_resume else None
+            retry = UnreachableRetry(result, attempt, first_attempt_at, delay, resume=resume)
+            return retry
+        return result
       else:
         msg = "No playbook found to run for lifecycle {0} for request {1}".format(lifecycle, request_id)
         logger.debug(msg)
@@ -198,13 +441,9 @@ class AnsibleClient(Service, AnsibleClientCapability):
       if key_property_processor is not None:
         key_property_processor.clear_key_files()
 
-      keep_files = request.get('keep_files', False)
-      if not keep_files and driver_files is not None:
-        try:
-          logger.debug('Attempting to remove lifecycle scripts at {0}'.format(driver_files.root_path))
-          driver_files.remove_all()
-        except Exception as e:
-          logger.exception('Encountered an error whilst trying to clear out lifecycle scripts directory {0}: {1}'.format(driver_files.root_path, str(e)))
+      # the driver files of a request that is to be retried are removed once it is done with
+      if retry is None:
+        self.remove_driver_files(request)
 
 
 class ResultCallback(CallbackBase):
@@ -214,7 +453,7 @@ class ResultCallback(CallbackBase):
     the end of the execution, look into utilizing the ``json`` callback plugin
     or writing your own custom callback plugin
     """
-    def __init__(self, ansible_properties, request_id, lifecycle, event_logger, display=None):
+    def __init__(self, ansible_properties, request_id, lifecycle, event_logger, display=None, resume=None):
         super(ResultCallback, self).__init__(display)
         self.ansible_properties = ansible_properties
         self.request_id = request_id
@@ -222,6 +461,10 @@ class ResultCallback(CallbackBase):
         self.plays = []
         self.lifecycle = lifecycle
         self.event_logger = event_logger
+        self.event_filter = ProgressEventFilter(ansible_properties, lifecycle)
+        self.timings = PlaybookTimings()
+        # ids of the tasks started but not yet summarised
+        self.unsummarised_tasks = []
 
         self.playbook_failed = False
 
@@ -229,6 +472,7 @@ class ResultCallback(CallbackBase):
         self.host_failed = False
         self.host_unreachable_log = []
         self.host_failed_log = []
+        self.unreachable_hosts = []
 
         self.resource_id = None
         self.properties = {}
@@ -239,6 +483,12 @@ class ResultCallback(CallbackBase):
         
         self.associated_topology = None
 
+        self.resumed = False
+        if resume is not None:
+          # carry over the outputs of the attempts before
+          self.properties.update(resume['properties'])
+          self.associated_topology = resume['associated_topology']
+
     def _new_play(self, play):
         return {
             'play': {
@@ -256,17 +506,23 @@ class ResultCallback(CallbackBase):
             'hosts': {}
         }
 
+    def _task_result_view(self, result):
+        # converted to a (size bounded) log safe dict only when the event is serialized
+        return TaskResultView(result._result, max_results=self.ansible_properties.progress_event_max_results,
+            max_msg_length=self.ansible_properties.progress_event_max_msg_length)
+
     def v2_playbook_on_play_start(self, play):
         """
         Called when a play begins
         Note: ONE playbook can have MANY plays
         """
         logger.debug('v2_playbook_on_play_start: {0}'.format(play))
-        if self.ansible_properties.log_progress_events:
+        if self.event_filter.playbook_events():
             play_name = play.get_name().strip()
             event = PlayStartedEvent(play_name=play_name)
             self.event_logger.add(event)
         self.plays.append(self._new_play(play))
+        self.timings.play_start(play.get_name().strip())
 
     def v2_playbook_on_task_start(self, task, is_conditional):
         """
@@ -281,10 +537,15 @@ class ResultCallback(CallbackBase):
         self._log_task_start(task, prefix='Handler/')
 
     def _log_task_start(self, task, prefix=None):
-        if self.ansible_properties.log_progress_events:
-            if prefix is None:
-              prefix = ''
-            task_name = '{0}{1}'.format(prefix, task.get_name().strip())
+        if prefix is None:
+          prefix = ''
+        task_name = '{0}{1}'.format(prefix, task.get_name().strip())
+        self.timings.task_start(task._uuid, task_name, module=task.action)
+        if self.event_filter.task_summaries():
+            # the linear strategy starts a task once the previous one has finished on every host
+            self._log_task_summaries()
+            self.unsummarised_tasks.append(task._uuid)
+        if self.event_filter.task_events():
             event = TaskStartedEvent(task_name=task_name)
             if not task.no_log:
               # Include args if the task has not been configured with the no_log option
@@ -299,21 +560,57 @@ class ResultCallback(CallbackBase):
         Called at the end of playbook execution (even in failure)
         """
         logger.debug('v2_playbook_on_stats: {0}'.format(stats))
-        if self.ansible_properties.log_progress_events:
+        self.timings.finish()
+        self._observe_timings()
+        self._log_task_summaries()
+        if self.event_filter.playbook_events():
             hosts = sorted(stats.processed.keys())
             host_stats = {}
             for h in hosts:
                 host_stats[h] = stats.summarize(h)
             
-            event = PlaybookResultEvent(plays=self.plays, host_stats=host_stats)
+            event = PlaybookResultEvent(plays=self.plays, host_stats=host_stats, timings=self.timings.to_dict())
             self.event_logger.add(event)
+        # make sure every event of the playbook is written before its result is reported
+        if hasattr(self.event_logger, 'flush'):
+            self.event_logger.flush()
+
+    def _observe_timings(self):
+        try:
+            for play_name, duration in self.timings.play_durations():
+                metrics.playbook_play_duration_seconds.labels(self.lifecycle).observe(duration)
+            # labelled by module rather than task name (or host), which are unbounded. The time of each task is in the
+            # timings of the playbook result event
+            for summary in self.timings.tasks.values():
+                metrics.playbook_task_duration_seconds.labels(self.lifecycle, summary.module).observe(summary.duration())
+                for duration in summary.host_durations.values():
+                    metrics.playbook_task_host_duration_seconds.labels(self.lifecycle, summary.module).observe(duration)
+        except Exception as e:
+            logger.debug('Unable to record playbook timings: {0}'.format(e))
+
+    def _log_task_summaries(self):
+        for task_id in self.unsummarised_tasks:
+            summary = self.timings.task(task_id)
+            event = TaskSummaryEvent(summary.task_name, summary.host_counts, summary.duration(), host_durations=summary.host_durations)
+            self.event_logger.add(event)
+        self.unsummarised_tasks = []
+
+    def _summarise_host_start(self, host, task):
+        summary = self.timings.task(task._uuid)
+        if summary is not None:
+            summary.host_start(host.get_name().strip())
+
+    def _summarise_host_result(self, result, host_result):
+        summary = self.timings.task(result._task._uuid)
+        if summary is not None:
+            summary.host_result(result._host.get_name().strip(), host_result, changed=result._result.get('changed', False) is True)
 
     def v2_playbook_on_no_hosts_matched(self):
         """
         Called if a play did not match any hosts (will be called after v2_playbook_on_play_start if this occurs)
         """
         logger.debug('v2_playbook_on_no_hosts_matched')
-        if self.ansible_properties.log_progress_events:
+        if self.event_filter.playbook_events():
             # We can assume it's the last play that started. Need to be wary of the "free" strategy but I think this works even then
             if len(self.plays) == 0:
                 play_name = 'Unknown'
@@ -331,10 +628,11 @@ class ResultCallback(CallbackBase):
         logger.error('task: \'' + self.failed_task + '\' UNREACHABLE: ' + ' ansible playbook task ' + self.failed_task + ' host unreachable: ' + str(self.host_unreachable_log))
 
     def _log_unreachable_event(self, result):
-        if self.ansible_properties.log_progress_events:
+        self._summarise_host_result(result, UNREACHABLE)
+        if self.event_filter.failure_events():
             task_name = result._task.get_name()
             self._clean_results(result._result, result._task.action)
-            task_result = result._result
+            task_result = self._task_result_view(result)
             event = HostUnreachableEvent(task_name=task_name, host_name=result._host.get_name().strip(), task_result=task_result)
             delegated_vars = result._result.get('_ansible_delegated_vars', None)
             if delegated_vars is not None:
@@ -343,6 +641,9 @@ class ResultCallback(CallbackBase):
 
     def __handle_unreachable(self, result):
         self.failed_task = result._task.get_name()
+        host_name = result._host.get_name()
+        if host_name not in self.unreachable_hosts:
+          self.unreachable_hosts.append(host_name)
         self.host_unreachable_log.append(dict(task=self.failed_task, result=result._result))
         self.host_unreachable = True
         self.failure_reason = 'Resource unreachable (task ' + str(self.failed_task) + ' failed: ' + str(result._result) + ')'
@@ -355,7 +656,7 @@ class ResultCallback(CallbackBase):
         Called when a var_prompt is used in a playbook, which we can't support because the playbook is not running in an interactive shell
         """
         logger.debug('v2_playbook_on_vars_prompt: {0}'.format(varname))
-        if self.ansible_properties.log_progress_events:
+        if self.event_filter.playbook_events():
             event = VarPromptEvent(var_name=varname)
             self.event_logger.add(event)
 
@@ -367,8 +668,8 @@ class ResultCallback(CallbackBase):
         Called when a task is retried
         """
         logger.debug('v2_runner_retry: {0}'.format(result))
-        if self.ansible_properties.log_progress_events:
-            host_name = result._host.get_name().strip()
+        host_name = result._host.get_name().strip()
+        if self.event_filter.host_event(result._task._uuid, host_name):
             delegated_vars = result._result.get('_ansible_delegated_vars', None)
             if delegated_vars is not None:
                 delegated_host_name = delegated_vars['ansible_host']
@@ -376,7 +677,7 @@ class ResultCallback(CallbackBase):
                 delegated_host_name = None
             self._clean_results(result._result, result._task.action)
             task_name = result._task.get_name().strip()
-            event = TaskRetryOnHostEvent(task_name, host_name, result._result, delegated_host_name=delegated_host_name)
+            event = TaskRetryOnHostEvent(task_name, host_name, self._task_result_view(result), delegated_host_name=delegated_host_name)
             self.event_logger.add(event)
 
     def v2_runner_on_start(self, host, task):
@@ -384,9 +685,10 @@ class ResultCallback(CallbackBase):
         Called when a task starts on a particular host (Ansible v2.8+)
         """
         logger.debug('v2_runner_on_start: host={0}, task={1}'.format(host, task))
-        if self.ansible_properties.log_progress_events:
+        self._summarise_host_start(host, task)
+        host_name = host.get_name().strip()
+        if self.event_filter.host_event(task._uuid, host_name):
             task_name = task.get_name().strip()
-            host_name = host.get_name().strip()
             event = TaskStartedOnHostEvent(task_name=task_name, host_name=host_name)
             if not task.no_log:
               # Include args if the task has not been configured with the no_log option
@@ -400,7 +702,9 @@ class ResultCallback(CallbackBase):
         logger.debug('runner_on_failed: host={0}, result={1}'.format(host, res))
     
     def _log_event_for_failed_task(self, result, is_item=False):
-        if self.ansible_properties.log_progress_events:
+        if not is_item:
+            self._summarise_host_result(result, FAILED)
+        if self.event_filter.failure_events():
             host_name = result._host.get_name().strip()
             delegated_vars = result._result.get('_ansible_delegated_vars', None)
             if delegated_vars is not None:
@@ -413,7 +717,7 @@ class ResultCallback(CallbackBase):
                 item_label = None
             self._clean_results(result._result, result._task.action)
             task_name = result._task.get_name().strip()
-            event = TaskFailedOnHostEvent(task_name, host_name, result._result, item_label=item_label, delegated_host_name=delegated_host_name)
+            event = TaskFailedOnHostEvent(task_name, host_name, self._task_result_view(result), item_label=item_label, delegated_host_name=delegated_host_name)
             self.event_logger.add(event)
 
     def v2_runner_item_on_failed(self, result):
@@ -447,9 +751,11 @@ class ResultCallback(CallbackBase):
           self.playbook_failed = True
           self._log_event_for_failed_task(result)
 
-    def _log_event_for_skipped_task(self, result, is_item=False):
-        if self.ansible_properties.log_progress_events:
-            host_name = result._host.get_name().strip()
+    def _log_event_for_skipped_task(self, result, is_item=False, summarise=False):
+        if summarise:
+            self._summarise_host_result(result, SKIPPED)
+        host_name = result._host.get_name().strip()
+        if self.event_filter.host_event(result._task._uuid, host_name):
             delegated_vars = result._result.get('_ansible_delegated_vars', None)
             if delegated_vars is not None:
                 delegated_host_name = delegated_vars['ansible_host']
@@ -461,7 +767,7 @@ class ResultCallback(CallbackBase):
                 item_label = None
             self._clean_results(result._result, result._task.action)
             task_name = result._task.get_name().strip()
-            event = TaskSkippedOnHostEvent(task_name, host_name, result._result, item_label=item_label, delegated_host_name=delegated_host_name)
+            event = TaskSkippedOnHostEvent(task_name, host_name, self._task_result_view(result), item_label=item_label, delegated_host_name=delegated_host_name)
             self.event_logger.add(event)
         
     def v2_runner_item_on_skipped(self, result):
@@ -476,27 +782,30 @@ class ResultCallback(CallbackBase):
         Called when task execution is skipped
         """
         logger.debug('v2_runner_on_skipped: {0}'.format(result))
-        self._log_event_for_skipped_task(result, is_item=True)
+        self._log_event_for_skipped_task(result, is_item=True, summarise=True)
 
     def runner_on_ok(self, host, res):
         logger.debug('runner_on_ok: host={0} res={1}'.format(host, res))
 
     def _log_event_for_ok_task(self, result, is_item=False):
+        if not is_item:
+            self._summarise_host_result(result, OK)
         if self.ansible_properties.log_progress_events:
             host_name = result._host.get_name().strip()
-            delegated_vars = result._result.get('_ansible_delegated_vars', None)
-            if delegated_vars is not None:
-                delegated_host_name = delegated_vars['ansible_host']
-            else:
-                delegated_host_name = None
-            if is_item:
-                item_label = self._get_item_label(result._result)
-            else:
-                item_label = None
-            self._clean_results(result._result, result._task.action)
-            task_name = result._task.get_name().strip()
-            event = TaskCompletedOnHostEvent(task_name, host_name, result._result, item_label=item_label, delegated_host_name=delegated_host_name)
-            self.event_logger.add(event)
+            if self.event_filter.host_event(result._task._uuid, host_name):
+                delegated_vars = result._result.get('_ansible_delegated_vars', None)
+                if delegated_vars is not None:
+                    delegated_host_name = delegated_vars['ansible_host']
+                else:
+                    delegated_host_name = None
+                if is_item:
+                    item_label = self._get_item_label(result._result)
+                else:
+                    item_label = None
+                self._clean_results(result._result, result._task.action)
+                task_name = result._task.get_name().strip()
+                event = TaskCompletedOnHostEvent(task_name, host_name, self._task_result_view(result), item_label=item_label, delegated_host_name=delegated_host_name)
+                self.event_logger.add(event)
             self._generate_additional_logs(result)
 
     def v2_runner_item_on_ok(self, result):
@@ -545,11 +854,28 @@ class ResultCallback(CallbackBase):
                       self.playbook_failed = True
         self._log_event_for_ok_task(result)
                 
+    def resume_point(self):
+      """
+      Returns where a retry of the playbook can resume from: the (last) task that found hosts unreachable, those hosts and
+      the outputs collected so far. None if no host was unreachable
+      """
+      if not self.host_unreachable or len(self.unreachable_hosts) == 0:
+        return None
+      return {
+        'task': self.failed_task,
+        'hosts': list(self.unreachable_hosts),
+        'properties': dict(self.properties),
+        'associated_topology': self.associated_topology
+      }
+
     def get_result(self):
       if self.playbook_failed:
-        return LifecycleExecution(self.request_id, STATUS_FAILED, self.failure_details, self.properties)
+        result = LifecycleExecution(self.request_id, STATUS_FAILED, self.failure_details, self.properties)
       else:
-        return LifecycleExecution(self.request_id, STATUS_COMPLETE, None, self.properties, self.associated_topology)
+        result = LifecycleExecution(self.request_id, STATUS_COMPLETE, None, self.properties, self.associated_topology)
+      # not part of the lifecycle execution message, for the driver's own reporting
+      result.slowest_tasks = self.timings.slowest_tasks(self.ansible_properties.slowest_tasks_count)
+      return result
 
     def _generate_additional_logs(self, result):
       # Added logic to print logs for custom ansible module : ibm_cp4na_log_message
@@ -621,36 +947,12 @@ def get_lifecycle_playbook_path(root_path, transition_name):
             # no playbook
             return None
 
-def process_templates(parent_dir, templating, all_properties):
-  path = parent_dir.get_path()
-  logger.debug('Process templates: walking {0}'.format(path))
-
-  for root, dirs, files in os.walk(path):
-    logger.debug('Process templates: files = '.format(files))
-    for file in files:
-        j2_env = Environment(loader=FileSystemLoader(root), trim_blocks=True)
-        path = root + '/' + file
-        logger.debug(f'Processing template {file}')
-
-        with open(path, "r") as template_file:
-          try:
-            template_content = template_file.read()
-            content = templating.render(template_content, all_properties)
-            logger.debug('Wrote process template to file {0}'.format(path))
-            with open(path, "w") as template_file_write:
-                template_file_write.write(content)
-          except UnicodeDecodeError as ude:
-            # skip this file, not a text file
-            pass
-
-
-
-
 class KeyPropertyProcessor():
-  def __init__(self, properties, system_properties, dl_properties):
+  def __init__(self, properties, system_properties, dl_properties, key_file_cache=None):
     self.properties = properties
     self.system_properties = system_properties
     self.dl_properties = dl_properties
+    self.key_file_cache = key_file_cache if key_file_cache is not None else KeyFileCache()
     self.key_files = []
 
   """
@@ -667,24 +969,22 @@ class KeyPropertyProcessor():
       self.write_private_key(properties, prop[0], prop[1])
 
   def write_private_key(self, properties, key_prop_name, private_key):
-    with NamedTemporaryFile(delete=False, mode='w') as private_key_file:
-      logger.debug('Writing private key file {0}'.format(private_key_file.name))
-      private_key_value = private_key.get('privateKey', None)
-      private_key_file.write(private_key_value)
-      private_key_file.flush()
-      self.key_files.append(private_key_file)
+    private_key_value = private_key.get('privateKey', None)
+    # requests using the same key share a file (see KeyFileCache)
+    private_key_path = self.key_file_cache.acquire(private_key_value)
+    self.key_files.append(private_key_path)
 
-      logger.debug('Setting property {0}_path'.format(key_prop_name))
-      properties[key_prop_name + '_path'] = private_key_file.name
+    logger.debug('Setting property {0}_path'.format(key_prop_name))
+    properties[key_prop_name + '_path'] = private_key_path
 
-      logger.debug('Setting property {0}_name'.format(key_prop_name))
-      key_name = private_key.get('keyName', None)
-      properties[key_prop_name + '_name'] = key_name
+    logger.debug('Setting property {0}_name'.format(key_prop_name))
+    key_name = private_key.get('keyName', None)
+    properties[key_prop_name + '_name'] = key_name
 
   """
-  Remove any private key files generated during the Ansible run.
+  Release any private key files generated during the Ansible run.
   """
   def clear_key_files(self):
     for key_file in self.key_files:
-      logger.debug('Removing private key file {0}'.format(key_file.name))
-      os.unlink(key_file.name)
+      self.key_file_cache.release(key_file)
+    self.key_files = []
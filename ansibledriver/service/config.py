@@ -5,13 +5,15 @@ from ignition.service.framework import ServiceRegistration
 from ignition.service.resourcedriver import LifecycleMessagingCapability
 from ignition.service.requestqueue import LifecycleRequestQueueCapability
 from ignition.service.templating import TemplatingCapability, ResourceTemplateContextCapability 
-from ignition.service.progress_events import ProgressEventLogWriterCapability
+from ignition.service.progress_events import ProgressEventLogWriterCapability, ProgressEventLogSerializerCapability
 import ansibledriver.api_specs as api_specs
 from ansibledriver.service.process import AnsibleProcessorCapability, AnsibleProcessorService
 from ansibledriver.service.ansible import AnsibleClientCapability, AnsibleClient
 from ansibledriver.service.resourcedriver import AnsibleDriverHandler, AdditionalResourceDriverProperties
 from ansibledriver.service.rendercontext import ExtendedResourceTemplateContextService
-from ansibledriver.service.progress_events import AnsibleYAMLProgressEventLogSerializer
+from ansibledriver.service.progress_events import AnsibleYAMLProgressEventLogSerializer, BufferedProgressEventLogWriter
+from ansibledriver.service.driverfiles import CachingDriverFilesManagerService
+from ansibledriver.service.metricsapi import MetricsApiService
 
 class AnsibleServiceConfigurator():
 
@@ -19,12 +21,16 @@ class AnsibleServiceConfigurator():
         pass
 
     def configure(self, configuration, service_register):
-        service_register.add_service(ServiceRegistration(AnsibleYAMLProgressEventLogSerializer))
+        service_register.add_service(ServiceRegistration(AnsibleYAMLProgressEventLogSerializer, configuration))
+        service_register.add_service(ServiceRegistration(BufferedProgressEventLogWriter, configuration,
+            serializer_service=ProgressEventLogSerializerCapability))
         service_register.add_service(ServiceRegistration(ExtendedResourceTemplateContextService))
+        service_register.add_service(ServiceRegistration(CachingDriverFilesManagerService, configuration))
         service_register.add_service(ServiceRegistration(AnsibleClient, configuration,
             render_context_service=ResourceTemplateContextCapability,
             templating=TemplatingCapability,
             event_logger=ProgressEventLogWriterCapability))
+        service_register.add_service(ServiceRegistration(MetricsApiService))
         service_register.add_service(ServiceRegistration(AnsibleProcessorService, configuration,
             ansible_client=AnsibleClientCapability,
             request_queue_service=LifecycleRequestQueueCapability,
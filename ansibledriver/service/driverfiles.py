@@ -0,0 +1,135 @@
+import os
+import io
+import uuid
+import base64
+import shutil
+import hashlib
+import zipfile
+import logging
+from ignition.service.framework import Service
+from ignition.service.resourcedriver import DriverFilesManagerCapability, ResourceDriverProperties
+from ignition.utils.file import DirectoryTree
+from ansibledriver.service.ansible import AnsibleProperties
+import ansibledriver.service.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_CACHE_DIRECTORY = 'package_cache'
+# directory of a resource package that is rendered in place, so must never share files with the cache
+TEMPLATED_DIRECTORY = 'config'
+
+
+class CachingDriverFilesManagerService(Service, DriverFilesManagerCapability):
+    """
+    Manages the driver files (resource packages) of requests. A pristine extracted copy of each package is kept
+    in a size-bounded cache under ansible.tmp_dir, keyed by a hash of the package content, and each request is given
+    its own working copy of the cached tree. Packages are only decoded and decompressed the first time they are seen.
+    """
+    def __init__(self, configuration):
+        resource_driver_config = configuration.property_groups.get_property_group(ResourceDriverProperties)
+        self.ansible_properties = configuration.property_groups.get_property_group(AnsibleProperties)
+        self.scripts_workspace = resource_driver_config.scripts_workspace
+        if self.scripts_workspace is None:
+            raise ValueError('scripts_workspace directory must be set')
+        if not os.path.exists(self.scripts_workspace):
+            os.makedirs(self.scripts_workspace)
+        self.cache_path = os.path.join(self.ansible_properties.tmp_dir, PACKAGE_CACHE_DIRECTORY)
+        self.max_cache_bytes = int(self.ansible_properties.package_cache_max_size_mb * 1024 * 1024)
+
+    def build_tree(self, tree_name, driver_files):
+        extracted_path = os.path.join(self.scripts_workspace, tree_name)
+        if os.path.exists(extracted_path):
+            shutil.rmtree(extracted_path)
+        if self.ansible_properties.package_cache_enabled:
+            try:
+                cached_path = self.__cached_package(driver_files)
+                shutil.copytree(cached_path, extracted_path, copy_function=self.__copy_function(cached_path))
+                return DirectoryTree(extracted_path)
+            except OSError as e:
+                # e.g. the entry was evicted by another worker whilst being copied
+                logger.warning('Unable to use the resource package cache, extracting the package directly: {0}'.format(e))
+                shutil.rmtree(extracted_path, ignore_errors=True)
+        self.__extract(base64.b64decode(driver_files), extracted_path)
+        return DirectoryTree(extracted_path)
+
+    def __extract(self, package, extracted_path):
+        package_file = io.BytesIO(package)
+        if not zipfile.is_zipfile(package_file):
+            raise ValueError('lifecycle_scripts should include binary contents of a zip file')
+        with zipfile.ZipFile(package_file, 'r') as package_zip:
+            package_zip.extractall(extracted_path)
+
+    def __cached_package(self, driver_files):
+        # the hash is taken over the encoded package, so a cache hit doesn't need to decode it
+        key = hashlib.sha256(driver_files.encode('utf-8')).hexdigest()
+        entry_path = os.path.join(self.cache_path, key)
+        if os.path.isdir(entry_path):
+            # the modification time of an entry records when it was last used
+            os.utime(entry_path)
+            metrics.package_cache_hits.inc()
+            return entry_path
+        metrics.package_cache_misses.inc()
+        os.makedirs(self.cache_path, exist_ok=True)
+        # extract to a staging directory first, so other workers never see a partially extracted package
+        staging_path = os.path.join(self.cache_path, '.staging-{0}'.format(uuid.uuid4()))
+        self.__extract(base64.b64decode(driver_files), staging_path)
+        try:
+            os.rename(staging_path, entry_path)
+        except OSError:
+            # another worker cached the same package first
+            shutil.rmtree(staging_path, ignore_errors=True)
+        self.__evict(keep=key)
+        return entry_path
+
+    def __copy_function(self, cached_path):
+        if not self.ansible_properties.package_cache_hardlinks:
+            return shutil.copy2
+        templated_path = os.path.join(cached_path, TEMPLATED_DIRECTORY, '')
+        def link_or_copy(src, dst):
+            if not src.startswith(templated_path):
+                try:
+                    os.link(src, dst)
+                    return dst
+                except OSError:
+                    pass
+            return shutil.copy2(src, dst)
+        return link_or_copy
+
+    def __evict(self, keep):
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_path):
+            if key.startswith('.'):
+                continue
+            entry_path = os.path.join(self.cache_path, key)
+            try:
+                size = directory_size(entry_path)
+                entries.append((os.stat(entry_path).st_mtime, key, size))
+                total_size += size
+            except OSError:
+                # evicted by another worker
+                pass
+        # least recently used first
+        entries.sort()
+        for last_used, key, size in entries:
+            if total_size <= self.max_cache_bytes:
+                break
+            if key == keep:
+                continue
+            logger.debug('Evicting resource package {0} from the cache'.format(key))
+            evicting_path = os.path.join(self.cache_path, '.evicting-{0}'.format(uuid.uuid4()))
+            try:
+                os.rename(os.path.join(self.cache_path, key), evicting_path)
+                shutil.rmtree(evicting_path, ignore_errors=True)
+                metrics.package_cache_evictions.inc()
+            except OSError:
+                pass
+            total_size -= size
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            size += os.lstat(os.path.join(root, file)).st_size
+    return size
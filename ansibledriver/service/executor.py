@@ -0,0 +1,284 @@
+import os
+import copy
+import pickle
+import struct
+import resource
+import logging
+from multiprocessing import Process
+from ansible.plugins.callback import CallbackBase
+from ansible.playbook.play import Play
+from ansible.playbook.task import Task
+from ansible.playbook.task_include import TaskInclude
+from ansible.inventory.host import Host
+from ansible.executor.task_result import TaskResult
+from ansible.executor.stats import AggregateStats
+import ansibledriver.service.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# how AnsibleClient runs playbooks: in the worker process, or each in a child process of its own
+IN_PROCESS = 'in_process'
+SUBPROCESS = 'subprocess'
+
+# the callback events passed from a playbook process to the ResultCallback of the worker, each identified in a frame by
+# its index in this list
+STREAMED_EVENTS = [
+    'v2_playbook_on_play_start',
+    'v2_playbook_on_task_start',
+    'v2_playbook_on_handler_task_start',
+    'v2_playbook_on_stats',
+    'v2_playbook_on_no_hosts_matched',
+    'v2_playbook_on_vars_prompt',
+    'v2_runner_on_start',
+    'v2_runner_on_ok',
+    'v2_runner_on_failed',
+    'v2_runner_on_skipped',
+    'v2_runner_on_unreachable',
+    'v2_runner_retry',
+    'v2_runner_item_on_ok',
+    'v2_runner_item_on_failed',
+    'v2_runner_item_on_skipped'
+]
+# frame types ending the stream: the playbook ran (with the return value of the run), or failed (with an error message)
+FRAME_DONE = 254
+FRAME_ERROR = 255
+
+# a frame is a header, of the frame type and length of the payload, followed by the payload (pickled)
+FRAME_HEADER = struct.Struct('!BI')
+
+
+class PlaybookProcessError(Exception):
+    pass
+
+
+class FrameWriter():
+
+    def __init__(self, fd):
+        self.fd = fd
+        # set when a frame could not be sent, so the run ends in failure rather than missing events
+        self.error = None
+
+    def write(self, frame_type, payload):
+        try:
+            data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # task results are plain data, except when a module returns an object that can't be pickled
+            try:
+                data = pickle.dumps(picklable(payload), protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                self.error = 'Unable to send {0} event of the playbook process: {1}'.format(STREAMED_EVENTS[frame_type] if frame_type < len(STREAMED_EVENTS) else frame_type, e)
+                raise
+        view = memoryview(FRAME_HEADER.pack(frame_type, len(data)) + data)
+        while len(view) > 0:
+            written = os.write(self.fd, view)
+            view = view[written:]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FrameReader():
+
+    def __init__(self, fd):
+        self.file = os.fdopen(fd, 'rb')
+
+    def read(self):
+        """
+        Returns the (frame type, payload) of the next frame, None at the end of the stream
+        """
+        header = self.file.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return None
+        frame_type, length = FRAME_HEADER.unpack(header)
+        data = self.file.read(length)
+        if len(data) < length:
+            return None
+        return frame_type, pickle.loads(data)
+
+    def close(self):
+        self.file.close()
+
+
+class StreamedPlay():
+
+    def __init__(self, play):
+        self.name = play.get_name()
+        self._uuid = str(play._uuid)
+
+    def get_name(self):
+        return self.name
+
+
+class StreamedTask():
+
+    def __init__(self, task):
+        self.name = task.get_name()
+        self._uuid = str(task._uuid)
+        self.action = task.action
+        self.no_log = task.no_log
+        self.args = {str(arg_name): str(arg_value) for arg_name, arg_value in task.args.items()} if not task.no_log else {}
+
+    def get_name(self):
+        return self.name
+
+
+class StreamedHost():
+
+    def __init__(self, host):
+        self.name = host.get_name()
+
+    def get_name(self):
+        return self.name
+
+
+class StreamedResult():
+
+    def __init__(self, result):
+        self._host = StreamedHost(result._host)
+        self._task = StreamedTask(result._task)
+        self._result = result._result
+        self._task_fields = result._task_fields
+
+
+class StreamedStats():
+
+    def __init__(self, stats):
+        self.processed = dict(stats.processed)
+        self.summaries = {host: stats.summarize(host) for host in stats.processed.keys()}
+
+    def summarize(self, host):
+        return self.summaries[host]
+
+
+def picklable(value):
+    """
+    Returns the value, or a copy of it in which the values that can't be pickled are replaced by their string, keeping
+    the stand-ins (e.g. StreamedResult) of callback arguments
+    """
+    try:
+        pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        return value
+    except Exception:
+        pass
+    if isinstance(value, dict):
+        return {key if isinstance(key, (str, int)) else str(key): picklable(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return tuple(picklable(item) for item in value)
+    if isinstance(value, (list, set)):
+        return [picklable(item) for item in value]
+    if isinstance(value, STREAMED_TYPES):
+        stand_in = copy.copy(value)
+        stand_in.__dict__ = picklable(value.__dict__)
+        return stand_in
+    return str(value)
+
+
+def streamed(value):
+    """
+    Returns a copy of a callback argument that can be sent to the worker, holding what ResultCallback uses of it
+    """
+    if isinstance(value, TaskResult):
+        return StreamedResult(value)
+    if isinstance(value, Task):
+        return StreamedTask(value)
+    if isinstance(value, Host):
+        return StreamedHost(value)
+    if isinstance(value, Play):
+        return StreamedPlay(value)
+    if isinstance(value, AggregateStats):
+        return StreamedStats(value)
+    return value
+
+
+STREAMED_TYPES = (StreamedPlay, StreamedTask, StreamedHost, StreamedResult, StreamedStats)
+
+
+class CallbackStreamer(CallbackBase):
+    """
+    Stdout callback of a playbook process, writing the events ResultCallback handles to the worker
+    """
+    def __init__(self, writer):
+        super(CallbackStreamer, self).__init__()
+        self.writer = writer
+
+    def stream(self, event, args, kwargs):
+        self.writer.write(STREAMED_EVENTS.index(event), (tuple(streamed(arg) for arg in args), {key: streamed(value) for key, value in kwargs.items()}))
+
+    def v2_runner_item_on_ok(self, result):
+        # not handled by ResultCallback, whose check for includes can't be made on the streamed task
+        if isinstance(result._task, TaskInclude):
+            return
+        self.stream('v2_runner_item_on_ok', (result,), {})
+
+
+def _streaming_method(event):
+    def stream_event(self, *args, **kwargs):
+        self.stream(event, args, kwargs)
+    stream_event.__name__ = event
+    return stream_event
+
+
+for _event in STREAMED_EVENTS:
+    if _event not in CallbackStreamer.__dict__:
+        setattr(CallbackStreamer, _event, _streaming_method(_event))
+
+
+def _run_playbook_process(execute, read_fd, write_fd, max_memory_mb, max_cpu_seconds):
+    os.close(read_fd)
+    writer = FrameWriter(write_fd)
+    try:
+        # limits apply to the playbook process and each of the Ansible processes it forks
+        if max_memory_mb > 0:
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory_mb * 1024 * 1024, resource.RLIM_INFINITY))
+        if max_cpu_seconds > 0:
+            resource.setrlimit(resource.RLIMIT_CPU, (max_cpu_seconds, resource.RLIM_INFINITY))
+        start_at_done = execute(CallbackStreamer(writer))
+        if writer.error is not None:
+            # Ansible only logs the exceptions of callbacks, the worker would miss an event (e.g. a failure)
+            writer.write(FRAME_ERROR, writer.error)
+        else:
+            writer.write(FRAME_DONE, start_at_done)
+    except Exception as e:
+        logger.exception('Playbook process failed')
+        writer.write(FRAME_ERROR, 'Playbook process failed: {0}'.format(e))
+    finally:
+        writer.close()
+
+
+def run_in_subprocess(execute, callback, max_memory_mb=0, max_cpu_seconds=0):
+    """
+    Runs execute(stdout_callback) in a child process, calling the methods of callback for the events received by the
+    child's stdout_callback as they arrive. Returns what execute returned, or raises a PlaybookProcessError if it
+    raised an exception or the child exited without finishing (e.g. it was killed for exceeding a limit)
+    """
+    read_fd, write_fd = os.pipe()
+    playbook_process = Process(target=_run_playbook_process, args=(execute, read_fd, write_fd, max_memory_mb, max_cpu_seconds), daemon=False)
+    playbook_process.start()
+    # close the write end of the pipe in this process, so a dead child is seen as the end of the stream
+    os.close(write_fd)
+    reader = FrameReader(read_fd)
+    ending = None
+    try:
+        frame = reader.read()
+        while frame is not None:
+            frame_type, payload = frame
+            if frame_type in (FRAME_DONE, FRAME_ERROR):
+                ending = frame
+            else:
+                args, kwargs = payload
+                try:
+                    getattr(callback, STREAMED_EVENTS[frame_type])(*args, **kwargs)
+                except Exception as e:
+                    # as Ansible does for the callbacks of a playbook run in process
+                    logger.warning('Failure handling callback event {0}: {1}'.format(STREAMED_EVENTS[frame_type], e))
+            frame = reader.read()
+    finally:
+        reader.close()
+        playbook_process.join()
+        metrics.process_exited(playbook_process.pid)
+    if ending is None:
+        raise PlaybookProcessError('Playbook process exited unexpectedly with exit code {0}'.format(playbook_process.exitcode))
+    frame_type, payload = ending
+    if frame_type == FRAME_ERROR:
+        raise PlaybookProcessError(payload)
+    return payload
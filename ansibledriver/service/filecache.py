@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache():
+    """
+    Per-process cache of files written for requests, keyed by a hash of what they hold (see key), so requests that need
+    the same content share one file. Files are reference counted, and removed once they have not been used for
+    ttl_seconds. With a ttl_seconds of 0 each acquire writes its own file, removed when released.
+
+    Only the process that owns the cache shares files: the process that created it, until a worker forked from it
+    claims it. Other processes forked from the owner (e.g. the playbook processes of a concurrent worker) write and
+    remove their own files, as they can't return them to the cache.
+
+    Subclasses derive the key (key), write the file (write_file) and dispose of files that are not cached
+    (discard_file), and set the metrics counting hits and misses
+    """
+    # described in the logs as
+    file_description = 'file'
+    hits_metric = None
+    misses_metric = None
+
+    def __init__(self, ttl_seconds, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.owner_pid = os.getpid()
+        # entries by key, each with the path of the file, its reference count and when it was last released
+        self.entries = {}
+        self.keys_by_path = {}
+        self.lock = threading.Lock()
+
+    def claim(self):
+        """
+        Makes this process the owner of the cache, called by a worker when it starts. Entries inherited from the
+        parent are dropped, their files belong to the parent
+        """
+        self.owner_pid = os.getpid()
+        self.entries = {}
+        self.keys_by_path = {}
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.ttl_seconds > 0 and os.getpid() == self.owner_pid
+
+    def key(self, source):
+        raise NotImplementedError()
+
+    def write_file(self, source, cached):
+        """
+        Writes a file for the source, returning its path. cached is True when the file is kept by the cache
+        """
+        raise NotImplementedError()
+
+    def discard_file(self, path, source):
+        """
+        Disposes of a file written when the cache is not in use
+        """
+        self.remove_file(path)
+
+    def acquire(self, source):
+        """
+        Returns the path of a file for the source, to be given back with release
+        """
+        if not self.enabled():
+            return self.write_file(source, False)
+        key = self.key(source)
+        with self.lock:
+            self.__evict()
+            entry = self.entries.get(key, None)
+            if entry is not None and os.path.exists(entry['path']):
+                self.hits_metric.inc()
+            else:
+                self.misses_metric.inc()
+                entry = {'path': self.write_file(source, True), 'references': 0, 'released': None}
+                self.entries[key] = entry
+                self.keys_by_path[entry['path']] = key
+            entry['references'] += 1
+            return entry['path']
+
+    def release(self, path, source=None):
+        """
+        Gives back a file returned by acquire
+        """
+        if not self.enabled():
+            self.discard_file(path, source)
+            return
+        with self.lock:
+            entry = self.entries.get(self.keys_by_path.get(path, None), None)
+            if entry is not None and entry['references'] > 0:
+                entry['references'] -= 1
+                if entry['references'] == 0:
+                    entry['released'] = self.clock()
+            self.__evict()
+
+    def __evict(self):
+        now = self.clock()
+        for key, entry in list(self.entries.items()):
+            if entry['references'] == 0 and entry['released'] is not None and now - entry['released'] >= self.ttl_seconds:
+                self.__remove(key, entry)
+
+    def __remove(self, key, entry):
+        del self.entries[key]
+        self.keys_by_path.pop(entry['path'], None)
+        self.remove_file(entry['path'])
+
+    def remove_file(self, path):
+        try:
+            if os.path.exists(path):
+                logger.debug('Removing {0} {1}'.format(self.file_description, path))
+                os.unlink(path)
+        except Exception as e:
+            logger.exception('Encountered an error whilst trying to remove {0} {1}: {2}'.format(self.file_description, path, str(e)))
+
+    def clear(self):
+        """
+        Removes every cached file, including those still in use
+        """
+        if os.getpid() != self.owner_pid:
+            return
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                self.__remove(key, entry)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,56 @@
+import logging
+from multiprocessing import Lock, RawValue
+from collections.abc import Mapping
+
+logger = logging.getLogger(__name__)
+
+# resource property overriding the forks of the playbooks of a resource package (declared, with a default value, in
+# the package's resource descriptor)
+FORKS_PROPERTY = 'playbook_forks'
+
+
+class ForkBudget():
+    """
+    Forks (Ansible worker processes) in use by the playbook runs of all the processes forked from the process that
+    created the budget (an AnsibleClient, one for each gunicorn worker of the driver), limited to max_forks (0 is no
+    limit). Each run is granted at least one fork, even when the budget is used up, so the budget may be exceeded by
+    one fork for each run started while it is
+    """
+    def __init__(self, max_forks):
+        self.max_forks = max_forks
+        self.lock = Lock()
+        self.in_use = RawValue('i', 0)
+
+    def acquire(self, wanted):
+        """
+        Returns the number of forks granted to a run that wants the given number, to be given back with release
+        """
+        if self.max_forks <= 0:
+            return wanted
+        with self.lock:
+            granted = max(1, min(wanted, self.max_forks - self.in_use.value))
+            self.in_use.value += granted
+        if granted < wanted:
+            logger.debug('Fork budget of {0} used up, running with {1} of {2} forks'.format(self.max_forks, granted, wanted))
+        return granted
+
+    def release(self, granted):
+        if self.max_forks <= 0:
+            return
+        with self.lock:
+            self.in_use.value = max(0, self.in_use.value - granted)
+
+
+def wanted_forks(max_forks, host_count, resource_properties=None):
+    """
+    Returns the forks wanted by a playbook run against host_count hosts: no more than the hosts, nor than max_forks or
+    the playbook_forks resource property, if set
+    """
+    if isinstance(resource_properties, Mapping):
+        override = resource_properties.get(FORKS_PROPERTY, None)
+        if override is not None:
+            try:
+                max_forks = int(override)
+            except (TypeError, ValueError):
+                logger.warning('Invalid {0} resource property {1}, using {2} forks'.format(FORKS_PROPERTY, override, max_forks))
+    return max(1, min(max_forks, host_count))
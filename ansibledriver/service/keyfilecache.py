@@ -0,0 +1,34 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import ansibledriver.service.metrics as metrics
+from ansibledriver.service.filecache import FileCache
+
+logger = logging.getLogger(__name__)
+
+
+class KeyFileCache(FileCache):
+    """
+    Cache of the private key files written for key properties, keyed by the fingerprint (sha256) of the key. Files are
+    written to key_dir (e.g. /dev/shm, so key material stays in memory; None is the default temp dir)
+    """
+    file_description = 'private key file'
+    hits_metric = metrics.key_file_cache_hits
+    misses_metric = metrics.key_file_cache_misses
+
+    def __init__(self, key_dir=None, ttl_seconds=0, clock=time.monotonic):
+        super().__init__(ttl_seconds, clock=clock)
+        self.key_dir = key_dir
+
+    def key(self, private_key):
+        return hashlib.sha256(private_key.encode('utf-8')).hexdigest()
+
+    def write_file(self, private_key, cached):
+        # mkstemp creates the file readable and writable by this user only
+        fd, path = tempfile.mkstemp(prefix='key_', dir=self.key_dir)
+        with os.fdopen(fd, 'w') as key_file:
+            logger.debug('Writing private key file {0}'.format(path))
+            key_file.write(private_key)
+        return path
@@ -0,0 +1,27 @@
+import json
+import hashlib
+import ansibledriver.service.metrics as metrics
+from ansibledriver.service.filecache import FileCache
+
+
+class KubeconfigCache(FileCache):
+    """
+    Cache of the kubeconfig files written for Kubernetes deployment locations, keyed by a hash of the location's client
+    config, so requests against the same cluster share one file
+    """
+    file_description = 'kubeconfig file'
+    hits_metric = metrics.kubeconfig_cache_hits
+    misses_metric = metrics.kubeconfig_cache_misses
+
+    def key(self, kube_location):
+        return hashlib.sha256(json.dumps(kube_location.client_config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def write_file(self, kube_location, cached):
+        path = kube_location.write_config_file()
+        if cached:
+            # the cache, not the location, removes the file
+            kube_location.config_files_created = [f for f in kube_location.config_files_created if f['path'] != path]
+        return path
+
+    def discard_file(self, path, kube_location):
+        kube_location.clear_config_files()
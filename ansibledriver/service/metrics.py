@@ -0,0 +1,215 @@
+import os
+import glob
+import fcntl
+import logging
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, multiprocess
+from prometheus_client.mmap_dict import MmapedDict
+
+logger = logging.getLogger(__name__)
+
+"""
+Operational metrics of the driver. Metrics are registered with the default prometheus_client registry.
+
+Metrics are recorded by the Ansible worker processes (and their playbook processes) as well as the main process. When
+PROMETHEUS_MULTIPROC_DIR is set, before the driver starts, each process writes its metrics to files in that directory
+and they are aggregated when collected. The counter and histogram values of processes that have exited are merged into
+archive files, so the files to aggregate don't grow with every process started.
+"""
+
+# types of metric whose values are kept (in archive files) once the process that recorded them has exited. Gauges are
+# all live (removed when their process exits)
+ARCHIVED_TYPES = ['counter', 'histogram', 'summary']
+
+def multiprocess_enabled():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') is not None
+
+
+def generate():
+    """
+    Returns the metrics of all processes of the driver in the Prometheus text format
+    """
+    if multiprocess_enabled():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def process_exited(pid):
+    """
+    Called when a process that may have recorded metrics has exited, so that its live gauge values are removed and its
+    other values archived
+    """
+    if multiprocess_enabled() and pid is not None:
+        try:
+            multiprocess.mark_process_dead(pid)
+            archive_process(pid)
+        except Exception as e:
+            logger.debug('Unable to remove metrics of process {0}: {1}'.format(pid, e))
+
+
+def archive_process(pid, path=None):
+    """
+    Adds the values of the metric files of an exited process to the archive file of their type, then removes them
+    """
+    path = path if path is not None else os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    # workers archive the files of their playbook processes, the main process those of the workers
+    with open(os.path.join(path, 'archive.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            for metric_type in ARCHIVED_TYPES:
+                process_file = os.path.join(path, '{0}_{1}.db'.format(metric_type, pid))
+                if not os.path.exists(process_file):
+                    continue
+                # opened for each merge, as other processes may have added keys since
+                archive = MmapedDict(os.path.join(path, '{0}_archive.db'.format(metric_type)))
+                try:
+                    for key, value, timestamp, position in MmapedDict.read_all_values_from_file(process_file):
+                        archived_value, archived_timestamp = archive.read_value(key)
+                        archive.write_value(key, archived_value + value, max(archived_timestamp, timestamp))
+                finally:
+                    archive.close()
+                os.remove(process_file)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def archive_exited_processes(path=None):
+    """
+    Archives the metrics of processes that have exited without process_exited being called (e.g. killed playbook
+    processes)
+    """
+    if not multiprocess_enabled() and path is None:
+        return
+    path = path if path is not None else os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    pids = set()
+    for metric_file in glob.glob(os.path.join(path, '*.db')):
+        pid = os.path.basename(metric_file)[:-len('.db')].split('_')[-1]
+        if pid.isdigit():
+            pids.add(int(pid))
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            multiprocess.mark_process_dead(pid, path)
+            archive_process(pid, path)
+        except PermissionError:
+            pass
+
+
+## Ansible process pool
+
+process_pool_size = Gauge('ald_process_pool_size',
+    'Number of Ansible worker processes in the pool', multiprocess_mode='livesum')
+process_pool_workers_spawned = Counter('ald_process_pool_workers_spawned',
+    'Number of Ansible worker processes started')
+process_pool_workers_retired = Counter('ald_process_pool_workers_retired',
+    'Number of Ansible worker processes retired from the pool')
+process_pool_capacity = Gauge('ald_process_pool_capacity',
+    'Number of requests the Ansible worker pool can handle at the same time', multiprocess_mode='livesum')
+process_pool_active_requests = Gauge('ald_process_pool_active_requests',
+    'Number of requests being handled by the Ansible worker pool', multiprocess_mode='livesum')
+process_pool_workers_recycled = Counter('ald_process_pool_workers_recycled',
+    'Number of Ansible worker processes replaced after reaching their request or memory limit', ['reason'])
+worker_rss_bytes = Gauge('ald_worker_rss_bytes',
+    'Resident memory of each Ansible worker process', ['worker'], multiprocess_mode='liveall')
+process_pool_workers_died = Counter('ald_process_pool_workers_died',
+    'Number of Ansible worker processes that exited unexpectedly, by signal or exit code', ['reason'])
+process_pool_workers_restarted = Counter('ald_process_pool_workers_restarted',
+    'Number of Ansible worker processes started to replace one that died')
+worker_requests_recovered = Counter('ald_worker_requests_recovered',
+    'Number of requests left unfinished by an Ansible worker process that exited, failed or left to be redelivered', ['outcome'])
+
+## Lifecycle requests
+
+REQUEST_DURATION_BUCKETS = (0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, float('inf'))
+
+requests_handled = Counter('ald_requests',
+    'Number of lifecycle requests handled, by lifecycle and result status', ['lifecycle', 'status'])
+request_duration_seconds = Histogram('ald_request_duration_seconds',
+    'Time taken to handle a lifecycle request', ['lifecycle'], buckets=REQUEST_DURATION_BUCKETS)
+request_queue_wait_seconds = Histogram('ald_request_queue_wait_seconds',
+    'Time from a lifecycle request being put on the request queue to a worker starting to handle it', ['lifecycle'],
+    buckets=REQUEST_DURATION_BUCKETS)
+unreachable_retries = Counter('ald_unreachable_retries',
+    'Number of times a lifecycle request was scheduled to run again because a host was unreachable', ['lifecycle'])
+scheduled_requests = Gauge('ald_scheduled_requests',
+    'Number of lifecycle requests read by workers, waiting for the tenant-fair scheduler to run them', multiprocess_mode='livesum')
+parked_retries = Gauge('ald_parked_retries',
+    'Number of lifecycle requests waiting to be retried because a host was unreachable', multiprocess_mode='livesum')
+scheduled_requests_expired = Counter('ald_scheduled_requests_expired',
+    'Number of lifecycle requests failed because they waited longer than scheduler_max_wait_seconds to run', ['lifecycle'])
+unreachable_retries_rejected = Counter('ald_unreachable_retries_rejected',
+    'Number of unreachable retries not made because the retry budget of the worker was exhausted', ['lifecycle'])
+
+## Playbook cache
+
+playbook_cache_hits = Counter('ald_playbook_cache_hits',
+    'Number of playbook runs that used YAML cached from a previous run of the same scripts')
+playbook_cache_misses = Counter('ald_playbook_cache_misses',
+    'Number of playbook runs that had to parse their scripts')
+
+## Resource package cache
+
+package_cache_hits = Counter('ald_package_cache_hits',
+    'Number of requests whose resource package was copied from the package cache')
+package_cache_misses = Counter('ald_package_cache_misses',
+    'Number of requests whose resource package had to be extracted')
+package_cache_evictions = Counter('ald_package_cache_evictions',
+    'Number of resource packages evicted from the package cache')
+
+## Kubeconfig cache
+
+kubeconfig_cache_hits = Counter('ald_kubeconfig_cache_hits',
+    'Number of requests that used a kubeconfig file cached for their Kubernetes deployment location')
+kubeconfig_cache_misses = Counter('ald_kubeconfig_cache_misses',
+    'Number of requests that had to write a kubeconfig file for their Kubernetes deployment location')
+
+## Private key file cache
+
+key_file_cache_hits = Counter('ald_key_file_cache_hits',
+    'Number of key properties that used a cached private key file')
+key_file_cache_misses = Counter('ald_key_file_cache_misses',
+    'Number of key properties that had to write a private key file')
+
+## Forks
+
+ansible_forks = Gauge('ald_ansible_forks',
+    'Number of forks (Ansible worker processes) granted to the playbooks running in the pod', multiprocess_mode='livesum')
+
+## SSH master connection pool
+
+ssh_masters_reused = Counter('ald_ssh_masters_reused',
+    'Number of times a playbook run found an SSH master connection open for one of its hosts')
+ssh_masters_stopped = Counter('ald_ssh_masters_stopped',
+    'Number of SSH master connections stopped by the pool, by reason (idle, max_connections or unhealthy)', ['reason'])
+
+## Progress events
+
+progress_events_dropped = Counter('ald_progress_events_dropped',
+    'Number of progress events discarded because the progress event buffer was full')
+progress_event_write_seconds = Histogram('ald_progress_event_write_seconds',
+    'Time from a progress event being added to it being written',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf')))
+
+## Templates
+
+template_cache_hits = Counter('ald_template_cache_hits',
+    'Number of templates rendered with a compiled template from the template cache')
+template_cache_misses = Counter('ald_template_cache_misses',
+    'Number of templates that had to be compiled')
+template_rendering_seconds = Histogram('ald_template_rendering_seconds',
+    'Time taken to render the templates of a resource package',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float('inf')))
+
+## Playbook timings
+
+PLAYBOOK_DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, float('inf'))
+
+playbook_play_duration_seconds = Histogram('ald_playbook_play_duration_seconds',
+    'Wall time of each play of a lifecycle playbook', ['lifecycle'], buckets=PLAYBOOK_DURATION_BUCKETS)
+playbook_task_duration_seconds = Histogram('ald_playbook_task_duration_seconds',
+    'Wall time of each task of a lifecycle playbook, across all of its hosts, by the module it runs', ['lifecycle', 'module'], buckets=PLAYBOOK_DURATION_BUCKETS)
+playbook_task_host_duration_seconds = Histogram('ald_playbook_task_host_duration_seconds',
+    'Wall time of each task of a lifecycle playbook on each of its hosts, by the module it runs', ['lifecycle', 'module'], buckets=PLAYBOOK_DURATION_BUCKETS)
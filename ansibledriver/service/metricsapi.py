@@ -0,0 +1,28 @@
+import os
+import pathlib
+import logging
+from ignition.service.framework import Service, Capability, interface
+import ansibledriver.api_specs as api_specs
+import ansibledriver.service.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+metrics_api_spec = os.path.join(str(pathlib.Path(api_specs.__file__).parent.resolve()), 'metrics.yaml')
+
+
+class MetricsApiCapability(Capability):
+
+    @interface
+    def metrics(self):
+        pass
+
+
+class MetricsApiService(Service, MetricsApiCapability):
+    """
+    Controller for the metrics API, which Prometheus scrapes
+    """
+    def __init__(self):
+        pass
+
+    def metrics(self):
+        return (metrics.generate().decode('utf-8'), 200, {'Content-Type': 'text/plain'})
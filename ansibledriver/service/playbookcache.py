@@ -0,0 +1,106 @@
+import os
+import hashlib
+import logging
+import ansibledriver.service.metrics as metrics
+from ansibledriver.util.lrucache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# vars files are loaded "unsafe" (without copying) by Ansible so they are never shared between runs
+UNCACHEABLE_DIRECTORIES = ('host_vars', 'group_vars')
+
+
+class PlaybookCache():
+    """
+    Per-process cache of the YAML parsed by Ansible from the scripts of a resource package (playbooks, includes and
+    roles), keyed by a hash of the content of the scripts directory. Runs of a package that has been seen before
+    have their DataLoader primed with the parsed data, so they skip reading and parsing the YAML.
+
+    Only the process that owns the cache uses it (see claim): processes forked to run a single request or playbook
+    would throw their entries away, so they skip it
+    """
+    def __init__(self, max_size):
+        self.entries = LRUCache(max_size)
+        self.owner_pid = os.getpid()
+
+    def claim(self):
+        """
+        Makes this process the owner of the cache, called by a worker when it starts
+        """
+        self.owner_pid = os.getpid()
+
+    def enabled(self):
+        return self.entries.max_size > 0 and os.getpid() == self.owner_pid
+
+    def content_hash(self, scripts_path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(scripts_path):
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                digest.update(os.path.relpath(path, scripts_path).encode('utf-8'))
+                digest.update(b'\0')
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+                digest.update(b'\0')
+        return digest.hexdigest()
+
+    def load(self, loader, scripts_path):
+        """
+        Primes the loader with any cached data for the scripts. Returns the cache key for the scripts, to be
+        passed to save once the loader has been used
+        """
+        if not self.enabled():
+            return None
+        key = self.content_hash(scripts_path)
+        entry = self.entries.get(key)
+        if entry is None:
+            metrics.playbook_cache_misses.inc()
+            return key
+        metrics.playbook_cache_hits.inc()
+        if entry['root'] != scripts_path:
+            for data in entry['files'].values():
+                relocate(data, entry['root'], scripts_path)
+            entry['root'] = scripts_path
+        for relative_path, data in entry['files'].items():
+            loader._FILE_CACHE[os.path.join(scripts_path, relative_path)] = data
+        return key
+
+    def save(self, key, loader, scripts_path):
+        """
+        Stores the data parsed from files in the scripts directory by the loader
+        """
+        if key is None:
+            return
+        files = {}
+        prefix = os.path.join(scripts_path, '')
+        for path, data in loader._FILE_CACHE.items():
+            if path.startswith(prefix):
+                relative_path = path[len(prefix):]
+                if not any(directory in UNCACHEABLE_DIRECTORIES for directory in relative_path.split(os.sep)[:-1]):
+                    files[relative_path] = data
+        entry = self.entries.peek(key)
+        if entry is None:
+            self.entries.put(key, {'root': scripts_path, 'files': files})
+        else:
+            entry['files'].update(files)
+
+
+def relocate(data, old_root, new_root):
+    """
+    Rewrites the source file positions recorded in parsed YAML (used by Ansible to find files relative to a task)
+    from one scripts directory to another
+    """
+    old_prefix = os.path.join(old_root, '')
+    new_prefix = os.path.join(new_root, '')
+    stack = [data]
+    while len(stack) > 0:
+        item = stack.pop()
+        data_source = getattr(item, '_data_source', None)
+        if isinstance(data_source, str) and data_source.startswith(old_prefix):
+            item._data_source = new_prefix + data_source[len(old_prefix):]
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
@@ -1,7 +1,9 @@
 import json
 import logging
+import gc
 import time
 import os
+import shutil
 import sys
 import multiprocessing
 import copy
@@ -17,9 +19,18 @@ from ignition.service.framework import Service, Capability, interface
 from ignition.service.config import ConfigurationPropertiesGroup
 from ignition.service.logging import logging_context
 from ignition.service.requestqueue import RequestHandler
+from ansibledriver.service.retry import UnreachableRetry, RetryBudget, DelayedRetryQueue, UNREACHABLE_RETRY_STATE
+from ansibledriver.service.scheduling import SharedCounters, TenantFairScheduler, LocationLimiter
+from ansibledriver.service.supervision import RequestJournal, RestartBackoff, exit_reason
+import ansibledriver.service.metrics as metrics
 
 logger = logging.getLogger(__name__)
 
+# status of a request (in metrics) whose attempt found a host unreachable and that is waiting to be retried
+STATUS_RETRYING = 'RETRYING'
+# how often a worker measures its resident memory
+RSS_UPDATE_SECONDS = 5
+
 class AnsibleProcessorCapability(Capability):
 
     @interface
@@ -32,6 +43,67 @@ class ProcessProperties(ConfigurationPropertiesGroup):
         # apply defaults (correct settings will be picked up from config file or environment variables)
         self.process_pool_size = 2
         self.use_process_pool = True
+        # elastic pool: process_pool_size is the initial size, the pool then grows and shrinks between
+        # min_process_pool_size and max_process_pool_size
+        self.autoscale_enabled = False
+        self.min_process_pool_size = 1
+        self.max_process_pool_size = 10
+        # number of requests waiting on the lifecycle request queue before another worker is added
+        self.scale_up_queue_lag = 1
+        # workers that have not handled a request for this long are retired
+        self.worker_idle_seconds = 300
+        # workers are recycled after handling worker_max_requests requests, or once their resident memory exceeds
+        # worker_max_rss_mb (0 is no limit): a replacement is started, then the worker stops reading requests and exits
+        # once it has finished those it has already read
+        self.worker_max_requests = 0
+        self.worker_max_rss_mb = 0
+        # workers that die (e.g. killed for running out of memory) are replaced, their requests failed (or left to be
+        # redelivered by the request queue). A worker that keeps dying is restarted after a delay, doubling from
+        # worker_restart_backoff_seconds up to worker_restart_max_backoff_seconds, reset once no worker has died for
+        # worker_restart_backoff_reset_seconds
+        self.worker_restart_enabled = True
+        self.worker_supervisor_interval_seconds = 1
+        self.worker_restart_backoff_seconds = 1
+        self.worker_restart_max_backoff_seconds = 60
+        self.worker_restart_backoff_reset_seconds = 300
+        # where each worker records the requests it has accepted, for the supervisor (None is the default temp dir)
+        self.request_journal_dir = None
+        # how often the pool is checked for scaling
+        self.pool_monitor_interval_seconds = 5
+        # pre-load Ansible plugins in this process before forking workers from it, so that new and replacement
+        # workers start warm
+        self.warm_worker_template = False
+        # number of requests a worker handles at the same time. With more than 1, each request runs in its own child
+        # process, supervised by a thread of the worker. The child exits once the request is done, so the caches kept
+        # by each worker process (parsed playbooks, templates, kubeconfig and private key files) are not used: only
+        # the SSH control pool and package cache, kept on disk, carry over from one request to the next
+        self.max_concurrent_requests_per_worker = 1
+        # unreachable retries allowed for all the requests of a worker in any unreachable_retry_budget_window_seconds
+        # (0 is no limit). Requests that would exceed the budget fail with the result of their last attempt
+        self.unreachable_retry_budget = 60
+        self.unreachable_retry_budget_window_seconds = 60
+        # tenant-fair scheduling: each worker reads up to scheduler_queue_size requests ahead and runs them by priority
+        # (the priority field or request property, higher first), then in turns weighted by tenant_weights (by
+        # tenant_id, default 1). Tenants are limited to tenant_max_concurrent_requests in progress across the pool
+        # (0 is no limit), or their own limit in tenant_concurrency_caps. Each gunicorn worker of the driver
+        # (NUM_PROCESSES) runs a pool of its own, so a pod runs up to NUM_PROCESSES times the limit of a tenant.
+        # Requests read ahead are committed on the request queue as they are read, so are delivered at most once: the
+        # requests of a worker that dies are failed, but those of a driver pod that dies are lost. Requests waiting to
+        # run for longer than scheduler_max_wait_seconds (0 is no limit) fail, making room for the requests behind them
+        self.tenant_scheduling_enabled = False
+        self.scheduler_queue_size = 20
+        self.scheduler_max_wait_seconds = 1800
+        self.tenant_weights = {}
+        self.tenant_max_concurrent_requests = 0
+        self.tenant_concurrency_caps = {}
+        # requests in progress against each deployment location across the pool (0 is no limit). Limits can be set by
+        # infrastructure type in location_concurrency_limits, e.g. {'Openstack': {'max_concurrent_requests': 5,
+        # 'key': 'endpoint'}}, where key is name (count by deployment location name) or endpoint (count by the API
+        # endpoint of the location, or the value of its endpoint_property). Requests beyond a limit stay queued on the
+        # worker that read them, which reads up to scheduler_queue_size requests ahead. As with the tenant caps, the
+        # limits apply to the pool of each gunicorn worker, so a pod runs up to NUM_PROCESSES times the limit
+        self.location_max_concurrent_requests = 0
+        self.location_concurrency_limits = {}
 
 class AnsibleProcessorService(Service, AnsibleProcessorCapability):
     def __init__(self, configuration, **kwargs):
@@ -62,12 +134,208 @@ class AnsibleProcessorService(Service, AnsibleProcessorCapability):
         # we don't using a multiprocessing.Pool here because it uses daemon processes which cannot
         # create sub-processes (and Ansible requires this)
         self.shutdown_event = multiprocessing.Event()
-        self.pool = [None] * self.process_properties.process_pool_size
-        for i in range(self.process_properties.process_pool_size):
-          request_queue = self.request_queue_service.get_lifecycle_request_queue('AnsiblePoolProcess{0}'.format(i), AnsibleRequestHandler(self.messaging_service, self.ansible_client))
-          self.pool[i] = AnsibleProcess('AnsiblePoolProcess{0}'.format(i), request_queue, self.sigchld_handler, self.shutdown_event)
-          self.pool[i].daemon = False
-          self.pool[i].start()
+        self.pool = []
+        self.pool_lock = threading.RLock()
+        self.next_worker_id = 0
+        # requests in progress by tenant, shared by the workers of this pool (not those of other gunicorn workers)
+        self.tenant_counters = SharedCounters() if self.process_properties.tenant_scheduling_enabled else None
+        # requests in progress by deployment location, shared by the workers of this pool
+        self.location_counters = SharedCounters() if LocationLimiter.enabled(self.process_properties) else None
+        # delays the restart of workers that keep dying, and the restarts waiting for their delay to pass
+        self.restart_backoff = RestartBackoff(self.process_properties.worker_restart_backoff_seconds, self.process_properties.worker_restart_max_backoff_seconds,
+          self.process_properties.worker_restart_backoff_reset_seconds)
+        self.pending_restarts = []
+        if self.process_properties.warm_worker_template:
+          self.warm_up()
+        for i in range(self.initial_pool_size()):
+          self.spawn_worker()
+
+        # the pool monitor adds and retires workers in the background
+        self.pool_monitor = AnsiblePoolMonitor(self.maintain_pool, self.process_properties.pool_monitor_interval_seconds, self.shutdown_event, name='AnsiblePoolMonitor')
+        self.pool_monitor.start()
+        # the supervisor replaces workers that have died
+        self.worker_supervisor = AnsiblePoolMonitor(self.supervise_workers, self.process_properties.worker_supervisor_interval_seconds, self.shutdown_event, name='AnsibleWorkerSupervisor')
+        self.worker_supervisor.start()
+
+    def warm_up(self):
+      start = time.perf_counter()
+      self.ansible_client.warm_up()
+      # move everything loaded so far out of reach of the garbage collector, so forked workers
+      # don't copy memory pages just because the collector touched them
+      gc.collect()
+      gc.freeze()
+      logger.info('Warmed up Ansible worker template in {0:.3f}s'.format(time.perf_counter() - start))
+
+    def initial_pool_size(self):
+      pool_size = self.process_properties.process_pool_size
+      if self.process_properties.autoscale_enabled:
+        pool_size = max(self.process_properties.min_process_pool_size, min(pool_size, self.process_properties.max_process_pool_size))
+      return pool_size
+
+    def spawn_worker(self):
+      with self.pool_lock:
+        name = 'AnsiblePoolProcess{0}'.format(self.next_worker_id)
+        self.next_worker_id += 1
+        worker_state = WorkerState()
+        request_handler = self.create_request_handler(worker_state)
+        request_handler.journal = RequestJournal.create(self.process_properties.request_journal_dir)
+        request_queue = self.request_queue_service.get_lifecycle_request_queue(name, request_handler)
+        request_handler.queue_timing = time_request_queue(request_queue)
+        worker = AnsibleProcess(name, request_queue, self.sigchld_handler, self.shutdown_event, worker_state=worker_state, request_handler=request_handler)
+        worker.daemon = False
+        worker.start()
+        self.pool.append(worker)
+        metrics.process_pool_workers_spawned.inc()
+        self.update_pool_metrics()
+        return worker
+
+    def update_pool_metrics(self):
+      pool_size = len(self.active_workers())
+      metrics.process_pool_size.set(pool_size)
+      metrics.process_pool_capacity.set(pool_size * max(1, self.process_properties.max_concurrent_requests_per_worker))
+
+    def create_request_handler(self, worker_state):
+      max_concurrent_requests = self.process_properties.max_concurrent_requests_per_worker
+      retry_budget = RetryBudget(self.process_properties.unreachable_retry_budget, self.process_properties.unreachable_retry_budget_window_seconds)
+      scheduler = None
+      if self.process_properties.tenant_scheduling_enabled or self.location_counters is not None:
+        location_limiter = LocationLimiter(self.process_properties, self.location_counters) if self.location_counters is not None else None
+        scheduler = TenantFairScheduler(self.process_properties, self.tenant_counters, location_limiter=location_limiter)
+      if max_concurrent_requests > 1:
+        return ConcurrentAnsibleRequestHandler(self.messaging_service, self.ansible_client, max_concurrent_requests, worker_state=worker_state, retry_budget=retry_budget, scheduler=scheduler)
+      return AnsibleRequestHandler(self.messaging_service, self.ansible_client, worker_state=worker_state, retry_budget=retry_budget, scheduler=scheduler)
+
+    def retire_worker(self, worker):
+      with self.pool_lock:
+        logger.info('Retiring Ansible worker process {0}'.format(worker.name))
+        # the worker exits once it has finished handling its current request
+        worker.worker_state.retire_event.set()
+        metrics.process_pool_workers_retired.inc()
+        self.update_pool_metrics()
+
+    def active_workers(self):
+      return [worker for worker in self.pool if not worker.worker_state.retire_event.is_set()]
+
+    def reap_retired_workers(self):
+      with self.pool_lock:
+        for worker in list(self.pool):
+          if worker.worker_state.retire_event.is_set() and not worker.is_alive():
+            self.remove_worker(worker)
+            logger.debug('Removed retired Ansible worker process {0}'.format(worker.name))
+
+    def remove_worker(self, worker):
+      """
+      Removes a worker that has exited from the pool, dealing with the requests it left unfinished
+      """
+      worker.join()
+      self.pool.remove(worker)
+      metrics.process_exited(worker.pid)
+      self.recover_requests(worker)
+
+    def recover_requests(self, worker):
+      """
+      Fails the requests a worker accepted but did not finish, except those the request queue will redeliver (not yet
+      committed), and releases the tenant and location slots they held
+      """
+      journal = getattr(worker.request_handler, 'journal', None) if worker.request_handler is not None else None
+      if journal is None:
+        return
+      reason = exit_reason(worker.exitcode)
+      for entry in journal.entries():
+        request_id = entry.get('request_id', None)
+        try:
+          slots = entry.get('slots', {})
+          if self.tenant_counters is not None and 'tenant' in slots:
+            self.tenant_counters.release(slots['tenant'])
+          if self.location_counters is not None and slots.get('location', None) is not None:
+            self.location_counters.release(slots['location'])
+          if entry.get('committed', False):
+            logger.warning('Ansible worker process {0} exited ({1}) before finishing request {2}, failing it'.format(worker.name, reason, request_id))
+            metrics.worker_requests_recovered.labels('failed').inc()
+            self.messaging_service.send_lifecycle_execution(LifecycleExecution(request_id, STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR,
+              "Driver worker exited ({0}) before the request finished".format(reason)), {}), tenant_id=entry.get('tenant_id', None))
+          else:
+            logger.warning('Ansible worker process {0} exited ({1}) before finishing request {2}, it will be redelivered'.format(worker.name, reason, request_id))
+            metrics.worker_requests_recovered.labels('redelivered').inc()
+        except Exception as e:
+          logger.exception('Unable to recover request {0} of Ansible worker process {1}: {2}'.format(request_id, worker.name, e))
+        finally:
+          if entry.get('driver_files', None) is not None and not entry.get('keep_files', False):
+            shutil.rmtree(entry['driver_files'], ignore_errors=True)
+      journal.close()
+
+    def supervise_workers(self):
+      """
+      Called periodically by the worker supervisor, replaces workers that have died
+      """
+      if not self.active or self.shutdown_event.is_set():
+        return
+      with self.pool_lock:
+        for worker in self.active_workers():
+          if worker.is_alive():
+            continue
+          reason = exit_reason(worker.exitcode)
+          logger.error('Ansible worker process {0} (pid {1}) died unexpectedly ({2}){3}'.format(worker.name, worker.pid, reason,
+            ', it may have run out of memory' if reason == 'SIGKILL' else ''))
+          metrics.process_pool_workers_died.labels(reason).inc()
+          self.remove_worker(worker)
+          self.update_pool_metrics()
+          if self.process_properties.worker_restart_enabled:
+            delay = self.restart_backoff.next_delay()
+            if delay > 0:
+              logger.info('Restarting Ansible worker process {0} in {1:.0f}s'.format(worker.name, delay))
+            self.pending_restarts.append(time.monotonic() + delay)
+        now = time.monotonic()
+        due = [restart_at for restart_at in self.pending_restarts if restart_at <= now]
+        self.pending_restarts = [restart_at for restart_at in self.pending_restarts if restart_at > now]
+        for restart_at in due:
+          metrics.process_pool_workers_restarted.inc()
+          self.spawn_worker()
+
+    def maintain_pool(self):
+      """
+      Called periodically by the pool monitor
+      """
+      if not self.active:
+        return
+      self.reap_retired_workers()
+      metrics.archive_exited_processes()
+      self.recycle_workers()
+      if self.process_properties.autoscale_enabled:
+        self.scale_pool()
+
+    def recycle_workers(self):
+      max_requests = self.process_properties.worker_max_requests
+      max_rss_bytes = self.process_properties.worker_max_rss_mb * 1024 * 1024
+      if max_requests <= 0 and max_rss_bytes <= 0:
+        return
+      with self.pool_lock:
+        for worker in self.active_workers():
+          reason = worker.worker_state.recycle_reason(max_requests, max_rss_bytes)
+          if reason is None:
+            continue
+          logger.info('Recycling Ansible worker process {0} after {1} requests with {2:.1f}MB resident ({3} limit reached)'.format(
+            worker.name, worker.worker_state.requests_handled.value, worker.worker_state.rss_bytes.value / (1024 * 1024), reason))
+          # the replacement is started first, so the pool keeps its capacity while the worker finishes its requests
+          self.spawn_worker()
+          self.retire_worker(worker)
+          metrics.process_pool_workers_recycled.labels(reason).inc()
+
+    def scale_pool(self):
+      with self.pool_lock:
+        workers = self.active_workers()
+        pool_size = len(workers)
+        queue_lag = sum(worker.worker_state.queue_lag.value for worker in workers)
+        if queue_lag >= self.process_properties.scale_up_queue_lag and pool_size < self.process_properties.max_process_pool_size:
+          logger.info('Lifecycle request queue lag is {0}, adding a worker to the pool of {1}'.format(queue_lag, pool_size))
+          self.spawn_worker()
+        elif pool_size > self.process_properties.min_process_pool_size:
+          now = time.time()
+          idle_workers = [worker for worker in workers if worker.worker_state.idle_seconds(now) >= self.process_properties.worker_idle_seconds]
+          if len(idle_workers) > 0:
+            # retire one worker at a time, the longest idle first
+            idle_workers.sort(key=lambda worker: worker.worker_state.last_active.value)
+            self.retire_worker(idle_workers[0])
 
     def sigint_handler(self, sig, frame):
       logger.debug('sigint_handler')
@@ -87,22 +355,166 @@ class AnsibleProcessorService(Service, AnsibleProcessorCapability):
         self.shutdown_event.set()
         if self.process_properties.use_process_pool:
           logger.debug("Terminating Ansible processes")
-          for p in self.pool:
+          with self.pool_lock:
+            workers = list(self.pool)
+          for p in workers:
             if p is not None and p.is_alive():
               logger.debug("Terminating Ansible Driver process {0}".format(p.name))
               p.join()
+            if p is not None:
+              # requests of workers that did not stop cleanly
+              self.recover_requests(p)
+
+
+class AnsiblePoolMonitor(threading.Thread):
+    """
+    Periodically calls a method of the processor service maintaining its pool of Ansible processes (scaling it, or
+    replacing workers that have died)
+    """
+    def __init__(self, maintain, interval_seconds, shutdown_event, name='AnsiblePoolMonitor'):
+      super(AnsiblePoolMonitor, self).__init__(name=name, daemon=True)
+      self.maintain = maintain
+      self.interval_seconds = interval_seconds
+      self.shutdown_event = shutdown_event
+
+    def run(self):
+      while not self.shutdown_event.wait(self.interval_seconds):
+        try:
+          self.maintain()
+        except Exception as e:
+          logger.exception('Unexpected exception maintaining the Ansible process pool: {0}'.format(e))
 
 
 ## Ansible Process Pools
 
+class WorkerState():
+    """
+    State of an Ansible worker process, shared between the worker and the parent process
+    """
+    def __init__(self):
+      # number of requests the worker is currently handling
+      self.active_requests = RawValue('i', 0)
+      self.last_active = RawValue('d', time.time())
+      # number of requests waiting on the request queue partitions assigned to the worker
+      self.queue_lag = RawValue('l', 0)
+      # number of requests waiting to be retried by the worker
+      self.parked_retries = RawValue('i', 0)
+      # number of requests read by the worker, waiting to be scheduled
+      self.scheduled_requests = RawValue('i', 0)
+      # number of requests the worker has handled, and its resident memory (in bytes) when it last measured it
+      self.requests_handled = RawValue('l', 0)
+      self.rss_bytes = RawValue('l', 0)
+      self.retire_event = multiprocessing.Event()
+      # guards updates made by the request handling threads of the worker
+      self.lock = threading.Lock()
+
+    def request_started(self):
+      with self.lock:
+        self.active_requests.value += 1
+      metrics.process_pool_active_requests.inc()
+
+    def request_finished(self):
+      with self.lock:
+        self.active_requests.value -= 1
+        self.requests_handled.value += 1
+        self.last_active.value = time.time()
+      metrics.process_pool_active_requests.dec()
+
+    def idle_seconds(self, now):
+      if self.active_requests.value > 0 or self.parked_retries.value > 0 or self.scheduled_requests.value > 0:
+        return 0
+      return now - self.last_active.value
+
+    def recycle_reason(self, max_requests, max_rss_bytes):
+      """
+      Returns the limit (requests or rss) the worker has reached, None if it has not reached either
+      """
+      if max_requests > 0 and self.requests_handled.value >= max_requests:
+        return 'requests'
+      if max_rss_bytes > 0 and self.rss_bytes.value >= max_rss_bytes:
+        return 'rss'
+      return None
+
+
+def process_rss_bytes(pid='self'):
+    """
+    Returns the resident memory of a process in bytes, 0 if it can't be read
+    """
+    try:
+      with open('/proc/{0}/statm'.format(pid), 'r') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+      return 0
+
+
+def get_queue_lag(request_queue):
+    """
+    Returns the number of requests waiting on the partitions assigned to the request queue's Kafka consumer
+    """
+    consumer = getattr(request_queue, 'requests_consumer', None)
+    if consumer is None:
+      return 0
+    lag = 0
+    try:
+      for topic_partition in consumer.assignment():
+        highwater = consumer.highwater(topic_partition)
+        if highwater is not None:
+          lag += max(0, highwater - consumer.position(topic_partition))
+    except Exception as e:
+      logger.debug('Unable to determine request queue lag: {0}'.format(e))
+    return lag
+
+
+class QueueTimingConsumer():
+    """
+    Wraps the Kafka consumer of a request queue to note when the last request it returned was put on the queue (from
+    the timestamp of the Kafka record)
+    """
+    def __init__(self, consumer):
+      self.consumer = consumer
+      self.queued_at = None
+
+    def poll(self, *args, **kwargs):
+      records = self.consumer.poll(*args, **kwargs)
+      for messages in records.values():
+        if len(messages) > 0:
+          timestamp = getattr(messages[0], 'timestamp', None)
+          self.queued_at = timestamp / 1000 if isinstance(timestamp, (int, float)) and timestamp > 0 else None
+      return records
+
+    def take_queued_at(self):
+      queued_at, self.queued_at = self.queued_at, None
+      return queued_at
+
+    def __getattr__(self, name):
+      return getattr(self.consumer, name)
+
+
+def time_request_queue(request_queue):
+    """
+    Wraps the Kafka consumer of the request queue in a QueueTimingConsumer, which is returned (None if the request
+    queue has no Kafka consumer)
+    """
+    consumer = getattr(request_queue, 'requests_consumer', None)
+    if consumer is None:
+      return None
+    if not isinstance(consumer, QueueTimingConsumer):
+      consumer = QueueTimingConsumer(consumer)
+      request_queue.requests_consumer = consumer
+    return consumer
+
+
 class AnsibleProcess(Process):
 
-    def __init__(self, name, request_queue, sigchld_handler, shutdown_event):
+    def __init__(self, name, request_queue, sigchld_handler, shutdown_event, worker_state=None, request_handler=None):
       super(AnsibleProcess, self).__init__(daemon=False)
       self.name = name
       self.request_queue = request_queue
       self.sigchld_handler = sigchld_handler
       self.shutdown_event = shutdown_event
+      self.worker_state = worker_state if worker_state is not None else WorkerState()
+      self.request_handler = request_handler
+      self.rss_updated = 0
 
       logger.info('Created worker process: {0} {1}'.format(name, self.request_queue))
 
@@ -119,25 +531,279 @@ class AnsibleProcess(Process):
           # make sure Ansible processes are acknowledged to avoid zombie processes
           signal(SIGCHLD, self.sigchld_handler)
 
+        if self.request_handler is not None:
+          self.request_handler.worker_started()
         logger.info('Initialised ansible worker process {0} {1}'.format(self.name, self.request_queue))
         # continually read from the request queue and process Ansible lifecycle requests
-        while not self.shutdown_event.is_set(): 
-          # note: process_request handles all exceptions
-          self.request_queue.process_request()
+        while not self.shutdown_event.is_set() and not self.retired():
+          retiring = self.worker_state.retire_event.is_set()
+          if self.request_handler is not None:
+            self.request_handler.run_due_retries()
+            self.request_handler.fail_expired_requests()
+          read = False
+          if not retiring and (self.request_handler is None or self.request_handler.accepting_requests()):
+            read = self.read_request()
+          # with a scheduler, requests are read ahead while there are more to read, then run in the order it chooses
+          if self.request_handler is not None and not read:
+            if self.request_handler.dispatch() == 0 and (retiring or not self.request_handler.accepting_requests()):
+              # nothing can run yet (all slots in use, or all tenants at their cap) and no more requests can be read
+              self.shutdown_event.wait(0.1)
+          if not retiring:
+            self.worker_state.queue_lag.value = get_queue_lag(self.request_queue)
+          self.update_rss()
       finally:
+        if self.request_handler is not None:
+          # let requests still in progress finish
+          self.request_handler.close()
         self.request_queue.close()
 
+    def retired(self):
+      """
+      A retired worker stops reading requests, then exits once it has no requests in progress, queued by its scheduler
+      or waiting to be retried
+      """
+      if not self.worker_state.retire_event.is_set():
+        return False
+      return self.request_handler is None or self.request_handler.pending_requests() == 0
+
+    def update_rss(self):
+      now = time.monotonic()
+      if now - self.rss_updated < RSS_UPDATE_SECONDS:
+        return
+      self.rss_updated = now
+      rss = process_rss_bytes()
+      self.worker_state.rss_bytes.value = rss
+      metrics.worker_rss_bytes.labels(self.name).set(rss)
+
+    def read_request(self):
+      """
+      Reads (and handles) the next request from the request queue, if there is one. Returns True if a request was read
+      """
+      received = self.request_handler.requests_received if self.request_handler is not None else 0
+      # note: process_request handles all exceptions
+      self.request_queue.process_request()
+      read = self.request_handler is not None and self.request_handler.requests_received > received
+      if read:
+        # process_request commits the request once handle_request returns
+        self.request_handler.requests_committed()
+      return read
+
 
 """
 Handler for Ansible driver request queue messages/requests.
 """
 class AnsibleRequestHandler(RequestHandler):
-    def __init__(self, messaging_service, ansible_client):
+    def __init__(self, messaging_service, ansible_client, worker_state=None, retry_budget=None, scheduler=None):
       super(AnsibleRequestHandler, self).__init__()
       self.messaging_service = messaging_service
       self.ansible_client = ansible_client
+      self.worker_state = worker_state
+      # set when the worker's request queue can tell when each request was queued
+      self.queue_timing = None
+      self.retry_budget = retry_budget if retry_budget is not None else RetryBudget(0, 0)
+      # requests waiting to be retried
+      self.parked_retries = DelayedRetryQueue()
+      # when set, requests are run in the order chosen by the scheduler (see dispatch) rather than as they are read
+      self.scheduler = scheduler
+      self.requests_received = 0
+      # set by the processor service, records the requests accepted by the worker until they are finished
+      self.journal = None
+
+    def run_request(self, request):
+      return self.ansible_client.run_lifecycle_playbook(request)
+
+    def worker_started(self):
+      self.ansible_client.worker_started()
+
+    def close(self):
+      self.fail_parked_retries()
+      self.fail_scheduled_requests()
+      self.ansible_client.close()
+
+    def accepting_requests(self):
+      return self.scheduler is None or not self.scheduler.full()
+
+    def pending_requests(self):
+      """
+      Returns the number of requests the worker has read but not finished: in progress, queued by the scheduler or
+      waiting to be retried
+      """
+      pending = len(self.parked_retries)
+      if self.scheduler is not None:
+        pending += len(self.scheduler)
+      if self.worker_state is not None:
+        pending += self.worker_state.active_requests.value
+      return pending
+
+    def schedule(self, request):
+      self.scheduler.add(request)
+      self.__scheduled_requests_changed(1)
+
+    def __scheduled_requests_changed(self, change):
+      if self.worker_state is not None:
+        self.worker_state.scheduled_requests.value = len(self.scheduler)
+      metrics.scheduled_requests.inc(change)
+
+    def next_scheduled_request(self):
+      request = self.scheduler.next_request()
+      if request is not None:
+        self.__scheduled_requests_changed(-1)
+        if self.journal is not None:
+          self.journal.hold_slots(request, self.scheduler.held_slots(request))
+      return request
+
+    def scheduled_request_finished(self, request):
+      if self.journal is not None:
+        self.journal.hold_slots(request, None)
+      self.scheduler.request_finished(request)
+
+    def requests_committed(self):
+      """
+      Called by the worker once the request queue has committed the requests read so far
+      """
+      if self.journal is not None:
+        self.journal.commit()
+
+    def request_done(self, request):
+      """
+      Called once the final result of a request has been sent (or it has been failed)
+      """
+      if self.journal is not None and request is not None:
+        self.journal.remove(request)
+
+    def dispatch(self):
+      """
+      Called by the worker when it has no more requests to read (or can't read any more), runs the next scheduled
+      request. Returns the number of requests started
+      """
+      if self.scheduler is None:
+        return 0
+      request = self.next_scheduled_request()
+      if request is None:
+        return 0
+      try:
+        self._handle_request(request)
+      finally:
+        self.scheduled_request_finished(request)
+      return 1
+
+    def fail_scheduled_requests(self):
+      """
+      Called when the worker stops, the requests it has read but not run fail
+      """
+      if self.scheduler is None:
+        return
+      requests = self.scheduler.take_all()
+      for request in requests:
+        logger.warning('Worker stopping, request {0} will not be run'.format(request.get('request_id')))
+      self.__fail_scheduled(requests, "Driver worker stopped before the request was run")
+
+    def fail_expired_requests(self):
+      """
+      Called by the worker between reads of the request queue, fails the scheduled requests that have waited too long
+      to run (their tenant or deployment location at its limit)
+      """
+      if self.scheduler is None:
+        return
+      requests = self.scheduler.take_expired()
+      for request in requests:
+        logger.warning('Request {0} waited more than {1}s to run and will not be run'.format(request.get('request_id'), self.scheduler.max_wait_seconds))
+        metrics.scheduled_requests_expired.labels(request.get('lifecycle_name', None)).inc()
+      self.__fail_scheduled(requests, "Request waited too long to be run by the driver")
+
+    def __fail_scheduled(self, requests, description):
+      if len(requests) > 0:
+        self.__scheduled_requests_changed(-len(requests))
+      for request in requests:
+        try:
+          self.messaging_service.send_lifecycle_execution(LifecycleExecution(request['request_id'], STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR, description), {}), tenant_id=request['tenant_id'])
+        finally:
+          self.ansible_client.remove_driver_files(request)
+          self.request_done(request)
+
+    def park_retry(self, request, retry):
+      """
+      Parks a request to be run again once the delay of the retry has passed, so the worker is free to handle other
+      requests in the meantime. Returns False if the worker's retry budget does not allow another retry
+      """
+      lifecycle = request.get('lifecycle_name', None)
+      if not self.retry_budget.try_acquire():
+        logger.warning('Unreachable retry budget of the worker exhausted, request {0} will not be retried'.format(request.get('request_id')))
+        metrics.unreachable_retries_rejected.labels(lifecycle).inc()
+        return False
+      request[UNREACHABLE_RETRY_STATE] = retry.retry_state()
+      self.parked_retries.put(request, retry.result, retry.delay_seconds)
+      self.__parked_retries_changed(1)
+      metrics.unreachable_retries.labels(lifecycle).inc()
+      logger.info('Request {0} found a host unreachable on attempt {1}, retrying in {2:.1f}s'.format(request.get('request_id'), retry.attempt, retry.delay_seconds))
+      return True
+
+    def __parked_retries_changed(self, change):
+      if self.worker_state is not None:
+        self.worker_state.parked_retries.value = len(self.parked_retries)
+      metrics.parked_retries.inc(change)
+
+    def run_due_retries(self):
+      """
+      Called by the worker between reads of the request queue, runs the parked requests that are due a retry
+      """
+      due = self.parked_retries.take_due()
+      if len(due) > 0:
+        self.__parked_retries_changed(-len(due))
+      for request, result in due:
+        self.retry_request(request)
+
+    def retry_request(self, request):
+      if self.scheduler is not None:
+        self.schedule(request)
+      else:
+        self._handle_request(request)
+
+    def fail_parked_retries(self):
+      """
+      Called when the worker stops, the requests still waiting to be retried fail with the result of their last attempt
+      """
+      parked = self.parked_retries.take_all()
+      if len(parked) > 0:
+        self.__parked_retries_changed(-len(parked))
+      for request, result in parked:
+        logger.warning('Worker stopping, request {0} will not be retried'.format(request.get('request_id')))
+        try:
+          self.messaging_service.send_lifecycle_execution(result, tenant_id=request['tenant_id'])
+        finally:
+          self.ansible_client.remove_driver_files(request)
+          self.request_done(request)
+
+    def observe_queue_wait(self, request):
+      """
+      Records the time the request waited on the request queue. Called by the thread reading the request queue, as
+      soon as it has read the request
+      """
+      if self.queue_timing is None or request is None:
+        return
+      queued_at = self.queue_timing.take_queued_at()
+      if queued_at is not None:
+        metrics.request_queue_wait_seconds.labels(request.get('lifecycle_name', None)).observe(max(0, time.time() - queued_at))
 
     def handle_request(self, request):
+      self.requests_received += 1
+      if self.journal is not None and request is not None:
+        self.journal.add(request)
+      if self.scheduler is not None:
+        self.observe_queue_wait(request)
+        self.schedule(request)
+      else:
+        self.start_request(request)
+
+    def start_request(self, request):
+      self.observe_queue_wait(request)
+      self._handle_request(request)
+
+    def _handle_request(self, request):
+      if self.worker_state is not None:
+        self.worker_state.request_started()
+      started = time.monotonic()
+      status = None
       try:
         if request is not None:
           if request.get('logging_context', None) is not None:
@@ -152,9 +818,20 @@ class AnsibleRequestHandler(RequestHandler):
  
           # run the playbook and send the response to the response queue
           logger.debug('Ansible worker running request with request id {0}'.format(request.get('request_id')))
-          result = self.ansible_client.run_lifecycle_playbook(request)
+          result = self.run_request(request)
+          if isinstance(result, UnreachableRetry):
+            if self.park_retry(request, result):
+              status = STATUS_RETRYING
+              return
+            # the failure of the last attempt stands
+            self.ansible_client.remove_driver_files(request)
+            result = result.result
           if result is not None:
+            status = result.status
             logger.debug('Ansible worker finished with result {0}'.format(result))
+            slowest_tasks = getattr(result, 'slowest_tasks', None)
+            if slowest_tasks:
+              logger.info('Slowest tasks of request {0}: {1}'.format(request.get('request_id'), ', '.join('{0} ({1}s)'.format(task['taskName'], task['durationSeconds']) for task in slowest_tasks)))
             self.messaging_service.send_lifecycle_execution(result, tenant_id=request['tenant_id'])
           else:
             logger.warning("Empty response from Ansible worker for request with request id {0}".format(request.get('request_id')))
@@ -165,10 +842,110 @@ class AnsibleRequestHandler(RequestHandler):
         traceback.print_exc(file=sys.stderr)
         # don't want the worker to die without knowing the cause, so catch all exceptions
         if request is not None:
+          status = STATUS_FAILED
           self.messaging_service.send_lifecycle_execution(LifecycleExecution(request['request_id'], STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR, "Unexpected exception: {0}".format(e)), {}), tenant_id=request['tenant_id'])
       finally:
+        if self.worker_state is not None:
+          self.worker_state.request_finished()
+        if request is not None:
+          if status != STATUS_RETRYING:
+            self.request_done(request)
+          lifecycle = request.get('lifecycle_name', None)
+          metrics.requests_handled.labels(lifecycle, status).inc()
+          metrics.request_duration_seconds.labels(lifecycle).observe(time.monotonic() - started)
         # clean up zombie processes (Ansible can leave these behind)
         for p in active_children():
           logger.debug("removed zombie process {0}".format(p.name))
 
 
+"""
+Handler that handles several requests at the same time. Each request is handled by its own thread, which runs the
+playbook in a dedicated child process, so that a worker's concurrency scales with time spent waiting on I/O rather
+than with the number of worker processes.
+"""
+class ConcurrentAnsibleRequestHandler(AnsibleRequestHandler):
+    def __init__(self, messaging_service, ansible_client, max_concurrent_requests, worker_state=None, retry_budget=None, scheduler=None):
+      super(ConcurrentAnsibleRequestHandler, self).__init__(messaging_service, ansible_client, worker_state=worker_state, retry_budget=retry_budget, scheduler=scheduler)
+      if max_concurrent_requests < 1:
+        raise ValueError('max_concurrent_requests must be at least 1')
+      self.max_concurrent_requests = max_concurrent_requests
+      self.request_slots = threading.BoundedSemaphore(max_concurrent_requests)
+      self.request_threads = []
+
+    def start_request(self, request):
+      # blocks the worker from reading further requests while all slots are in use
+      self.request_slots.acquire()
+      self.observe_queue_wait(request)
+      self.__start_request_thread(request)
+
+    def retry_request(self, request):
+      if self.scheduler is not None:
+        self.schedule(request)
+        return
+      self.request_slots.acquire()
+      self.__start_request_thread(request)
+
+    def dispatch(self):
+      """
+      Starts scheduled requests while there are free slots, returns the number of requests started
+      """
+      if self.scheduler is None:
+        return 0
+      started = 0
+      while self.request_slots.acquire(blocking=False):
+        request = self.next_scheduled_request()
+        if request is None:
+          self.request_slots.release()
+          break
+        self.__start_request_thread(request, scheduled=True)
+        started += 1
+      return started
+
+    def __start_request_thread(self, request, scheduled=False):
+      self.request_threads = [thread for thread in self.request_threads if thread.is_alive()]
+      thread = threading.Thread(target=self._handle_request_in_thread, args=(request, scheduled), daemon=True)
+      self.request_threads.append(thread)
+      thread.start()
+
+    def _handle_request_in_thread(self, request, scheduled=False):
+      try:
+        self._handle_request(request)
+      finally:
+        if scheduled:
+          self.scheduled_request_finished(request)
+        self.request_slots.release()
+
+    def run_request(self, request):
+      receiver, sender = Pipe(False)
+      playbook_process = Process(target=self._run_request_in_child, args=(request, sender), daemon=False)
+      playbook_process.start()
+      # close the write end of the pipe in this process, so a dead child is seen as EOF
+      sender.close()
+      try:
+        result = receiver.recv()
+      except EOFError:
+        result = None
+      finally:
+        receiver.close()
+        playbook_process.join()
+        metrics.process_exited(playbook_process.pid)
+        self.ansible_client.playbook_process_exited()
+      if result is None:
+        return LifecycleExecution(request['request_id'], STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR, "Playbook process exited unexpectedly with exit code {0}".format(playbook_process.exitcode)), {})
+      return result
+
+    def _run_request_in_child(self, request, sender):
+      try:
+        try:
+          sender.send(self.ansible_client.run_lifecycle_playbook(request))
+        except Exception as e:
+          # the request fails with the error, rather than as a playbook process that exited unexpectedly
+          logger.exception('Playbook process of request {0} failed: {1}'.format(request.get('request_id'), e))
+          sender.send(LifecycleExecution(request['request_id'], STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR, str(e)), {}))
+      finally:
+        sender.close()
+
+    def close(self):
+      for thread in self.request_threads:
+        thread.join()
+      super(ConcurrentAnsibleRequestHandler, self).close()
@@ -1,10 +1,221 @@
-from ignition.service.progress_events import YAMLProgressEventLogSerializer
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from ignition.service.config import ConfigurationPropertiesGroup
+from ignition.service.logging import logging_context
+from ignition.service.progress_events import YAMLProgressEventLogSerializer, ProgressEventLogWriterService
+from ignition.model.progress_events import ResourceTransitionProgressEvent
 from ansible.parsing.yaml.dumper import AnsibleDumper
+from ansibledriver.service import metrics
 import yaml
 
+logger = logging.getLogger(__name__)
+# events are written with the logger of the standard writer, so they are logged exactly as they would be without buffering
+events_logger = logging.getLogger(ProgressEventLogWriterService.__module__)
+
+# what happens to a new event when the buffer is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+SAMPLE = 'sample'
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, SAMPLE)
+
+# how progress events are serialized
+YAML = 'yaml'
+YAML_C = 'yaml_c'
+JSON = 'json'
+SERIALIZER_FORMATS = (YAML, YAML_C, JSON)
+
+
+class ProgressEventLogProperties(ConfigurationPropertiesGroup):
+    def __init__(self):
+        super().__init__('progress_event_log')
+        # write progress events from a background thread, so playbooks do not wait on serializing and logging them
+        self.buffer_enabled = False
+        # maximum number of events waiting to be written
+        self.buffer_size = 1000
+        # events are written in batches of up to batch_size, at least every flush_interval_seconds
+        self.batch_size = 50
+        self.flush_interval_seconds = 0.5
+        # block: wait for space in the buffer, drop_oldest: discard the oldest buffered event,
+        # sample: keep 1 in every sample_rate events (replacing the oldest buffered event), discard the rest
+        self.overflow_policy = BLOCK
+        self.sample_rate = 10
+        # yaml: pure Python YAML dumper, yaml_c: the same YAML output from the (much faster) libyaml emitter,
+        # json: compact JSON
+        self.serializer_format = YAML
+
+
+if hasattr(yaml, 'CSafeDumper'):
+    class AnsibleCDumper(yaml.CSafeDumper):
+        """
+        libyaml based dumper with the representations the Ansible dumper has for Ansible types, such as AnsibleUnicode
+        """
+        yaml_representers = dict(AnsibleDumper.yaml_representers)
+        yaml_multi_representers = dict(AnsibleDumper.yaml_multi_representers)
+else:
+    # PyYAML built without libyaml
+    AnsibleCDumper = None
+
+
+def _json_default(value):
+    # Ansible's str, list and dict subclasses (AnsibleUnicode, AnsibleSequence etc.) are serialized natively,
+    # anything else is converted to its closest JSON type
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if hasattr(value, 'keys') and hasattr(value, '__getitem__'):
+        return {key: value[key] for key in value.keys()}
+    return str(value)
+
+
 class AnsibleYAMLProgressEventLogSerializer(YAMLProgressEventLogSerializer):
 
+    def __init__(self, configuration=None):
+        super().__init__()
+        serializer_format = YAML
+        if configuration is not None:
+            serializer_format = configuration.property_groups.get_property_group(ProgressEventLogProperties).serializer_format
+        if serializer_format not in SERIALIZER_FORMATS:
+            raise ValueError('Invalid progress event serializer_format {0}, expected one of {1}'.format(serializer_format, SERIALIZER_FORMATS))
+        if serializer_format == YAML_C and AnsibleCDumper is None:
+            logger.warning('libyaml is not available, progress events will be serialized with the pure Python YAML dumper')
+            serializer_format = YAML
+        self.serializer_format = serializer_format
+
     def serialize(self, event):
         data = event.to_dict()
+        if self.serializer_format == JSON:
+            return json.dumps(data, default=_json_default, ensure_ascii=False, separators=(',', ':'))
         # Use the Ansible dumper as it has extra representations for Ansible types, such as AnsibleUnicode
-        return yaml.dump(data, Dumper=AnsibleDumper, allow_unicode=True)
+        dumper = AnsibleCDumper if self.serializer_format == YAML_C else AnsibleDumper
+        return yaml.dump(data, Dumper=dumper, allow_unicode=True)
+
+
+class BufferedProgressEventLogWriter(ProgressEventLogWriterService):
+    """
+    Progress event writer that, when buffering is enabled, queues events in memory and writes them in batches from a
+    background thread. Each event is written with the logging context of the thread that added it
+    """
+    def __init__(self, configuration, serializer_service):
+        super().__init__(serializer_service)
+        self.properties = configuration.property_groups.get_property_group(ProgressEventLogProperties)
+        if self.properties.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid progress event overflow_policy {0}, expected one of {1}'.format(self.properties.overflow_policy, OVERFLOW_POLICIES))
+        self.__reset()
+
+    def __reset(self):
+        # the buffer, its condition and the flusher thread belong to a single process; a forked worker starts its own,
+        # as a thread of the parent may have held the condition when it forked
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        self.events = deque()
+        self.added = 0
+        self.written = 0
+        self.overflowed = 0
+        self.dropped = 0
+        self.flush_requested = False
+        self.flusher = None
+
+    def add(self, event):
+        if not self.properties.buffer_enabled:
+            added = time.monotonic()
+            super().add(event)
+            metrics.progress_event_write_seconds.observe(time.monotonic() - added)
+            return
+        if not isinstance(event, ResourceTransitionProgressEvent):
+            raise ValueError('Cannot add event of type "{0}" because it must be a subtype of "{1}"'.format(event.__class__.__name__, ResourceTransitionProgressEvent.__name__))
+        # checked before taking the condition, which may be one inherited from the parent
+        if self.pid != os.getpid():
+            self.__reset()
+        with self.condition:
+            self.__ensure_flusher()
+            self.added += 1
+            if len(self.events) >= self.properties.buffer_size and not self.__make_room():
+                self.__drop()
+                return
+            self.events.append((event, logging_context.get_all(), time.monotonic()))
+            if len(self.events) >= self.properties.batch_size:
+                self.condition.notify_all()
+
+    def __ensure_flusher(self):
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.__run_flusher, name='ProgressEventLogFlusher', daemon=True)
+            self.flusher.start()
+
+    def __make_room(self):
+        """
+        Applies the overflow policy when the buffer is full. Returns False if the new event should be discarded
+        """
+        policy = self.properties.overflow_policy
+        if policy == BLOCK:
+            self.condition.notify_all()
+            while len(self.events) >= self.properties.buffer_size:
+                self.condition.wait()
+            return True
+        if policy == SAMPLE:
+            self.overflowed += 1
+            if self.overflowed % max(self.properties.sample_rate, 1) != 0:
+                return False
+        self.events.popleft()
+        self.__drop()
+        return True
+
+    def __drop(self):
+        self.dropped += 1
+        self.written += 1
+        metrics.progress_events_dropped.inc()
+
+    def __run_flusher(self):
+        while True:
+            with self.condition:
+                if len(self.events) < self.properties.batch_size and not self.flush_requested:
+                    self.condition.wait(self.properties.flush_interval_seconds)
+                self.flush_requested = False
+                batch = [self.events.popleft() for i in range(min(len(self.events), self.properties.batch_size))]
+                dropped, self.dropped = self.dropped, 0
+                # wake any writer blocked on a full buffer
+                self.condition.notify_all()
+            if dropped > 0:
+                logger.warning('Dropped {0} progress event(s) because the event buffer was full'.format(dropped))
+            for event, context, added in batch:
+                self.__write(event, context)
+                metrics.progress_event_write_seconds.observe(time.monotonic() - added)
+            if len(batch) > 0:
+                with self.condition:
+                    self.written += len(batch)
+                    self.condition.notify_all()
+
+    def __write(self, event, context):
+        logging_context.clear()
+        logging_context.set_from_dict(context)
+        try:
+            events_logger.info(self.to_loggable(event))
+        except Exception as e:
+            logger.exception('Failed to write progress event: {0}'.format(str(e)))
+        finally:
+            logging_context.clear()
+
+    def flush(self, timeout=None):
+        """
+        Waits until every event added before this call has been written (or dropped). Returns False on timeout
+        """
+        if self.pid != os.getpid():
+            # nothing has been added in this process
+            return True
+        with self.condition:
+            if self.flusher is None:
+                return True
+            target = self.added
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self.written < target:
+                self.flush_requested = True
+                self.condition.notify_all()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
@@ -0,0 +1,145 @@
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# key of the request holding the state of its unreachable retries, set on a request when it is retried
+UNREACHABLE_RETRY_STATE = 'unreachable_retry'
+
+
+class UnreachableRetry():
+    """
+    Returned by AnsibleClient.run_lifecycle_playbook, in place of a LifecycleExecution, when a host was unreachable
+    and the request should be run again in delay_seconds. The driver files of the request are kept for the retry.
+
+    result is the (failed) LifecycleExecution of the attempt, which stands if the request is not retried after all.
+    resume is where the retry resumes the playbook from (see ResultCallback.resume_point), None to run it all again
+    """
+    def __init__(self, result, attempt, first_attempt_at, delay_seconds, resume=None):
+        self.result = result
+        self.attempt = attempt
+        self.first_attempt_at = first_attempt_at
+        self.delay_seconds = delay_seconds
+        self.resume = resume
+
+    def retry_state(self):
+        return {'attempt': self.attempt, 'first_attempt_at': self.first_attempt_at, 'resume': self.resume}
+
+    def __str__(self):
+        return 'UnreachableRetry(attempt={0}, delay_seconds={1:.1f})'.format(self.attempt, self.delay_seconds)
+
+
+class UnreachableRetryPolicy():
+    """
+    Decides if, and when, a request is retried after a host was unreachable: exponential backoff from
+    unreachable_sleep_seconds, with jitter, up to max_unreachable_retries attempts within
+    unreachable_retry_deadline_seconds of the first attempt
+    """
+    def __init__(self, ansible_properties, random=random.random, clock=time.time):
+        self.base_seconds = ansible_properties.unreachable_sleep_seconds
+        self.multiplier = ansible_properties.unreachable_backoff_multiplier
+        self.max_seconds = ansible_properties.unreachable_max_sleep_seconds
+        self.jitter = min(1, max(0, ansible_properties.unreachable_jitter))
+        self.max_attempts = ansible_properties.max_unreachable_retries
+        self.deadline_seconds = ansible_properties.unreachable_retry_deadline_seconds
+        self.random = random
+        self.clock = clock
+
+    def backoff(self, attempt):
+        """
+        Returns the time between the start of the given (failed) attempt and the next one
+        """
+        if self.base_seconds <= 0:
+            return 0
+        delay = self.base_seconds * (self.multiplier ** (attempt - 1))
+        if self.max_seconds > 0:
+            delay = min(delay, self.max_seconds)
+        # take off up to jitter of the delay, so that requests failing together don't retry together
+        return delay * (1 - self.jitter * self.random())
+
+    def next_delay(self, attempt, first_attempt_at, attempt_started_at):
+        """
+        Returns the number of seconds to wait before retrying a request whose attempt (numbered from 1) found a host
+        unreachable, or None if the request should not be retried
+        """
+        if attempt >= self.max_attempts:
+            logger.debug('Unreachable retries exhausted after {0} attempts'.format(attempt))
+            return None
+        now = self.clock()
+        # the time the attempt took counts towards the delay
+        delay = max(0, attempt_started_at + self.backoff(attempt) - now)
+        if self.deadline_seconds > 0 and now + delay > first_attempt_at + self.deadline_seconds:
+            logger.debug('Unreachable retry deadline of {0}s reached after {1} attempts'.format(self.deadline_seconds, attempt))
+            return None
+        return delay
+
+
+class RetryBudget():
+    """
+    Limits the retries of all requests handled by a worker to max_retries in any window_seconds (0 is no limit), so
+    that a widespread outage can't keep a worker busy retrying
+    """
+    def __init__(self, max_retries, window_seconds, clock=time.monotonic):
+        self.max_retries = max_retries
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self.retries = deque()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Returns True, and counts a retry, if the budget allows another retry
+        """
+        if self.max_retries <= 0:
+            return True
+        with self.lock:
+            now = self.clock()
+            while len(self.retries) > 0 and self.retries[0] <= now - self.window_seconds:
+                self.retries.popleft()
+            if len(self.retries) >= self.max_retries:
+                return False
+            self.retries.append(now)
+            return True
+
+
+class DelayedRetryQueue():
+    """
+    Requests parked until they are due a retry, indexed by due time (a heap). Each entry holds the request and the
+    (failed) result of its last attempt. Safe to use from the request handling threads of a worker
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        # breaks ties between requests due at the same time, so requests themselves are never compared
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def put(self, request, result, delay_seconds):
+        with self.lock:
+            heapq.heappush(self.heap, (self.clock() + delay_seconds, next(self.sequence), request, result))
+
+    def take_due(self):
+        """
+        Removes and returns the (request, result) of each entry that is due, earliest first
+        """
+        now = self.clock()
+        due = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                due_at, sequence, request, result = heapq.heappop(self.heap)
+                due.append((request, result))
+        return due
+
+    def take_all(self):
+        with self.lock:
+            entries = sorted(self.heap)
+            self.heap = []
+        return [(request, result) for due_at, sequence, request, result in entries]
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,310 @@
+import time
+import bisect
+import hashlib
+import logging
+import itertools
+import threading
+from collections.abc import Mapping
+from multiprocessing import Lock, RawArray
+from ansibledriver.model.deploymentlocation import DeploymentLocation
+
+logger = logging.getLogger(__name__)
+
+
+class SharedCounters():
+    """
+    Counts by key (e.g. requests in progress by tenant), shared by the processes forked from the process that created
+    them. Keys are hashed into a fixed number of slots (with linear probing), each freed once the count of its key is
+    back to 0, so the slots bound the number of keys counted at the same time. When every slot is taken, further keys
+    are counted together in an overflow slot, limited as a whole
+    """
+    def __init__(self, slots=1024):
+        self.slots = slots
+        self.lock = Lock()
+        # hash of the key in each slot (0 is an empty slot)
+        self.keys = RawArray('q', slots)
+        # the counts of the slots, then the overflow count
+        self.counts = RawArray('i', slots + 1)
+
+    def __hash(self, key):
+        # a stable hash, the same in every process
+        hashed = int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+        return hashed if hashed != 0 else 1
+
+    def __slot(self, key, add):
+        hashed = self.__hash(key)
+        start = hashed % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            if self.keys[slot] == hashed:
+                return slot
+            if self.keys[slot] == 0:
+                if not add:
+                    return None
+                self.keys[slot] = hashed
+                return slot
+        return None
+
+    def __free(self, slot):
+        """
+        Empties the slot, moving back the keys after it that would no longer be found (backward shift deletion)
+        """
+        self.keys[slot] = 0
+        self.counts[slot] = 0
+        following = slot
+        while True:
+            following = (following + 1) % self.slots
+            hashed = self.keys[following]
+            if hashed == 0:
+                return
+            home = hashed % self.slots
+            # keys whose probe from home to their slot doesn't pass the emptied slot are still found
+            if (slot < following and slot < home <= following) or (slot > following and (home > slot or home <= following)):
+                continue
+            self.keys[slot] = hashed
+            self.counts[slot] = self.counts[following]
+            self.keys[following] = 0
+            self.counts[following] = 0
+            slot = following
+
+    def get(self, key):
+        with self.lock:
+            slot = self.__slot(key, False)
+            return self.counts[slot] if slot is not None else 0
+
+    def try_acquire(self, key, limit):
+        """
+        Adds one to the count of the key, unless it has reached limit (0 is no limit). Returns True if added
+        """
+        with self.lock:
+            slot = self.__slot(key, True)
+            if slot is None:
+                logger.warning('No free slot to count {0}, counting it with the other keys without a slot'.format(key))
+                slot = self.slots
+            if limit > 0 and self.counts[slot] >= limit:
+                return False
+            self.counts[slot] += 1
+            return True
+
+    def release(self, key):
+        with self.lock:
+            slot = self.__slot(key, False)
+            if slot is None:
+                # counted in the overflow slot
+                if self.counts[self.slots] > 0:
+                    self.counts[self.slots] -= 1
+            elif self.counts[slot] > 1:
+                self.counts[slot] -= 1
+            else:
+                self.__free(slot)
+
+
+def request_priority(request):
+    """
+    Returns the priority of a request (higher runs first), from its priority field or priority request property
+    (default 0)
+    """
+    priority = request.get('priority', None)
+    if priority is None:
+        request_properties = request.get('request_properties', None)
+        if isinstance(request_properties, Mapping):
+            priority = request_properties.get('priority', None)
+    try:
+        return int(priority) if priority is not None else 0
+    except (TypeError, ValueError):
+        logger.warning('Invalid priority {0} of request {1}, using 0'.format(priority, request.get('request_id')))
+        return 0
+
+
+class LocationLimiter():
+    """
+    Limits the requests in progress against each deployment location, across the workers sharing location_counters
+    (those of one processor service, so one gunicorn worker of the driver).
+    Limits are set by infrastructure type (see ProcessProperties.location_concurrency_limits), counting requests by
+    deployment location name or by the endpoint of the location, so that locations sharing an endpoint share a limit
+    """
+    def __init__(self, process_properties, location_counters=None):
+        self.default_limit = process_properties.location_max_concurrent_requests
+        self.limits = process_properties.location_concurrency_limits or {}
+        self.location_counters = location_counters if location_counters is not None else SharedCounters()
+
+    @staticmethod
+    def enabled(process_properties):
+        return process_properties.location_max_concurrent_requests > 0 or len(process_properties.location_concurrency_limits or {}) > 0
+
+    def key_and_limit(self, request):
+        """
+        Returns the key the request is counted against, and its limit (0 is no limit)
+        """
+        deployment_location = request.get('deployment_location', None) or {}
+        infrastructure_type = deployment_location.get('type', None)
+        type_limits = self.limits.get(infrastructure_type, None) or {}
+        limit = int(type_limits.get('max_concurrent_requests', self.default_limit))
+        if type_limits.get('key', 'name') == 'endpoint':
+            endpoint = DeploymentLocation.endpoint(deployment_location, type_limits.get('endpoint_property', None))
+            if endpoint is not None:
+                return 'endpoint:{0}'.format(endpoint), limit
+        return 'name:{0}:{1}'.format(infrastructure_type, deployment_location.get('name', None)), limit
+
+    def try_acquire(self, request):
+        """
+        Returns the key counting the request, None if the request is not limited, or False if its location is at its
+        limit
+        """
+        key, limit = self.key_and_limit(request)
+        if limit <= 0:
+            return None
+        if not self.location_counters.try_acquire(key, limit):
+            return False
+        return key
+
+    def release(self, key):
+        self.location_counters.release(key)
+
+
+class TenantFairScheduler():
+    """
+    Orders the requests read ahead by a worker. With tenant scheduling enabled, no tenant can starve the others:
+    requests of a higher priority run first, then tenants get turns in proportion to their weights (weighted fair
+    queuing on a virtual clock). Tenants with as many requests in progress as their cap (across the workers sharing
+    tenant_counters) are passed over until one of them finishes. Otherwise requests run by priority, then in the order
+    they were read.
+
+    Requests against a deployment location at its limit (see LocationLimiter) stay queued, while later requests
+    against other locations run. Requests queued for longer than max_wait_seconds are taken by take_expired, so
+    requests held up by their tenant or location don't keep the requests behind them from being read
+    """
+    def __init__(self, process_properties, tenant_counters=None, location_limiter=None, clock=time.monotonic):
+        self.max_size = process_properties.scheduler_queue_size
+        self.max_wait_seconds = process_properties.scheduler_max_wait_seconds
+        self.clock = clock
+        self.by_tenant = process_properties.tenant_scheduling_enabled
+        self.weights = process_properties.tenant_weights or {}
+        self.default_cap = process_properties.tenant_max_concurrent_requests
+        self.caps = process_properties.tenant_concurrency_caps or {}
+        self.tenant_counters = tenant_counters if tenant_counters is not None else SharedCounters()
+        self.location_limiter = location_limiter
+        # pending requests of each tenant (all under None when not scheduling by tenant), as a list of
+        # (-priority, sequence, request) in order
+        self.pending = {}
+        # virtual finish time of the last turn of each tenant
+        self.finish_times = {}
+        self.virtual_time = 0
+        self.sequence = itertools.count()
+        self.size = 0
+        # the tenant and location slots held by each request in progress, by id
+        self.held = {}
+        # the time each pending request was added, by id
+        self.added_at = {}
+        self.lock = threading.Lock()
+
+    def weight(self, tenant_id):
+        return max(float(self.weights.get(tenant_id, 1)), 0.001)
+
+    def cap(self, tenant_id):
+        return int(self.caps.get(tenant_id, self.default_cap)) if self.by_tenant else 0
+
+    def add(self, request):
+        queue = request.get('tenant_id', None) if self.by_tenant else None
+        with self.lock:
+            bisect.insort(self.pending.setdefault(queue, []), (-request_priority(request), next(self.sequence), request))
+            self.added_at[id(request)] = self.clock()
+            self.size += 1
+
+    def __take_runnable(self, queue):
+        """
+        Removes and returns the first request of the queue whose location is not at its limit, holding its location
+        slot. None if there is no such request
+        """
+        requests = self.pending[queue]
+        for i, (priority, sequence, request) in enumerate(requests):
+            location_key = self.location_limiter.try_acquire(request) if self.location_limiter is not None else None
+            if location_key is not False:
+                del requests[i]
+                return request, location_key
+        return None, None
+
+    def next_request(self):
+        """
+        Removes and returns the request to run next, None if there are none or none can run (their tenants or locations
+        are at their limits). The request's slots are held until request_finished is called
+        """
+        with self.lock:
+            candidates = []
+            for queue, requests in self.pending.items():
+                start = max(self.virtual_time, self.finish_times.get(queue, 0))
+                priority, sequence, request = requests[0]
+                candidates.append((priority, start + 1 / self.weight(queue), sequence, queue, start))
+            for priority, finish_time, sequence, queue, start in sorted(candidates):
+                if not self.tenant_counters.try_acquire(queue, self.cap(queue)):
+                    continue
+                request, location_key = self.__take_runnable(queue)
+                if request is None:
+                    self.tenant_counters.release(queue)
+                    continue
+                self.held[id(request)] = (queue, location_key)
+                self.added_at.pop(id(request), None)
+                self.virtual_time = start
+                self.finish_times[queue] = finish_time
+                if len(self.pending[queue]) == 0:
+                    del self.pending[queue]
+                self.size -= 1
+                if len(self.finish_times) > len(self.pending) + 1000:
+                    # tenants without requests, whose turns are behind the clock, start afresh anyway
+                    self.finish_times = {tenant: finish for tenant, finish in self.finish_times.items() if tenant in self.pending or finish > self.virtual_time}
+                return request
+            return None
+
+    def request_finished(self, request):
+        with self.lock:
+            if id(request) not in self.held:
+                return
+            queue, location_key = self.held.pop(id(request))
+        self.tenant_counters.release(queue)
+        if location_key is not None:
+            self.location_limiter.release(location_key)
+
+    def held_slots(self, request):
+        """
+        Returns the (tenant, location key) slots held by a request in progress, None if it holds none
+        """
+        with self.lock:
+            return self.held.get(id(request), None)
+
+    def take_all(self):
+        with self.lock:
+            requests = [request for requests in self.pending.values() for priority, sequence, request in requests]
+            self.pending = {}
+            self.added_at = {}
+            self.size = 0
+        return requests
+
+    def take_expired(self):
+        """
+        Removes and returns the pending requests added more than max_wait_seconds ago (none when 0)
+        """
+        if self.max_wait_seconds <= 0:
+            return []
+        expired = []
+        with self.lock:
+            oldest = self.clock() - self.max_wait_seconds
+            for queue in list(self.pending.keys()):
+                waiting = []
+                for entry in self.pending[queue]:
+                    if self.added_at[id(entry[2])] < oldest:
+                        del self.added_at[id(entry[2])]
+                        expired.append(entry[2])
+                    else:
+                        waiting.append(entry)
+                if len(waiting) > 0:
+                    self.pending[queue] = waiting
+                else:
+                    del self.pending[queue]
+            self.size -= len(expired)
+        return expired
+
+    def full(self):
+        return self.size >= self.max_size
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,199 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+from ansible.template import Templar
+import ansibledriver.service.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+SSH_CONNECTION_TYPES = ['ssh', 'smart']
+
+# host variables for each connection setting, in order of precedence
+USER_VARS = ['ansible_user', 'ansible_ssh_user']
+HOST_VARS = ['ansible_host', 'ansible_ssh_host']
+PORT_VARS = ['ansible_port', 'ansible_ssh_port']
+KEY_FILE_VARS = ['ansible_ssh_private_key_file', 'ansible_private_key_file']
+PASSWORD_VARS = ['ansible_password', 'ansible_ssh_pass', 'ansible_ssh_password']
+
+
+class SshControlPool():
+    """
+    Pool of SSH master connections (ControlMaster) kept open between the playbook runs of a worker, so that lifecycles
+    run back to back against the same hosts skip the SSH handshake and authentication.
+
+    Before a playbook is run, each of its SSH hosts is given a ControlPath (ansible_control_path) for its host, port,
+    user and credentials (the fingerprint of its private key, or its password), so a master connection is only
+    shared by runs connecting the same way. The masters themselves are started by Ansible's ssh connection (with
+    ControlMaster=auto and ControlPersist in ssh_args) and are found by their sockets in the worker's control
+    directory, whose modification time is when they were last used. So the pool is shared with the processes forked
+    from the worker (e.g. the playbook processes of a concurrent worker).
+
+    After each run, masters idle for idle_seconds, and the least recently used beyond max_connections, are stopped by
+    the worker: the processes forked from it only record their use of its masters, the worker evicts once they have
+    exited (see AnsibleClient.playbook_process_exited). Stopping a master lets the sessions using it finish, later runs
+    start a new master. A master that has not been
+    used for health_check_seconds is checked before it is used again, and its socket removed if it does not respond
+    """
+    def __init__(self, control_dir=None, max_connections=50, idle_seconds=600, health_check_seconds=60, clock=time.time, ssh_command='ssh'):
+        self.base_dir = control_dir if control_dir is not None else tempfile.gettempdir()
+        self.max_connections = max_connections
+        self.idle_seconds = idle_seconds
+        self.health_check_seconds = health_check_seconds
+        self.clock = clock
+        self.ssh_command = ssh_command
+        self.claim()
+
+    def claim(self):
+        """
+        Makes this process the owner of the pool, called by a worker when it starts. The processes forked from the
+        worker use its masters, only the worker stops them
+        """
+        self.owner_pid = os.getpid()
+        # a directory for each worker, so workers only evict their own masters
+        self.control_dir = os.path.join(self.base_dir, 'ald-ssh-{0}'.format(self.owner_pid))
+
+    def control_path(self, host, port, user, credentials):
+        # hashed, as the path of a unix socket is limited to around 100 characters
+        key = '\0'.join([str(host), str(port), str(user), credentials])
+        return os.path.join(self.control_dir, hashlib.sha256(key.encode('utf-8')).hexdigest()[:32])
+
+    def __ssh(self, operation, path):
+        # the control path is used as is (without %h tokens), so the host argument is a placeholder
+        try:
+            completed = subprocess.run([self.ssh_command, '-O', operation, '-o', 'ControlPath={0}'.format(path), 'ald-ssh-pool'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+            return completed.returncode == 0
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug('Unable to run ssh -O {0} for {1}: {2}'.format(operation, path, e))
+            return False
+
+    def __credentials(self, host_vars, templar, fingerprints):
+        key_file = self.__host_var(host_vars, KEY_FILE_VARS, templar)
+        if key_file is not None:
+            key_file = os.path.expanduser(str(key_file))
+            if key_file not in fingerprints:
+                with open(key_file, 'rb') as f:
+                    fingerprints[key_file] = 'key:' + hashlib.sha256(f.read()).hexdigest()
+            return fingerprints[key_file]
+        password = self.__host_var(host_vars, PASSWORD_VARS, templar)
+        if password is not None:
+            return 'password:' + hashlib.sha256(str(password).encode('utf-8')).hexdigest()
+        return 'default'
+
+    def __host_var(self, host_vars, names, templar, default=None):
+        for name in names:
+            if host_vars.get(name, None) is not None:
+                return templar.template(host_vars[name])
+        return default
+
+    def prepare(self, inventory, variable_manager, loader, connection_type):
+        """
+        Sets the ControlPath of each SSH host of the inventory, checking the health of masters not used recently.
+        Returns the control paths, to be given to release once the playbook has run
+        """
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        control_paths = []
+        fingerprints = {}
+        now = self.clock()
+        for host in inventory.get_hosts():
+            try:
+                host_vars = variable_manager.get_vars(host=host, include_hostvars=False)
+                templar = Templar(loader=loader, variables=host_vars)
+                if self.__host_var(host_vars, ['ansible_connection'], templar, connection_type) not in SSH_CONNECTION_TYPES:
+                    continue
+                path = self.control_path(self.__host_var(host_vars, HOST_VARS, templar, host.name),
+                    self.__host_var(host_vars, PORT_VARS, templar), self.__host_var(host_vars, USER_VARS, templar),
+                    self.__credentials(host_vars, templar, fingerprints))
+            except Exception as e:
+                # e.g. variables only defined by the playbook, leave the host to the configured ControlPath
+                logger.debug('Unable to pool SSH connections of host {0}: {1}'.format(host.name, e))
+                continue
+            if os.path.exists(path):
+                if now - os.path.getmtime(path) >= self.health_check_seconds and not self.__ssh('check', path):
+                    logger.debug('SSH master {0} of host {1} is not responding, removing it'.format(path, host.name))
+                    metrics.ssh_masters_stopped.labels('unhealthy').inc()
+                    self.__remove(path)
+                else:
+                    metrics.ssh_masters_reused.inc()
+            host.set_variable('ansible_control_path', path)
+            control_paths.append(path)
+        return control_paths
+
+    def release(self, control_paths):
+        """
+        Records the use of the masters of a playbook run, then (in the worker) stops those idle for too long or beyond
+        max_connections
+        """
+        now = self.clock()
+        for path in set(control_paths):
+            if os.path.exists(path):
+                os.utime(path, (now, now))
+        self.evict()
+
+    def masters(self):
+        """
+        Returns the (last used, control path) of the masters of the worker, least recently used first
+        """
+        masters = []
+        try:
+            names = os.listdir(self.control_dir)
+        except FileNotFoundError:
+            return masters
+        for name in names:
+            if '.' in name:
+                # the temporary socket of a master being started
+                continue
+            path = os.path.join(self.control_dir, name)
+            try:
+                masters.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                # stopped meanwhile
+                pass
+        return sorted(masters)
+
+    def evict(self):
+        """
+        Stops the masters idle for too long or beyond max_connections. Only the worker evicts, a process forked from it
+        can't tell which masters its siblings are using
+        """
+        if os.getpid() != self.owner_pid:
+            return
+        masters = self.masters()
+        now = self.clock()
+        for i, (last_used, path) in enumerate(masters):
+            if self.idle_seconds > 0 and now - last_used >= self.idle_seconds:
+                reason = 'idle'
+            elif self.max_connections > 0 and len(masters) - i > self.max_connections:
+                reason = 'max_connections'
+            else:
+                continue
+            logger.debug('Stopping SSH master {0} ({1})'.format(path, reason))
+            metrics.ssh_masters_stopped.labels(reason).inc()
+            self.__stop(path)
+
+    def __stop(self, path):
+        if not self.__ssh('stop', path):
+            self.__remove(path)
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.masters())
+
+    def close(self):
+        """
+        Stops every master of the worker, called when it stops
+        """
+        if os.getpid() != self.owner_pid:
+            return
+        for last_used, path in self.masters():
+            self.__ssh('exit', path)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
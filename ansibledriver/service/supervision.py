@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import shutil
+import signal
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def exit_reason(exitcode):
+    """
+    Returns why a worker process exited, from its exit code (negative when killed by a signal)
+    """
+    if exitcode is None:
+        return 'unknown'
+    if exitcode < 0:
+        try:
+            return signal.Signals(-exitcode).name
+        except ValueError:
+            return 'signal {0}'.format(-exitcode)
+    return 'exit code {0}'.format(exitcode)
+
+
+class RequestJournal():
+    """
+    The requests a worker has accepted but not finished (running, scheduled or waiting to be retried), one file for
+    each in a directory created by the parent before the worker is started, so that the parent can deal with them if
+    the worker dies.
+
+    Entries are committed once the worker has committed the offset of their request on the request queue. Requests not
+    yet committed (those run by the worker as it reads them) are redelivered by the request queue to another worker,
+    the others are lost unless the parent fails them
+    """
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        # entries written by this process, by request id
+        self.written = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create(base_dir=None):
+        return RequestJournal(tempfile.mkdtemp(prefix='ald-requests-', dir=base_dir))
+
+    def __path(self, request_id):
+        return os.path.join(self.journal_dir, hashlib.sha256(str(request_id).encode('utf-8')).hexdigest()[:32] + '.json')
+
+    def __write(self, entry):
+        path = self.__path(entry['request_id'])
+        # written then renamed, so the parent never reads part of an entry
+        with open(path + '.tmp', 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(path + '.tmp', path)
+
+    def add(self, request):
+        driver_files = request.get('driver_files', None)
+        entry = {
+            'request_id': request.get('request_id', None),
+            'tenant_id': request.get('tenant_id', None),
+            'lifecycle_name': request.get('lifecycle_name', None),
+            'driver_files': getattr(driver_files, 'root_path', None),
+            'keep_files': bool(request.get('keep_files', False)),
+            'committed': False,
+            'slots': {}
+        }
+        with self.lock:
+            self.written[entry['request_id']] = entry
+            self.__write(entry)
+
+    def commit(self):
+        """
+        Marks the entries of the requests read so far as committed on the request queue
+        """
+        with self.lock:
+            for entry in self.written.values():
+                if not entry['committed']:
+                    entry['committed'] = True
+                    self.__write(entry)
+
+    def hold_slots(self, request, slots):
+        """
+        Records the (tenant, location key) slots (see TenantFairScheduler) held by the request while it runs, None
+        once it has released them
+        """
+        with self.lock:
+            entry = self.written.get(request.get('request_id', None), None)
+            if entry is not None:
+                entry['slots'] = {'tenant': slots[0], 'location': slots[1]} if slots is not None else {}
+                self.__write(entry)
+
+    def remove(self, request):
+        with self.lock:
+            entry = self.written.pop(request.get('request_id', None), None)
+            if entry is not None:
+                try:
+                    os.remove(self.__path(entry['request_id']))
+                except FileNotFoundError:
+                    pass
+
+    def entries(self):
+        """
+        Returns the entries in the journal, as written by the worker
+        """
+        entries = []
+        try:
+            names = os.listdir(self.journal_dir)
+        except FileNotFoundError:
+            return entries
+        for name in sorted(names):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.journal_dir, name), 'r') as entry_file:
+                    entries.append(json.load(entry_file))
+            except (OSError, ValueError) as e:
+                logger.warning('Unable to read request journal entry {0}: {1}'.format(name, e))
+        return entries
+
+    def __len__(self):
+        return len(self.entries())
+
+    def close(self):
+        shutil.rmtree(self.journal_dir, ignore_errors=True)
+
+
+class RestartBackoff():
+    """
+    Delays the restart of workers that keep crashing. The first crash in reset_seconds restarts the worker at once, each
+    further crash doubles the delay, from base_seconds up to max_seconds
+    """
+    def __init__(self, base_seconds, max_seconds, reset_seconds, clock=time.monotonic):
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.crashes = 0
+        self.last_crash = None
+
+    def next_delay(self):
+        """
+        Counts a crash, returns the number of seconds to wait before restarting the worker
+        """
+        now = self.clock()
+        if self.last_crash is None or now - self.last_crash >= self.reset_seconds:
+            self.crashes = 0
+        self.crashes += 1
+        self.last_crash = now
+        if self.crashes == 1 or self.base_seconds <= 0:
+            return 0
+        return min(self.max_seconds, self.base_seconds * (2 ** (self.crashes - 2)))
@@ -0,0 +1,155 @@
+import os
+import hashlib
+import multiprocessing
+import concurrent.futures
+import logging
+import tempfile
+import shutil
+import jinja2 as jinja
+from ignition.templating.jinja_template import base_env
+from ignition.templating.exceptions import TemplatingError
+from ignition.templating.syntax import Syntax
+from ansibledriver.util.lrucache import LRUCache
+from ansibledriver.service import metrics
+
+logger = logging.getLogger(__name__)
+
+# Jinja2 variable, statement and comment delimiters; files without any of these render to themselves
+TEMPLATE_MARKERS = ('{{', '{%', '{#')
+# template rendering modes
+SEQUENTIAL = 'sequential'
+THREADS = 'threads'
+PROCESSES = 'processes'
+RENDERING_MODES = (SEQUENTIAL, THREADS, PROCESSES)
+# number of bytes inspected when checking whether a file is binary
+BINARY_SNIFF_LENGTH = 8192
+
+
+class CachingTemplateRenderer():
+    """
+    Renders templates with the same environment as the Jinja2 templating service, caching compiled templates by a hash
+    of their content so that templates seen in earlier requests are not compiled again. Other templating services are
+    used as they are.
+    """
+    def __init__(self, templating, cache_size):
+        self.templating = templating
+        self.templates = LRUCache(cache_size)
+        self.jinja2 = cache_size > 0 and templating.syntax() == Syntax.JINJA2
+
+    def render(self, content, context):
+        if not self.jinja2:
+            return self.templating.render(content, context)
+        try:
+            return self.__compile(content).render(context)
+        except jinja.TemplateError as e:
+            raise TemplatingError(str(e)) from e
+
+    def __compile(self, content):
+        key = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        template = self.templates.get(key)
+        if template is None:
+            metrics.template_cache_misses.inc()
+            template = base_env.from_string(content)
+            self.templates.put(key, template)
+        else:
+            metrics.template_cache_hits.inc()
+        return template
+
+
+def process_templates(parent_dir, templating, all_properties, mode=SEQUENTIAL, parallelism=1, parallel_threshold=0):
+  """
+  Renders every template in the directory tree. Trees of at least parallel_threshold files may be rendered on a pool of
+  threads or processes (see mode). Whichever mode is used, the error raised is the one from the first file (in sorted
+  order) that fails to render
+  """
+  paths = template_paths(parent_dir.get_path())
+  if mode not in RENDERING_MODES:
+    raise ValueError('Invalid template rendering mode {0}, expected one of {1}'.format(mode, RENDERING_MODES))
+  if mode == SEQUENTIAL or parallelism <= 1 or len(paths) < max(parallel_threshold, 2):
+    render_templates(paths, templating, all_properties)
+  elif mode == THREADS:
+    logger.debug('Rendering {0} templates on {1} threads'.format(len(paths), parallelism))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='TemplateRenderer') as executor:
+      # map yields results in the order of paths, so the first error raised belongs to the first failing file
+      for result in executor.map(lambda path: process_template(path, templating, all_properties), paths):
+        pass
+  else:
+    chunks = split(paths, parallelism)
+    logger.debug('Rendering {0} templates in {1} processes'.format(len(paths), len(chunks)))
+    mp_context = multiprocessing.get_context('fork')
+    # the renderer and properties are inherited by the forked processes rather than pickled with every chunk
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(chunks), mp_context=mp_context,
+        initializer=init_render_process, initargs=(templating, all_properties)) as executor:
+      # chunks are contiguous, so the first chunk to fail holds the first failing file
+      for result in executor.map(render_chunk, chunks):
+        pass
+
+
+def template_paths(path):
+  logger.debug('Process templates: walking {0}'.format(path))
+  paths = []
+  for root, dirs, files in os.walk(path):
+    logger.debug('Process templates: files = {0}'.format(files))
+    paths.extend(os.path.join(root, file) for file in files)
+  return sorted(paths)
+
+
+def split(paths, parallelism):
+  chunk_size = -(-len(paths) // parallelism)
+  return [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+
+
+render_process_args = None
+
+
+def init_render_process(templating, all_properties):
+  global render_process_args
+  render_process_args = (templating, all_properties)
+
+
+def render_chunk(paths):
+  templating, all_properties = render_process_args
+  render_templates(paths, templating, all_properties)
+
+
+def render_templates(paths, templating, all_properties):
+  for path in paths:
+    logger.debug(f'Processing template {path}')
+    process_template(path, templating, all_properties)
+
+
+def process_template(path, templating, all_properties):
+  with open(path, 'rb') as template_file:
+    raw_content = template_file.read()
+  if b'\0' in raw_content[:BINARY_SNIFF_LENGTH]:
+    # skip this file, not a text file
+    return
+  try:
+    template_content = raw_content.decode('utf-8')
+  except UnicodeDecodeError:
+    # skip this file, not a text file
+    return
+  if not any(marker in template_content for marker in TEMPLATE_MARKERS):
+    # nothing to render
+    return
+  content = templating.render(template_content, all_properties)
+  if content != template_content:
+    write_file(path, content)
+    logger.debug('Wrote process template to file {0}'.format(path))
+
+
+def write_file(path, content):
+  """
+  Replaces the file with a new one, rather than writing to it in place, so that files hard linked from the resource
+  package cache are never modified
+  """
+  directory, file_name = os.path.split(path)
+  file_descriptor, tmp_path = tempfile.mkstemp(prefix='.{0}.'.format(file_name), dir=directory)
+  try:
+    with os.fdopen(file_descriptor, 'w', encoding='utf-8') as tmp_file:
+      tmp_file.write(content)
+    shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, path)
+  except Exception:
+    os.unlink(tmp_path)
+    raise
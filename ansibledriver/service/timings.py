@@ -0,0 +1,113 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# host results counted in a task summary
+OK = 'ok'
+CHANGED = 'changed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+UNREACHABLE = 'unreachable'
+HOST_RESULTS = (OK, CHANGED, FAILED, SKIPPED, UNREACHABLE)
+
+
+class TaskSummary():
+    """
+    Counts the results of a task on each host and times the task, and the task on each host, with a monotonic clock
+    """
+    def __init__(self, task_name, clock=time.monotonic, module=None):
+        self.task_name = task_name
+        # the module (action) run by the task
+        self.module = module
+        self.clock = clock
+        self.started = clock()
+        self.finished = self.started
+        self.host_started = {}
+        self.host_durations = {}
+        self.host_counts = {result: 0 for result in HOST_RESULTS}
+
+    def host_start(self, host_name):
+        self.host_started[host_name] = self.clock()
+
+    def host_result(self, host_name, result, changed=False):
+        self.finished = self.clock()
+        self.host_counts[result] += 1
+        if changed:
+            self.host_counts[CHANGED] += 1
+        self.host_durations[host_name] = self.finished - self.host_started.get(host_name, self.started)
+
+    def duration(self):
+        return self.finished - self.started
+
+
+class PlaybookTimings():
+    """
+    Wall time of a playbook run, of each of its plays and tasks, and of each task on each host, measured with a
+    monotonic clock
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.finished = None
+        # [play name, started, finished]
+        self.plays = []
+        # task id to the TaskSummary timing it, in the order the tasks started
+        self.tasks = {}
+
+    def play_start(self, play_name):
+        self.__finish_play()
+        self.plays.append([play_name, self.clock(), None])
+
+    def __finish_play(self):
+        if len(self.plays) > 0 and self.plays[-1][2] is None:
+            self.plays[-1][2] = self.clock()
+
+    def task_start(self, task_id, task_name, module=None):
+        summary = TaskSummary(task_name, clock=self.clock, module=module)
+        self.tasks[task_id] = summary
+        return summary
+
+    def task(self, task_id):
+        return self.tasks.get(task_id, None)
+
+    def finish(self):
+        self.__finish_play()
+        self.finished = self.clock()
+
+    def duration(self):
+        finished = self.finished if self.finished is not None else self.clock()
+        return finished - self.started
+
+    def play_durations(self):
+        return [(name, (finished if finished is not None else self.clock()) - started) for name, started, finished in self.plays]
+
+    def host_durations(self):
+        """
+        Returns the total time spent running tasks on each host
+        """
+        totals = {}
+        for summary in self.tasks.values():
+            for host_name, duration in summary.host_durations.items():
+                totals[host_name] = totals.get(host_name, 0) + duration
+        return totals
+
+    def slowest_tasks(self, count):
+        tasks = sorted(self.tasks.values(), key=lambda summary: summary.duration(), reverse=True)[:max(count, 0)]
+        return [{'taskName': summary.task_name, 'durationSeconds': round(summary.duration(), 3)} for summary in tasks]
+
+    def to_dict(self):
+        tasks = []
+        for summary in self.tasks.values():
+            task = {'taskName': summary.task_name, 'durationSeconds': round(summary.duration(), 3)}
+            if len(summary.host_durations) > 0:
+                slowest_host = max(summary.host_durations, key=summary.host_durations.get)
+                task['slowestHost'] = slowest_host
+                task['slowestHostDurationSeconds'] = round(summary.host_durations[slowest_host], 3)
+            tasks.append(task)
+        return {
+            'durationSeconds': round(self.duration(), 3),
+            'plays': [{'playName': name, 'durationSeconds': round(duration, 3)} for name, duration in self.play_durations()],
+            'tasks': tasks,
+            'hosts': {host_name: round(duration, 3) for host_name, duration in sorted(self.host_durations().items())}
+        }
@@ -0,0 +1,59 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# progress event verbosity tiers, each includes the events of the tiers before it
+# playbook: play started, no hosts matched, var prompt and playbook result events
+PLAYBOOK = 'playbook'
+# failures: task failed and host unreachable events
+FAILURES = 'failures'
+# summary: task started events and a task summary event per task, in place of the events of each host
+SUMMARY = 'summary'
+# full: the events of each host (and loop item)
+FULL = 'full'
+VERBOSITY_TIERS = (PLAYBOOK, FAILURES, SUMMARY, FULL)
+
+class ProgressEventFilter():
+    """
+    Decides which progress events a playbook run produces, from the configured verbosity tier and the sample rate for
+    its lifecycle. Sampling only applies to the events of each host, failures are never sampled
+    """
+    def __init__(self, ansible_properties, lifecycle):
+        self.enabled = ansible_properties.log_progress_events
+        self.verbosity = ansible_properties.progress_event_verbosity
+        if self.verbosity not in VERBOSITY_TIERS:
+            raise ValueError('Invalid progress_event_verbosity {0}, expected one of {1}'.format(self.verbosity, VERBOSITY_TIERS))
+        sample_rates = ansible_properties.progress_event_lifecycle_sample_rates or {}
+        self.sample_rate = max(1, int(sample_rates.get(lifecycle, ansible_properties.progress_event_sample_rate)))
+        # the events of a task on a host (started, retries, loop items and result) are kept or discarded together,
+        # by (task id, host name)
+        self.sampled = {}
+
+    def __includes(self, tier):
+        return self.enabled and VERBOSITY_TIERS.index(self.verbosity) >= VERBOSITY_TIERS.index(tier)
+
+    def playbook_events(self):
+        return self.__includes(PLAYBOOK)
+
+    def failure_events(self):
+        return self.__includes(FAILURES)
+
+    def task_events(self):
+        return self.__includes(SUMMARY)
+
+    def task_summaries(self):
+        return self.enabled and self.verbosity == SUMMARY
+
+    def host_event(self, task_id, host_name):
+        """
+        Called for each (non failure) event of a task on a host or loop item, returns True if the event should be
+        produced
+        """
+        if not self.__includes(FULL):
+            return False
+        keep = self.sampled.get((task_id, host_name), None)
+        if keep is None:
+            # keep the events of the first of every sample_rate tasks on a host
+            keep = len(self.sampled) % self.sample_rate == 0
+            self.sampled[(task_id, host_name)] = keep
+        return keep
@@ -0,0 +1,60 @@
+"""
+Compares the time taken to serialize TaskCompletedOnHostEvent progress events, shaped like those of a looped task,
+with each progress_event_log.serializer_format.
+
+Usage: python3 benchmarks/progress_event_serialization.py [events] [items]
+"""
+import sys
+import time
+from unittest.mock import MagicMock
+from ansible.parsing.yaml.objects import AnsibleUnicode
+from ansibledriver.model.progress_events import TaskCompletedOnHostEvent
+from ansibledriver.service.progress_events import AnsibleYAMLProgressEventLogSerializer, ProgressEventLogProperties, SERIALIZER_FORMATS
+
+
+def _task_result(items):
+    return {
+        'msg': AnsibleUnicode('All items completed'),
+        'changed': True,
+        'failed': False,
+        'results': [{
+            'msg': AnsibleUnicode('Installed package-{0} version 1.{0}.0 from repository https://repo.example.com/el8/x86_64'.format(i)),
+            'changed': i % 2 == 0,
+            'failed': False,
+            'rc': 0
+        } for i in range(items)]
+    }
+
+
+def _events(count, items):
+    return [TaskCompletedOnHostEvent(AnsibleUnicode('Install packages'), 'host{0}'.format(i), _task_result(items),
+        item_label='package-{0}'.format(i)) for i in range(count)]
+
+
+def _serializer(serializer_format):
+    properties = ProgressEventLogProperties()
+    properties.serializer_format = serializer_format
+    configuration = MagicMock()
+    configuration.property_groups.get_property_group.return_value = properties
+    return AnsibleYAMLProgressEventLogSerializer(configuration)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    items = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    events = _events(count, items)
+    baseline = None
+    for serializer_format in SERIALIZER_FORMATS:
+        serializer = _serializer(serializer_format)
+        start = time.perf_counter()
+        for event in events:
+            serializer.serialize(event)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = elapsed
+        print('{0:<7} {1} events  total {2:8.1f}ms  per event {3:7.3f}ms  speedup {4:5.1f}x'.format(serializer_format, count,
+            elapsed * 1000, elapsed * 1000 / count, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
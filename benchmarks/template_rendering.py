@@ -0,0 +1,74 @@
+"""
+Compares the time taken to render synthetic config trees of 10, 100 and 1000 template files in each template rendering
+mode (ansible.template_rendering_mode). Each file is rendered from a fresh copy of the tree, so files are always written.
+
+Usage: python3 benchmarks/template_rendering.py [iterations] [parallelism]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import statistics
+from ignition.service.templating import Jinja2TemplatingService
+from ignition.utils.file import DirectoryTree
+from ansibledriver.service.templates import CachingTemplateRenderer, process_templates, RENDERING_MODES
+
+TREE_SIZES = [10, 100, 1000]
+
+TEMPLATE = '''---
+# fragment {index}
+name: {{{{ name }}}}-{index}
+{{% for host in hosts %}}
+{{{{ host.name }}}}:
+  ansible_host: {{{{ host.address }}}}
+  ansible_user: {{{{ user | default('root') }}}}
+  labels: {{{{ host.labels | join(',') }}}}
+{{% endfor %}}
+'''
+
+PROPERTIES = {
+    'name': 'benchmark',
+    'user': 'ansible',
+    'hosts': [{'name': 'host{0}'.format(i), 'address': '10.0.0.{0}'.format(i), 'labels': ['a', 'b', 'c']} for i in range(50)]
+}
+
+
+def _build_tree(path, size):
+    for i in range(size):
+        # spread files over a few directories, as in a real package
+        directory = os.path.join(path, 'group{0}'.format(i % 10))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'fragment{0}.yml'.format(i)), 'w') as f:
+            # files differ in content so that each one is compiled
+            f.write(TEMPLATE.format(index=i))
+
+
+def _time_render(source, work_dir, mode, parallelism, renderer):
+    shutil.rmtree(work_dir, ignore_errors=True)
+    shutil.copytree(source, work_dir)
+    start = time.perf_counter()
+    process_templates(DirectoryTree(work_dir), renderer, PROPERTIES, mode=mode, parallelism=parallelism, parallel_threshold=0)
+    return time.perf_counter() - start
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    parallelism = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for size in TREE_SIZES:
+            source = os.path.join(tmp_dir, 'source{0}'.format(size))
+            _build_tree(source, size)
+            for mode in RENDERING_MODES:
+                # a new renderer for each mode, so its first iteration compiles every template
+                renderer = CachingTemplateRenderer(Jinja2TemplatingService(), size)
+                timings = [_time_render(source, os.path.join(tmp_dir, 'work'), mode, parallelism, renderer) for i in range(iterations)]
+                print('{0:>5} files  {1:<10} first {2:8.1f}ms  mean {3:8.1f}ms  min {4:8.1f}ms'.format(size, mode,
+                    timings[0] * 1000, statistics.mean(timings) * 1000, min(timings) * 1000))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compares the time taken to start an Ansible worker process that is ready to run playbooks:
+
+  cold        - fresh interpreter (spawn), imports and loads everything itself
+  fork        - forked from a parent that has imported Ansible but not loaded any plugins (default behaviour)
+  warm        - forked from a parent that has been warmed up as a worker template (process.warm_worker_template)
+
+Usage: python3 benchmarks/worker_spawn.py [iterations]
+"""
+import sys
+import time
+import gc
+import statistics
+import multiprocessing
+
+
+def _worker(conn, cold):
+    from ansible.plugins.loader import init_plugin_loader
+    from ansibledriver.service.ansible import warm_up_plugins
+    if cold:
+        # forked workers inherit the initialised plugin loader from their parent
+        init_plugin_loader()
+    # a worker loads these plugins when it runs its first playbook
+    warm_up_plugins()
+    conn.send(time.perf_counter())
+    conn.close()
+
+
+def _time_spawn(context):
+    r, w = multiprocessing.Pipe(False)
+    start = time.perf_counter()
+    p = context.Process(target=_worker, args=(w, context.get_start_method() == 'spawn'))
+    p.start()
+    ready = r.recv()
+    p.join()
+    return ready - start
+
+
+def _run(name, context, iterations):
+    timings = [_time_spawn(context) for i in range(iterations)]
+    print('{0:<6} mean {1:8.1f}ms  min {2:8.1f}ms  max {3:8.1f}ms'.format(name, statistics.mean(timings) * 1000, min(timings) * 1000, max(timings) * 1000))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    from ansible.plugins.loader import init_plugin_loader
+    import ansibledriver.service.ansible as ansible_service
+    init_plugin_loader()
+
+    _run('cold', multiprocessing.get_context('spawn'), iterations)
+    _run('fork', multiprocessing.get_context('fork'), iterations)
+
+    ansible_service.warm_up_plugins()
+    gc.collect()
+    gc.freeze()
+    _run('warm', multiprocessing.get_context('fork'), iterations)
+
+
+if __name__ == '__main__':
+    main()
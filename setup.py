@@ -27,7 +27,8 @@ setup(
         'boto3==1.18.42',
         'botocore==1.21.42',
         'itsdangerous==2.0.1',
-        'uvicorn==0.29.0'
+        'uvicorn==0.29.0',
+        'prometheus-client==0.20.0'
     ],
     entry_points='''
         [console_scripts]
@@ -0,0 +1,9 @@
+class FakeClock():
+    """
+    A clock for the classes taking one (e.g. time.monotonic), returning now until it is changed
+    """
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -1,10 +1,13 @@
 import logging
 import os
 import unittest
+import multiprocessing
 from ignition.locations.kubernetes import KubernetesDeploymentLocation
 from ignition.locations.exceptions import InvalidDeploymentLocationError
 from ignition.utils.propvaluemap import PropValueMap
 from ansibledriver.model.deploymentlocation import DeploymentLocation
+from ansibledriver.service.kubeconfigcache import KubeconfigCache
+from tests.unit.helpers import FakeClock
 
 
 logger = logging.getLogger()
@@ -90,3 +93,103 @@ class TestDeploymentLocation(unittest.TestCase):
         location.cleanup()
         self.assertFalse(os.path.isfile(location.properties().get('kubeconfig_path', None)))
 
+
+
+class TestKubeconfigCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = KubeconfigCache(60, clock=self.clock)
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def __location(self, server='localhost'):
+        return DeploymentLocation({
+            'name': 'dl',
+            'type': 'Kubernetes',
+            'properties': {
+                'connection_type': 'kubectl',
+                'clientConfig': EXAMPLE_KUBECTL_CONFIG.replace('localhost', server)
+            }
+        }, kubeconfig_cache=self.cache)
+
+    def test_requests_against_same_cluster_share_file(self):
+        location1 = self.__location()
+        location2 = self.__location()
+        other_location = self.__location(server='remote')
+        self.assertEqual(location1.kubeconfig_file, location2.kubeconfig_file)
+        self.assertNotEqual(location1.kubeconfig_file, other_location.kubeconfig_file)
+        location1.cleanup()
+        # still in use
+        self.clock.now = 120
+        other_location.cleanup()
+        self.assertTrue(os.path.exists(location1.kubeconfig_file))
+        location2.cleanup()
+        self.assertTrue(os.path.exists(location1.kubeconfig_file))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_unused_files_evicted_after_ttl(self):
+        location = self.__location()
+        location.cleanup()
+        self.clock.now = 59
+        reused = self.__location()
+        self.assertEqual(reused.kubeconfig_file, location.kubeconfig_file)
+        reused.cleanup()
+        self.clock.now = 200
+        self.__location(server='remote')
+        self.assertFalse(os.path.exists(location.kubeconfig_file))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_file_rewritten_if_removed(self):
+        location = self.__location()
+        location.cleanup()
+        os.remove(location.kubeconfig_file)
+        self.assertTrue(os.path.exists(self.__location().kubeconfig_file))
+
+    def __use_in_child(self, claim, sender):
+        if claim:
+            self.cache.claim()
+        location1 = self.__location()
+        location2 = self.__location()
+        shared = location1.kubeconfig_file == location2.kubeconfig_file
+        location1.cleanup()
+        location2.cleanup()
+        cached = len(self.cache)
+        self.cache.clear()
+        sender.send((self.cache.enabled(), shared, cached, os.path.exists(location1.kubeconfig_file)))
+        sender.close()
+
+    def __run_in_child(self, claim):
+        receiver, sender = multiprocessing.Pipe(False)
+        child = multiprocessing.Process(target=self.__use_in_child, args=(claim, sender))
+        child.start()
+        sender.close()
+        result = receiver.recv()
+        child.join()
+        return result
+
+    def test_worker_claims_cache_created_before_fork(self):
+        enabled, shared, cached, exists_after_clear = self.__run_in_child(True)
+        self.assertTrue(enabled)
+        self.assertTrue(shared)
+        self.assertEqual(cached, 1)
+        self.assertFalse(exists_after_clear)
+        # the parent's copy is untouched
+        self.assertEqual(len(self.cache), 0)
+
+    def test_unclaimed_cache_bypassed_in_forked_process(self):
+        enabled, shared, cached, exists_after_clear = self.__run_in_child(False)
+        self.assertFalse(enabled)
+        self.assertFalse(shared)
+        self.assertEqual(cached, 0)
+        self.assertFalse(exists_after_clear)
+
+    def test_disabled(self):
+        self.cache = KubeconfigCache(0)
+        location1 = self.__location()
+        location2 = self.__location()
+        self.assertNotEqual(location1.kubeconfig_file, location2.kubeconfig_file)
+        location1.cleanup()
+        self.assertFalse(os.path.exists(location1.kubeconfig_file))
+        location2.cleanup()
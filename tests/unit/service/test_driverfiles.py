@@ -0,0 +1,98 @@
+import io
+import os
+import base64
+import shutil
+import tempfile
+import unittest
+import zipfile
+import pathlib
+from ignition.boot.config import BootstrapApplicationConfiguration, PropertyGroups
+from ignition.service.resourcedriver import ResourceDriverProperties
+from ansibledriver.service.ansible import AnsibleProperties
+from ansibledriver.service.driverfiles import CachingDriverFilesManagerService
+
+RESOURCES = os.path.join(str(pathlib.Path(__file__).parent.absolute()), '..', '..', 'resources')
+
+
+def zip_package(package_path, extra_file=None):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as package_zip:
+        for root, dirs, files in os.walk(package_path):
+            for file in files:
+                path = os.path.join(root, file)
+                package_zip.write(path, os.path.relpath(path, package_path))
+        if extra_file is not None:
+            package_zip.writestr(extra_file, 'extra')
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+class TestCachingDriverFilesManagerService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ansible_properties = AnsibleProperties()
+        self.ansible_properties.tmp_dir = os.path.join(self.tmp_dir, 'tmp')
+        resource_driver_properties = ResourceDriverProperties()
+        resource_driver_properties.scripts_workspace = os.path.join(self.tmp_dir, 'workspace')
+        property_groups = PropertyGroups()
+        property_groups.add_property_group(self.ansible_properties)
+        property_groups.add_property_group(resource_driver_properties)
+        self.configuration = BootstrapApplicationConfiguration(app_name='test', property_sources=[], property_groups=property_groups, service_configurators=[], api_configurators=[], api_error_converter=None)
+        self.cache_path = os.path.join(self.ansible_properties.tmp_dir, 'package_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __cache_entries(self):
+        return [entry for entry in os.listdir(self.cache_path) if not entry.startswith('.')]
+
+    def test_build_tree_from_cache(self):
+        service = CachingDriverFilesManagerService(self.configuration)
+        package = zip_package(os.path.join(RESOURCES, 'ansible'))
+        first = service.build_tree('first', package)
+        second = service.build_tree('second', package)
+        self.assertEqual(len(self.__cache_entries()), 1)
+        for tree in [first, second]:
+            self.assertTrue(tree.has_file('scripts/install.yaml'))
+            self.assertTrue(tree.has_file('config/inventory.Kubernetes'))
+        # working copies are independent of each other and of the cache
+        first_playbook = first.get_file_path('scripts/install.yaml')
+        second_playbook = second.get_file_path('scripts/install.yaml')
+        self.assertNotEqual(os.stat(first_playbook).st_ino, os.stat(second_playbook).st_ino)
+        first.remove_all()
+        self.assertTrue(second.has_file('scripts/install.yaml'))
+
+    def test_build_tree_with_hardlinks(self):
+        self.ansible_properties.package_cache_hardlinks = True
+        service = CachingDriverFilesManagerService(self.configuration)
+        package = zip_package(os.path.join(RESOURCES, 'ansible'))
+        first = service.build_tree('first', package)
+        second = service.build_tree('second', package)
+        self.assertEqual(os.stat(first.get_file_path('scripts/install.yaml')).st_ino, os.stat(second.get_file_path('scripts/install.yaml')).st_ino)
+        # config files are templated in place so are always copied
+        self.assertNotEqual(os.stat(first.get_file_path('config/inventory.Kubernetes')).st_ino, os.stat(second.get_file_path('config/inventory.Kubernetes')).st_ino)
+
+    def test_evicts_least_recently_used_packages(self):
+        service = CachingDriverFilesManagerService(self.configuration)
+        first_package = zip_package(os.path.join(RESOURCES, 'ansible'))
+        service.build_tree('first', first_package)
+        # allow a single package in the cache
+        service.max_cache_bytes = 1
+        service.build_tree('second', zip_package(os.path.join(RESOURCES, 'ansible'), extra_file='extra.txt'))
+        self.assertEqual(len(self.__cache_entries()), 1)
+        tree = service.build_tree('third', first_package)
+        self.assertTrue(tree.has_file('scripts/install.yaml'))
+        self.assertFalse(tree.has_file('extra.txt'))
+
+    def test_build_tree_without_cache(self):
+        self.ansible_properties.package_cache_enabled = False
+        service = CachingDriverFilesManagerService(self.configuration)
+        tree = service.build_tree('first', zip_package(os.path.join(RESOURCES, 'ansible')))
+        self.assertTrue(tree.has_file('scripts/install.yaml'))
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_build_tree_with_invalid_package(self):
+        service = CachingDriverFilesManagerService(self.configuration)
+        with self.assertRaises(ValueError) as context:
+            service.build_tree('first', base64.b64encode(b'not a zip').decode('utf-8'))
+        self.assertEqual(str(context.exception), 'lifecycle_scripts should include binary contents of a zip file')
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from ansible import context
+from ignition.boot.config import BootstrapApplicationConfiguration, PropertyGroups
+from ignition.service.templating import Jinja2TemplatingService
+from ignition.model.lifecycle import STATUS_COMPLETE, STATUS_FAILED
+from ignition.model.failure import FAILURE_CODE_INFRASTRUCTURE_ERROR
+from ansibledriver.service.ansible import AnsibleClient, AnsibleProperties
+from ansibledriver.service.playbookcache import PlaybookCache
+from ansibledriver.service.rendercontext import ExtendedResourceTemplateContextService
+from ansibledriver.service.executor import FrameWriter, FrameReader, PlaybookProcessError, run_in_subprocess, SUBPROCESS, STREAMED_EVENTS, StreamedResult, StreamedHost
+from ansibledriver.model.progress_events import TaskCompletedOnHostEvent, TaskFailedOnHostEvent, PlaybookResultEvent
+from tests.unit.service.test_verbosity import RecordingEventLogger
+
+PLAYBOOK = '''---
+- hosts: all
+  gather_facts: no
+  tasks:
+  - name: first
+    set_fact:
+      output__first: "{{ inventory_hostname }}"
+  - name: second
+    set_fact:
+      output__second: "{{ inventory_hostname }}"
+'''
+
+FAILING_PLAYBOOK = '''---
+- hosts: all
+  gather_facts: no
+  tasks:
+  - name: fails
+    fail:
+      msg: failed on purpose
+'''
+
+
+class Unpicklable():
+
+    def __reduce__(self):
+        raise TypeError('not picklable')
+
+    def __str__(self):
+        raise TypeError('no string either')
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_frames_read_in_order(self):
+        read_fd, write_fd = os.pipe()
+        writer = FrameWriter(write_fd)
+        writer.write(1, {'msg': 'x' * 10000})
+        writer.write(254, True)
+        writer.close()
+        reader = FrameReader(read_fd)
+        self.assertEqual(reader.read(), (1, {'msg': 'x' * 10000}))
+        self.assertEqual(reader.read(), (254, True))
+        self.assertIsNone(reader.read())
+        reader.close()
+
+    def test_unpicklable_payload_sent_as_plain_data(self):
+        read_fd, write_fd = os.pipe()
+        writer = FrameWriter(write_fd)
+        writer.write(1, {'lock': [lambda: None]})
+        writer.close()
+        reader = FrameReader(read_fd)
+        frame_type, payload = reader.read()
+        self.assertIsInstance(payload['lock'][0], str)
+        reader.close()
+
+    def test_unpicklable_value_of_result_replaced(self):
+        result = StreamedResult.__new__(StreamedResult)
+        result._host = StreamedHost.__new__(StreamedHost)
+        result._host.name = 'host1'
+        result._result = {'msg': 'failed', 'failed': True, 'handle': lambda: None}
+        result._task_fields = {}
+        read_fd, write_fd = os.pipe()
+        writer = FrameWriter(write_fd)
+        writer.write(STREAMED_EVENTS.index('v2_runner_on_failed'), ((result,), {}))
+        writer.close()
+        reader = FrameReader(read_fd)
+        frame_type, (args, kwargs) = reader.read()
+        reader.close()
+        # the stand-in is kept, so the worker's callback still handles the failure
+        self.assertIsInstance(args[0], StreamedResult)
+        self.assertEqual(args[0]._host.get_name(), 'host1')
+        self.assertEqual(args[0]._result['msg'], 'failed')
+        self.assertTrue(args[0]._result['failed'])
+        self.assertIsInstance(args[0]._result['handle'], str)
+        self.assertIsNone(writer.error)
+
+
+class TestRunInSubprocess(unittest.TestCase):
+
+    def test_error_in_child(self):
+        def execute(stdout_callback):
+            raise ValueError('broken')
+        with self.assertRaises(PlaybookProcessError) as context_manager:
+            run_in_subprocess(execute, None)
+        self.assertEqual(str(context_manager.exception), 'Playbook process failed: broken')
+
+    def test_event_not_sent_fails_run(self):
+        def execute(stdout_callback):
+            try:
+                stdout_callback.writer.write(0, Unpicklable())
+            except Exception:
+                # as Ansible does for callbacks
+                pass
+            return True
+        with self.assertRaises(PlaybookProcessError) as context_manager:
+            run_in_subprocess(execute, None)
+        self.assertIn('Unable to send v2_playbook_on_play_start event', str(context_manager.exception))
+
+    def test_child_exits_unexpectedly(self):
+        def execute(stdout_callback):
+            os._exit(3)
+        with self.assertRaises(PlaybookProcessError) as context_manager:
+            run_in_subprocess(execute, None)
+        self.assertEqual(str(context_manager.exception), 'Playbook process exited unexpectedly with exit code 3')
+
+
+class TestSubprocessExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.inventory_path = os.path.join(self.tmp_dir, 'inventory')
+        with open(self.inventory_path, 'w') as f:
+            f.write('host1 ansible_connection=local\nhost2 ansible_connection=local\n')
+        self.properties = AnsibleProperties()
+        self.event_logger = RecordingEventLogger()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __playbook(self, content):
+        playbook_path = os.path.join(self.tmp_dir, 'Install.yaml')
+        with open(playbook_path, 'w') as f:
+            f.write(content)
+        return playbook_path
+
+    def __client(self):
+        property_groups = PropertyGroups()
+        property_groups.add_property_group(self.properties)
+        configuration = BootstrapApplicationConfiguration(app_name='test', property_sources=[], property_groups=property_groups, service_configurators=[], api_configurators=[], api_error_converter=None)
+        return AnsibleClient(configuration, templating=Jinja2TemplatingService(), render_context_service=ExtendedResourceTemplateContextService(), event_logger=self.event_logger)
+
+    def __run(self, playbook, executor, resume=None):
+        self.properties.playbook_executor = executor
+        self.event_logger.events = []
+        callback = self.__client().run_playbook('request', 'local', self.inventory_path, self.__playbook(playbook), 'Install', {}, resume=resume)
+        return callback, [type(event) for event in self.event_logger.events]
+
+    def test_same_outputs_and_events_as_in_process(self):
+        in_process, in_process_events = self.__run(PLAYBOOK, 'in_process')
+        cli_args = context.CLIARGS
+        subprocess, subprocess_events = self.__run(PLAYBOOK, SUBPROCESS)
+        # the playbook ran in another process
+        self.assertIs(context.CLIARGS, cli_args)
+        self.assertEqual(subprocess.get_result().status, STATUS_COMPLETE)
+        self.assertEqual(subprocess.get_result().outputs, in_process.get_result().outputs)
+        self.assertEqual(subprocess_events, in_process_events)
+        self.assertEqual(subprocess_events.count(TaskCompletedOnHostEvent), 4)
+        self.assertEqual(subprocess_events[-1], PlaybookResultEvent)
+        self.assertEqual(sorted(task['taskName'] for task in subprocess.get_result().slowest_tasks), ['first', 'second'])
+
+    def test_playbook_cache_skipped(self):
+        # the playbook process would hash the scripts for a cache that dies with it
+        with patch.object(PlaybookCache, 'content_hash', side_effect=AssertionError('scripts hashed')):
+            callback, events = self.__run(PLAYBOOK, SUBPROCESS)
+        self.assertEqual(callback.get_result().status, STATUS_COMPLETE)
+
+    def test_failed_task(self):
+        callback, events = self.__run(FAILING_PLAYBOOK, SUBPROCESS)
+        result = callback.get_result()
+        self.assertEqual(result.status, STATUS_FAILED)
+        self.assertEqual(result.failure_details.failure_code, FAILURE_CODE_INFRASTRUCTURE_ERROR)
+        self.assertIn('failed on purpose', result.failure_details.description)
+        self.assertEqual(events.count(TaskFailedOnHostEvent), 2)
+
+    def test_resume(self):
+        resume = {'task': 'second', 'hosts': ['host2'], 'properties': {'first': 'carried'}, 'associated_topology': None}
+        callback, events = self.__run(PLAYBOOK, SUBPROCESS, resume=resume)
+        self.assertTrue(callback.resumed)
+        self.assertEqual(callback.get_result().outputs, {'first': 'carried', 'second': 'host2'})
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from multiprocessing import Process
+from ansible import context
+from ignition.boot.config import BootstrapApplicationConfiguration, PropertyGroups
+from ignition.service.templating import Jinja2TemplatingService
+from ignition.utils.propvaluemap import PropValueMap
+from ansibledriver.service.ansible import AnsibleClient, AnsibleProperties
+from ansibledriver.service.rendercontext import ExtendedResourceTemplateContextService
+from ansibledriver.service.forks import ForkBudget, wanted_forks
+from tests.unit.service.test_verbosity import RecordingEventLogger
+
+PLAYBOOK = '''---
+- hosts: all
+  gather_facts: no
+  tasks:
+  - name: first
+    set_fact:
+      output__first: "{{ inventory_hostname }}"
+'''
+
+
+def acquire_in_child(budget, wanted):
+    budget.acquire(wanted)
+
+
+class TestForkBudget(unittest.TestCase):
+
+    def test_limits_forks_in_use(self):
+        budget = ForkBudget(10)
+        self.assertEqual(budget.acquire(8), 8)
+        self.assertEqual(budget.acquire(8), 2)
+        # always at least one
+        self.assertEqual(budget.acquire(8), 1)
+        budget.release(8)
+        self.assertEqual(budget.acquire(8), 7)
+
+    def test_shared_with_forked_processes(self):
+        budget = ForkBudget(10)
+        child = Process(target=acquire_in_child, args=(budget, 6))
+        child.start()
+        child.join()
+        self.assertEqual(budget.acquire(6), 4)
+
+    def test_unlimited(self):
+        budget = ForkBudget(0)
+        self.assertEqual(budget.acquire(100), 100)
+        self.assertEqual(budget.acquire(100), 100)
+
+
+class TestWantedForks(unittest.TestCase):
+
+    def test_by_host_count(self):
+        self.assertEqual(wanted_forks(20, 3), 3)
+        self.assertEqual(wanted_forks(20, 50), 20)
+        self.assertEqual(wanted_forks(20, 0), 1)
+
+    def test_resource_property_override(self):
+        resource_properties = PropValueMap({'playbook_forks': {'type': 'integer', 'value': 2}})
+        self.assertEqual(wanted_forks(20, 10, resource_properties), 2)
+        self.assertEqual(wanted_forks(20, 10, PropValueMap({'playbook_forks': {'type': 'string', 'value': 'many'}})), 10)
+
+
+class TestPlaybookForks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.playbook_path = os.path.join(self.tmp_dir, 'Install.yaml')
+        with open(self.playbook_path, 'w') as f:
+            f.write(PLAYBOOK)
+        self.inventory_path = os.path.join(self.tmp_dir, 'inventory')
+        with open(self.inventory_path, 'w') as f:
+            f.write('host1 ansible_connection=local\nhost2 ansible_connection=local\nhost3 ansible_connection=local\n')
+        self.properties = AnsibleProperties()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __client(self):
+        property_groups = PropertyGroups()
+        property_groups.add_property_group(self.properties)
+        configuration = BootstrapApplicationConfiguration(app_name='test', property_sources=[], property_groups=property_groups, service_configurators=[], api_configurators=[], api_error_converter=None)
+        return AnsibleClient(configuration, templating=Jinja2TemplatingService(), render_context_service=ExtendedResourceTemplateContextService(), event_logger=RecordingEventLogger())
+
+    def test_forks_by_host_count_within_budget(self):
+        self.properties.forks_budget = 4
+        client = self.__client()
+        client.fork_budget.acquire(2)
+        # the forks a run is given are in the CLI arguments of its executor
+        client.run_playbook('request', 'local', self.inventory_path, self.playbook_path, 'Install', {})
+        self.assertEqual(context.CLIARGS['forks'], 2)
+        self.properties.forks_budget = 0
+        client = self.__client()
+        client.run_playbook('request', 'local', self.inventory_path, self.playbook_path, 'Install', {})
+        self.assertEqual(context.CLIARGS['forks'], 3)
+        client.run_playbook('request', 'local', self.inventory_path, self.playbook_path, 'Install', {},
+            resource_properties=PropValueMap({'playbook_forks': {'type': 'integer', 'value': 1}}))
+        self.assertEqual(context.CLIARGS['forks'], 1)
+
+    def test_forks_given_back(self):
+        self.properties.forks_budget = 4
+        client = self.__client()
+        callback = client.run_playbook('request', 'local', self.inventory_path, self.playbook_path, 'Install', {})
+        self.assertEqual(callback.get_result().outputs, {'first': 'host3'})
+        self.assertEqual(client.fork_budget.in_use.value, 0)
+
+    def test_forks_given_back_when_executor_fails(self):
+        self.properties.forks_budget = 4
+        client = self.__client()
+        with patch('ansibledriver.service.ansible.PlaybookExecutor', side_effect=ValueError('broken playbook')):
+            with self.assertRaises(ValueError):
+                client.run_playbook('request', 'local', self.inventory_path, self.playbook_path, 'Install', {})
+        self.assertEqual(client.fork_budget.in_use.value, 0)
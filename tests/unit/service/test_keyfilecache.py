@@ -0,0 +1,134 @@
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from ignition.utils.propvaluemap import PropValueMap
+from ansibledriver.service.ansible import KeyPropertyProcessor
+from ansibledriver.service.keyfilecache import KeyFileCache
+from tests.unit.helpers import FakeClock
+
+
+def key_properties(private_key):
+    return PropValueMap({
+        'server_key': {'type': 'key', 'keyName': 'server', 'privateKey': private_key},
+        'host': {'type': 'string', 'value': 'server1'}
+    })
+
+
+class TestKeyFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.key_dir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.cache = KeyFileCache(self.key_dir, 60, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.key_dir, ignore_errors=True)
+
+    def test_same_key_shares_file(self):
+        path1 = self.cache.acquire('key1')
+        path2 = self.cache.acquire('key1')
+        other_path = self.cache.acquire('key2')
+        self.assertEqual(path1, path2)
+        self.assertNotEqual(path1, other_path)
+        self.assertEqual(os.path.dirname(path1), self.key_dir)
+        self.assertEqual(stat.S_IMODE(os.stat(path1).st_mode), 0o600)
+        with open(path1, 'r') as key_file:
+            self.assertEqual(key_file.read(), 'key1')
+
+    def test_unused_files_evicted_after_ttl(self):
+        path = self.cache.acquire('key1')
+        self.cache.acquire('key1')
+        self.cache.release(path)
+        self.clock.now = 120
+        self.cache.release(path)
+        # just released, so kept for the ttl
+        self.assertTrue(os.path.exists(path))
+        self.clock.now = 180
+        self.cache.acquire('key2')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_clear(self):
+        path = self.cache.acquire('key1')
+        self.cache.clear()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(self.cache), 0)
+
+    def __use_in_child(self, claim, sender):
+        if claim:
+            self.cache.claim()
+        path1 = self.cache.acquire('key1')
+        path2 = self.cache.acquire('key1')
+        self.cache.release(path1)
+        self.cache.release(path2)
+        cached = len(self.cache)
+        self.cache.clear()
+        sender.send((self.cache.enabled(), path1 == path2, cached))
+        sender.close()
+
+    def __run_in_child(self, claim):
+        receiver, sender = multiprocessing.Pipe(False)
+        child = multiprocessing.Process(target=self.__use_in_child, args=(claim, sender))
+        child.start()
+        sender.close()
+        result = receiver.recv()
+        child.join()
+        return result
+
+    def test_worker_claims_cache_created_before_fork(self):
+        self.assertEqual(self.__run_in_child(True), (True, True, 1))
+        # the files of the worker are removed when it clears the cache
+        self.assertEqual(os.listdir(self.key_dir), [])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_unclaimed_cache_bypassed_in_forked_process(self):
+        self.assertEqual(self.__run_in_child(False), (False, False, 0))
+        self.assertEqual(os.listdir(self.key_dir), [])
+
+    def test_disabled(self):
+        cache = KeyFileCache(self.key_dir, 0)
+        path1 = cache.acquire('key1')
+        path2 = cache.acquire('key1')
+        self.assertNotEqual(path1, path2)
+        cache.release(path1)
+        self.assertFalse(os.path.exists(path1))
+        self.assertTrue(os.path.exists(path2))
+        cache.release(path2)
+        self.assertEqual(os.listdir(self.key_dir), [])
+
+
+class TestKeyPropertyProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.key_dir = tempfile.mkdtemp()
+        self.cache = KeyFileCache(self.key_dir, 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.key_dir, ignore_errors=True)
+
+    def test_requests_with_same_key_share_file(self):
+        properties1 = key_properties('key1')
+        properties2 = key_properties('key1')
+        processor1 = KeyPropertyProcessor(properties1, PropValueMap({}), PropValueMap({}), key_file_cache=self.cache)
+        processor2 = KeyPropertyProcessor(properties2, PropValueMap({}), PropValueMap({}), key_file_cache=self.cache)
+        processor1.process_key_properties()
+        processor2.process_key_properties()
+        self.assertEqual(properties1.get('server_key_path'), properties2.get('server_key_path'))
+        self.assertEqual(properties1.get('server_key_name'), 'server')
+        processor1.clear_key_files()
+        processor2.clear_key_files()
+        # kept for the next request using the key
+        self.assertTrue(os.path.exists(properties1.get('server_key_path')))
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.key_dir), [])
+
+    def test_key_files_removed_without_cache(self):
+        properties = key_properties('key1')
+        processor = KeyPropertyProcessor(properties, PropValueMap({}), PropValueMap({}), key_file_cache=KeyFileCache(self.key_dir))
+        processor.process_key_properties()
+        self.assertTrue(os.path.exists(properties.get('server_key_path')))
+        processor.clear_key_files()
+        self.assertEqual(os.listdir(self.key_dir), [])
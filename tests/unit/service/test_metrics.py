@@ -0,0 +1,116 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from unittest.mock import MagicMock, patch
+from ansibledriver.service.metricsapi import MetricsApiService
+from ansibledriver.service.process import AnsibleRequestHandler, QueueTimingConsumer, time_request_queue
+import ansibledriver.service.metrics as metrics
+from ignition.model.lifecycle import LifecycleExecution, STATUS_COMPLETE
+from prometheus_client import multiprocess
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+
+
+def sample_value(name, labels):
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetricsApiService(unittest.TestCase):
+
+    def test_metrics(self):
+        body, status, headers = MetricsApiService().metrics()
+        self.assertEqual(status, 200)
+        self.assertEqual(headers, {'Content-Type': 'text/plain'})
+        self.assertIn('ald_process_pool_size', body)
+
+
+class TestQueueTimingConsumer(unittest.TestCase):
+
+    def test_notes_record_timestamp(self):
+        consumer = MagicMock()
+        consumer.poll.return_value = {'partition': [MagicMock(timestamp=1500)]}
+        request_queue = MagicMock(requests_consumer=consumer)
+        timing = time_request_queue(request_queue)
+        self.assertIs(request_queue.requests_consumer, timing)
+        # wrapping again returns the same consumer
+        self.assertIs(time_request_queue(request_queue), timing)
+        request_queue.requests_consumer.poll(timeout_ms=200, max_records=1)
+        consumer.poll.assert_called_once_with(timeout_ms=200, max_records=1)
+        self.assertEqual(timing.take_queued_at(), 1.5)
+        self.assertIsNone(timing.take_queued_at())
+        # other calls go to the consumer
+        request_queue.requests_consumer.assignment()
+        consumer.assignment.assert_called_once_with()
+
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def test_request_metrics(self):
+        ansible_client = MagicMock()
+        ansible_client.run_lifecycle_playbook.return_value = LifecycleExecution('1', STATUS_COMPLETE, None, {})
+        handler = AnsibleRequestHandler(MagicMock(), ansible_client)
+        handler.queue_timing = MagicMock()
+        handler.queue_timing.take_queued_at.return_value = time.time() - 5
+        handled = sample_value('ald_requests_total', {'lifecycle': 'MetricsTest', 'status': STATUS_COMPLETE})
+        waited = sample_value('ald_request_queue_wait_seconds_sum', {'lifecycle': 'MetricsTest'})
+        handler.handle_request({'request_id': '1', 'lifecycle_name': 'MetricsTest', 'driver_files': {}, 'tenant_id': '1'})
+        self.assertEqual(sample_value('ald_requests_total', {'lifecycle': 'MetricsTest', 'status': STATUS_COMPLETE}), handled + 1)
+        self.assertGreaterEqual(sample_value('ald_request_queue_wait_seconds_sum', {'lifecycle': 'MetricsTest'}) - waited, 5)
+        self.assertEqual(sample_value('ald_request_duration_seconds_count', {'lifecycle': 'MetricsTest'}), 1)
+
+
+class TestMetricsArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __record(self, pid, requests, duration_bucket):
+        counter = MmapedDict(os.path.join(self.path, 'counter_{0}.db'.format(pid)))
+        counter.write_value(mmap_key('ald_test_requests', 'ald_test_requests_total', ['lifecycle'], ['Install'], 'Requests'), requests, 0)
+        counter.close()
+        histogram = MmapedDict(os.path.join(self.path, 'histogram_{0}.db'.format(pid)))
+        histogram.write_value(mmap_key('ald_test_seconds', 'ald_test_seconds_bucket', ['le'], [duration_bucket], 'Seconds'), 1, 0)
+        histogram.write_value(mmap_key('ald_test_seconds', 'ald_test_seconds_sum', [], [], 'Seconds'), 1, 0)
+        histogram.close()
+        gauge = MmapedDict(os.path.join(self.path, 'gauge_livesum_{0}.db'.format(pid)))
+        gauge.write_value(mmap_key('ald_test_active', 'ald_test_active', [], [], 'Active'), 1, 0)
+        gauge.close()
+
+    def __samples(self):
+        registry = metrics.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=self.path)
+        return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value for metric in registry.collect() for sample in metric.samples}
+
+    def __dead_pid(self):
+        child = multiprocessing.Process(target=time.sleep, args=(0,))
+        child.start()
+        child.join()
+        return child.pid
+
+    def test_values_of_exited_processes_kept(self):
+        self.__record(101, 2, '1.0')
+        self.__record(102, 3, '5.0')
+        before = self.__samples()
+        metrics.archive_process(101, self.path)
+        metrics.archive_process(102, self.path)
+        self.assertEqual(sorted(os.listdir(self.path)), ['archive.lock', 'counter_archive.db', 'gauge_livesum_101.db', 'gauge_livesum_102.db', 'histogram_archive.db'])
+        after = self.__samples()
+        self.assertEqual(after, before)
+        self.assertEqual(after[('ald_test_requests_total', (('lifecycle', 'Install'),))], 5)
+        self.assertEqual(after[('ald_test_seconds_count', ())], 2)
+
+    def test_exited_processes_found(self):
+        dead_pid = self.__dead_pid()
+        self.__record(dead_pid, 2, '1.0')
+        self.__record(os.getpid(), 3, '1.0')
+        metrics.archive_exited_processes(self.path)
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(['archive.lock', 'counter_archive.db', 'histogram_archive.db',
+            'counter_{0}.db'.format(os.getpid()), 'histogram_{0}.db'.format(os.getpid()), 'gauge_livesum_{0}.db'.format(os.getpid())]))
+        samples = self.__samples()
+        self.assertEqual(samples[('ald_test_requests_total', (('lifecycle', 'Install'),))], 5)
+        self.assertEqual(samples[('ald_test_active', ())], 1)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from unittest.mock import patch
+import uuid
+import pathlib
+from ansible.parsing.dataloader import DataLoader
+from ansibledriver.service.playbookcache import PlaybookCache
+
+RESOURCES = os.path.join(str(pathlib.Path(__file__).parent.absolute()), '..', '..', 'resources')
+
+
+class TestPlaybookCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __copy_scripts(self, package='ansible'):
+        dst = os.path.join(self.tmp_dir, str(uuid.uuid4()))
+        shutil.copytree(os.path.join(RESOURCES, package, 'scripts'), dst)
+        return dst
+
+    def __parse(self, cache, scripts_path):
+        loader = DataLoader()
+        key = cache.load(loader, scripts_path)
+        data = loader.load_from_file(os.path.join(scripts_path, 'install.yaml'))
+        cache.save(key, loader, scripts_path)
+        return data
+
+    @patch('ansibledriver.service.playbookcache.metrics')
+    def test_reuses_parsed_playbook_from_another_copy_of_the_scripts(self, metrics):
+        cache = PlaybookCache(2)
+        first_path = self.__copy_scripts()
+        first = self.__parse(cache, first_path)
+        self.assertEqual(metrics.playbook_cache_misses.inc.call_count, 1)
+
+        second_path = self.__copy_scripts()
+        loader = DataLoader()
+        cache.load(loader, second_path)
+        self.assertEqual(metrics.playbook_cache_hits.inc.call_count, 1)
+        playbook_path = os.path.join(second_path, 'install.yaml')
+        self.assertIn(playbook_path, loader._FILE_CACHE)
+        # the file is not read again
+        os.remove(playbook_path)
+        second = loader.load_from_file(playbook_path)
+        self.assertEqual(second, first)
+        # positions are reported against the new copy of the scripts
+        self.assertEqual(second[0].ansible_pos[0], playbook_path)
+
+    @patch('ansibledriver.service.playbookcache.metrics')
+    def test_changed_scripts_are_parsed_again(self, metrics):
+        cache = PlaybookCache(2)
+        self.__parse(cache, self.__copy_scripts())
+        changed_path = self.__copy_scripts()
+        with open(os.path.join(changed_path, 'install.yaml'), 'a') as f:
+            f.write('\n# changed\n')
+        self.__parse(cache, changed_path)
+        metrics.playbook_cache_hits.inc.assert_not_called()
+        self.assertEqual(metrics.playbook_cache_misses.inc.call_count, 2)
+
+    def test_vars_files_are_not_cached(self):
+        cache = PlaybookCache(2)
+        scripts_path = self.__copy_scripts()
+        os.makedirs(os.path.join(scripts_path, 'host_vars'))
+        vars_path = os.path.join(scripts_path, 'host_vars', 'test-host.yml')
+        with open(vars_path, 'w') as f:
+            f.write('a: 1\n')
+        loader = DataLoader()
+        key = cache.load(loader, scripts_path)
+        loader.load_from_file(vars_path, unsafe=True)
+        loader.load_from_file(os.path.join(scripts_path, 'install.yaml'))
+        cache.save(key, loader, scripts_path)
+        self.assertEqual(list(cache.entries.peek(key)['files'].keys()), ['install.yaml'])
+
+    @patch('ansibledriver.service.playbookcache.metrics')
+    def test_disabled(self, metrics):
+        cache = PlaybookCache(0)
+        scripts_path = self.__copy_scripts()
+        self.__parse(cache, scripts_path)
+        self.assertEqual(len(cache.entries), 0)
+        metrics.playbook_cache_misses.inc.assert_not_called()
+
+    def __parse_in_child(self, cache, claim, sender):
+        if claim:
+            cache.claim()
+        self.__parse(cache, self.__copy_scripts())
+        sender.send((cache.enabled(), len(cache.entries)))
+        sender.close()
+
+    def __run_in_child(self, cache, claim):
+        receiver, sender = multiprocessing.Pipe(False)
+        child = multiprocessing.Process(target=self.__parse_in_child, args=(cache, claim, sender))
+        child.start()
+        sender.close()
+        result = receiver.recv()
+        child.join()
+        return result
+
+    def test_worker_claims_cache_created_before_fork(self):
+        self.assertEqual(self.__run_in_child(PlaybookCache(2), True), (True, 1))
+
+    def test_unclaimed_cache_bypassed_in_forked_process(self):
+        self.assertEqual(self.__run_in_child(PlaybookCache(2), False), (False, 0))
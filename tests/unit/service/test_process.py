@@ -16,8 +16,10 @@ from ignition.model.failure import FailureDetails, FAILURE_CODE_INFRASTRUCTURE_E
 from ignition.utils.file import DirectoryTree
 from ignition.utils.propvaluemap import PropValueMap
 from ignition.service.requestqueue import KafkaRequestQueueHandler
-from ansibledriver.service.process import AnsibleProcessorService, ProcessProperties, AnsibleProcess, AnsibleRequestHandler
+from ansibledriver.service.process import AnsibleProcessorService, ProcessProperties, AnsibleProcess, AnsibleRequestHandler, ConcurrentAnsibleRequestHandler, WorkerState, process_rss_bytes
 from ansibledriver.service.ansible import AnsibleProperties
+from ansibledriver.service.scheduling import SharedCounters
+from ansibledriver.service.supervision import RequestJournal
 from testfixtures import compare
 
 logger = logging.getLogger(__name__)
@@ -25,6 +27,16 @@ logger.setLevel(logging.DEBUG)
 stream_handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(stream_handler)
 
+
+def lifecycle_request(request_id, driver_files=None):
+    return {
+      'request_id': request_id,
+      'lifecycle_name': 'Install',
+      'driver_files': driver_files if driver_files is not None else {},
+      'tenant_id': '1234'
+    }
+
+
 # PickableMock is needed to be able to make MagicMocks with multiprocessing queues pickling
 # see https://github.com/testing-cabal/mock/issues/139#issuecomment-122128815
 class PickableMock(MagicMock):
@@ -218,3 +230,340 @@ class TestKafkaRequestQueueHandler(KafkaRequestQueueHandler):
 
     def close(self):
       self.closed = True
+
+
+class FakeAnsibleProcess():
+    def __init__(self, name, request_queue, sigchld_handler, shutdown_event, worker_state=None, request_handler=None):
+      self.name = name
+      self.request_queue = request_queue
+      self.worker_state = worker_state
+      self.request_handler = request_handler
+      self.started = False
+      self.pid = None
+      self.exitcode = None
+
+    def start(self):
+      self.started = True
+
+    def is_alive(self):
+      return self.started and self.exitcode is None and not self.worker_state.retire_event.is_set()
+
+    def join(self):
+      pass
+
+
+@patch('ansibledriver.service.process.AnsibleProcess', new=FakeAnsibleProcess)
+class TestProcessPoolScaling(unittest.TestCase):
+
+    def setUp(self):
+        property_groups = PropertyGroups()
+        property_groups.add_property_group(AnsibleProperties())
+        self.process_props = ProcessProperties()
+        self.process_props.process_pool_size = 1
+        self.process_props.autoscale_enabled = True
+        self.process_props.min_process_pool_size = 1
+        self.process_props.max_process_pool_size = 2
+        self.process_props.worker_idle_seconds = 60
+        self.process_props.pool_monitor_interval_seconds = 3600
+        self.process_props.worker_supervisor_interval_seconds = 3600
+        property_groups.add_property_group(self.process_props)
+        self.configuration = BootstrapApplicationConfiguration(app_name='test', property_sources=[], property_groups=property_groups, service_configurators=[], api_configurators=[], api_error_converter=None)
+        self.service = AnsibleProcessorService(self.configuration, ansible_client=MagicMock(), request_queue_service=MagicMock(), messaging_service=MagicMock())
+
+    def tearDown(self):
+        self.service.shutdown()
+
+    def test_initial_pool_size_bounded_by_max(self):
+        self.process_props.process_pool_size = 5
+        self.assertEqual(self.service.initial_pool_size(), 2)
+
+    def test_scale_up_on_queue_lag(self):
+        self.assertEqual(len(self.service.active_workers()), 1)
+        self.service.pool[0].worker_state.queue_lag.value = 3
+        self.service.maintain_pool()
+        self.assertEqual(len(self.service.active_workers()), 2)
+        self.assertEqual(self.service.pool[1].name, 'AnsiblePoolProcess1')
+        # never grows beyond max_process_pool_size
+        self.service.maintain_pool()
+        self.assertEqual(len(self.service.active_workers()), 2)
+
+    def test_retire_idle_worker(self):
+        self.service.spawn_worker()
+        busy_worker, idle_worker = self.service.pool
+        busy_worker.worker_state.active_requests.value = 1
+        idle_worker.worker_state.last_active.value = time.time() - 120
+        self.service.maintain_pool()
+        self.assertEqual(self.service.active_workers(), [busy_worker])
+        self.assertTrue(idle_worker.worker_state.retire_event.is_set())
+        # retired worker is removed once it has exited
+        self.service.maintain_pool()
+        self.assertEqual(self.service.pool, [busy_worker])
+        # never shrinks below min_process_pool_size
+        busy_worker.worker_state.active_requests.value = 0
+        busy_worker.worker_state.last_active.value = time.time() - 120
+        self.service.maintain_pool()
+        self.assertEqual(self.service.active_workers(), [busy_worker])
+
+    def test_recycle_worker_after_max_requests(self):
+        self.process_props.worker_max_requests = 10
+        worker = self.service.pool[0]
+        worker.worker_state.requests_handled.value = 9
+        self.service.maintain_pool()
+        self.assertEqual(self.service.active_workers(), [worker])
+        worker.worker_state.requests_handled.value = 10
+        self.service.maintain_pool()
+        # the replacement is started before the worker is retired
+        self.assertTrue(worker.worker_state.retire_event.is_set())
+        self.assertEqual([w.name for w in self.service.active_workers()], ['AnsiblePoolProcess1'])
+        self.assertTrue(self.service.active_workers()[0].started)
+
+    def test_recycle_worker_over_max_rss(self):
+        self.process_props.worker_max_rss_mb = 100
+        worker = self.service.pool[0]
+        worker.worker_state.rss_bytes.value = 99 * 1024 * 1024
+        self.service.maintain_pool()
+        self.assertFalse(worker.worker_state.retire_event.is_set())
+        worker.worker_state.rss_bytes.value = 101 * 1024 * 1024
+        self.service.maintain_pool()
+        self.assertTrue(worker.worker_state.retire_event.is_set())
+        self.assertEqual(len(self.service.active_workers()), 1)
+
+    def test_restart_dead_worker(self):
+        worker = self.service.spawn_worker()
+        committed_request = lifecycle_request('1', driver_files=DirectoryTree(tempfile.mkdtemp()))
+        worker.request_handler.handle_request = MagicMock()
+        worker.request_handler.journal.add(committed_request)
+        worker.request_handler.journal.commit()
+        uncommitted_request = lifecycle_request('2', driver_files=DirectoryTree(tempfile.mkdtemp()))
+        worker.request_handler.journal.add(uncommitted_request)
+        worker.exitcode = -signal.SIGKILL
+        self.service.supervise_workers()
+        self.assertEqual([w.name for w in self.service.active_workers()], ['AnsiblePoolProcess0', 'AnsiblePoolProcess2'])
+        self.assertFalse(os.path.exists(worker.request_handler.journal.journal_dir))
+        # the committed request is failed, the other is left to be redelivered by the request queue
+        self.service.messaging_service.send_lifecycle_execution.assert_called_once()
+        name, args, kwargs = self.service.messaging_service.send_lifecycle_execution.mock_calls[0]
+        compare(args[0], LifecycleExecution('1', STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR, "Driver worker exited (SIGKILL) before the request finished"), {}))
+        self.assertEqual(kwargs, {'tenant_id': '1234'})
+        self.assertFalse(os.path.exists(committed_request['driver_files'].root_path))
+        self.assertFalse(os.path.exists(uncommitted_request['driver_files'].root_path))
+
+    def test_restart_backoff(self):
+        self.service.spawn_worker().exitcode = 1
+        self.service.supervise_workers()
+        self.assertEqual(len(self.service.active_workers()), 2)
+        # the second death in a row waits for the backoff
+        self.service.pool[1].exitcode = 1
+        self.service.supervise_workers()
+        self.assertEqual(len(self.service.active_workers()), 1)
+        self.assertEqual(len(self.service.pending_restarts), 1)
+        self.service.pending_restarts = [0]
+        self.service.supervise_workers()
+        self.assertEqual(len(self.service.active_workers()), 2)
+
+    def test_dead_worker_releases_slots(self):
+        self.service.tenant_counters = SharedCounters()
+        self.service.location_counters = SharedCounters()
+        self.service.tenant_counters.try_acquire('tenant1', 0)
+        self.service.location_counters.try_acquire('name:Openstack:core', 0)
+        worker = self.service.spawn_worker()
+        request = lifecycle_request('1', driver_files=DirectoryTree(tempfile.mkdtemp()))
+        worker.request_handler.journal.add(request)
+        worker.request_handler.journal.hold_slots(request, ('tenant1', 'name:Openstack:core'))
+        worker.exitcode = -signal.SIGSEGV
+        self.service.supervise_workers()
+        self.assertEqual(self.service.tenant_counters.get('tenant1'), 0)
+        self.assertEqual(self.service.location_counters.get('name:Openstack:core'), 0)
+
+    def test_no_restart_when_disabled(self):
+        self.process_props.worker_restart_enabled = False
+        self.service.spawn_worker().exitcode = 1
+        self.service.supervise_workers()
+        self.assertEqual(len(self.service.pool), 1)
+
+    def test_no_recycling_by_default(self):
+        worker = self.service.pool[0]
+        worker.worker_state.requests_handled.value = 1000000
+        worker.worker_state.rss_bytes.value = 1024 * 1024 * 1024 * 10
+        self.service.maintain_pool()
+        self.assertEqual(self.service.active_workers(), [worker])
+
+
+@patch('ansibledriver.service.process.AnsibleProcess', new=FakeAnsibleProcess)
+class TestWarmWorkerTemplate(unittest.TestCase):
+
+    def setUp(self):
+        property_groups = PropertyGroups()
+        property_groups.add_property_group(AnsibleProperties())
+        self.process_props = ProcessProperties()
+        self.process_props.process_pool_size = 1
+        self.process_props.pool_monitor_interval_seconds = 3600
+        self.process_props.worker_supervisor_interval_seconds = 3600
+        property_groups.add_property_group(self.process_props)
+        self.configuration = BootstrapApplicationConfiguration(app_name='test', property_sources=[], property_groups=property_groups, service_configurators=[], api_configurators=[], api_error_converter=None)
+        self.ansible_client = MagicMock()
+
+    @patch('ansibledriver.service.process.gc')
+    def test_warm_worker_template(self, mock_gc):
+        self.process_props.warm_worker_template = True
+        service = AnsibleProcessorService(self.configuration, ansible_client=self.ansible_client, request_queue_service=MagicMock(), messaging_service=MagicMock())
+        service.shutdown()
+        self.ansible_client.warm_up.assert_called_once()
+        mock_gc.assert_has_calls([call.collect(), call.freeze()])
+
+    @patch('ansibledriver.service.process.gc')
+    def test_no_warm_worker_template(self, mock_gc):
+        self.process_props.warm_worker_template = False
+        service = AnsibleProcessorService(self.configuration, ansible_client=self.ansible_client, request_queue_service=MagicMock(), messaging_service=MagicMock())
+        service.shutdown()
+        self.ansible_client.warm_up.assert_not_called()
+        mock_gc.freeze.assert_not_called()
+
+
+class TestWorkerRecycling(unittest.TestCase):
+
+    def test_counts_requests_handled(self):
+        worker_state = WorkerState()
+        ansible_client = MagicMock()
+        ansible_client.run_lifecycle_playbook.return_value = LifecycleExecution('1', STATUS_COMPLETE, None, {})
+        handler = AnsibleRequestHandler(MagicMock(), ansible_client, worker_state=worker_state)
+        handler.handle_request(lifecycle_request('1'))
+        handler.handle_request(lifecycle_request('2'))
+        self.assertEqual(worker_state.requests_handled.value, 2)
+        self.assertEqual(handler.pending_requests(), 0)
+
+    def test_retiring_worker_exits_once_pending_requests_finished(self):
+        worker_state = WorkerState()
+        handler = AnsibleRequestHandler(MagicMock(), MagicMock(), worker_state=worker_state)
+        worker = AnsibleProcess('Test', MagicMock(), signal.SIG_IGN, multiprocessing.Event(), worker_state=worker_state, request_handler=handler)
+        self.assertFalse(worker.retired())
+        worker_state.retire_event.set()
+        worker_state.active_requests.value = 1
+        self.assertFalse(worker.retired())
+        worker_state.active_requests.value = 0
+        self.assertTrue(worker.retired())
+
+    def test_journals_requests_until_finished(self):
+        ansible_client = MagicMock()
+        ansible_client.run_lifecycle_playbook.return_value = LifecycleExecution('1', STATUS_COMPLETE, None, {})
+        handler = AnsibleRequestHandler(MagicMock(), ansible_client)
+        handler.journal = RequestJournal.create()
+        try:
+          handler.journal.add = MagicMock(wraps=handler.journal.add)
+          handler.handle_request(lifecycle_request('1'))
+          handler.journal.add.assert_called_once()
+          self.assertEqual(len(handler.journal), 0)
+        finally:
+          handler.journal.close()
+
+    def test_worker_claims_ansible_client_caches(self):
+        ansible_client = MagicMock()
+        handler = AnsibleRequestHandler(MagicMock(), ansible_client)
+        handler.worker_started()
+        ansible_client.worker_started.assert_called_once_with()
+
+    def test_process_rss_bytes(self):
+        self.assertGreater(process_rss_bytes(), 0)
+        self.assertGreater(process_rss_bytes(os.getpid()), 0)
+        self.assertEqual(process_rss_bytes('missing'), 0)
+
+
+class SleepingAnsibleClient():
+    def __init__(self, sleep_seconds):
+      self.sleep_seconds = sleep_seconds
+
+    def run_lifecycle_playbook(self, request):
+      time.sleep(self.sleep_seconds)
+      return LifecycleExecution(request['request_id'], STATUS_COMPLETE, None, {'pid': os.getpid()})
+
+    def playbook_process_exited(self):
+      pass
+
+    def close(self):
+      pass
+
+
+class ExitingAnsibleClient():
+    def run_lifecycle_playbook(self, request):
+      os._exit(3)
+
+    def playbook_process_exited(self):
+      pass
+
+    def close(self):
+      pass
+
+
+class RaisingAnsibleClient():
+    def run_lifecycle_playbook(self, request):
+      raise ValueError('Unable to read playbook')
+
+    def playbook_process_exited(self):
+      pass
+
+    def close(self):
+      pass
+
+
+class UnpicklableResultAnsibleClient():
+    def run_lifecycle_playbook(self, request):
+      return LifecycleExecution(request['request_id'], STATUS_COMPLETE, None, {'lock': threading.Lock()})
+
+    def playbook_process_exited(self):
+      pass
+
+    def close(self):
+      pass
+
+
+class TestConcurrentAnsibleRequestHandler(unittest.TestCase):
+
+    def test_handles_requests_concurrently_in_child_processes(self):
+        messaging_service = MagicMock()
+        worker_state = WorkerState()
+        handler = ConcurrentAnsibleRequestHandler(messaging_service, SleepingAnsibleClient(1), 2, worker_state=worker_state)
+        start = time.time()
+        handler.handle_request(lifecycle_request('1'))
+        handler.handle_request(lifecycle_request('2'))
+        self.assertEqual(worker_state.active_requests.value, 2)
+        handler.close()
+        self.assertLess(time.time() - start, 1.9)
+        self.assertEqual(worker_state.active_requests.value, 0)
+        self.assertEqual(messaging_service.send_lifecycle_execution.call_count, 2)
+        results = sorted([c[1][0] for c in messaging_service.send_lifecycle_execution.mock_calls], key=lambda r: r.request_id)
+        self.assertEqual([r.request_id for r in results], ['1', '2'])
+        self.assertEqual([r.status for r in results], [STATUS_COMPLETE, STATUS_COMPLETE])
+        self.assertNotEqual(results[0].outputs['pid'], os.getpid())
+
+    def test_metrics_of_request_processes_archived(self):
+        handler = ConcurrentAnsibleRequestHandler(MagicMock(), SleepingAnsibleClient(0), 2)
+        with patch('ansibledriver.service.process.metrics.process_exited') as process_exited:
+            handler.handle_request(lifecycle_request('1'))
+            handler.close()
+        process_exited.assert_called_once_with(ANY)
+        self.assertNotEqual(process_exited.call_args[0][0], os.getpid())
+
+    def test_fails_request_with_error_of_playbook_process(self):
+        messaging_service = MagicMock()
+        handler = ConcurrentAnsibleRequestHandler(messaging_service, RaisingAnsibleClient(), 2)
+        handler.handle_request(lifecycle_request('1'))
+        handler.close()
+        name, args, kwargs = messaging_service.send_lifecycle_execution.mock_calls[0]
+        compare(args[0], LifecycleExecution('1', STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR, "Unable to read playbook"), {}))
+
+    def test_fails_request_when_result_cannot_be_returned(self):
+        messaging_service = MagicMock()
+        handler = ConcurrentAnsibleRequestHandler(messaging_service, UnpicklableResultAnsibleClient(), 2)
+        handler.handle_request(lifecycle_request('1'))
+        handler.close()
+        name, args, kwargs = messaging_service.send_lifecycle_execution.mock_calls[0]
+        self.assertEqual(args[0].status, STATUS_FAILED)
+        self.assertIn('pickle', args[0].failure_details.description)
+
+    def test_fails_request_when_playbook_process_dies(self):
+        messaging_service = MagicMock()
+        handler = ConcurrentAnsibleRequestHandler(messaging_service, ExitingAnsibleClient(), 2)
+        handler.handle_request(lifecycle_request('1'))
+        handler.close()
+        name, args, kwargs = messaging_service.send_lifecycle_execution.mock_calls[0]
+        compare(args[0], LifecycleExecution('1', STATUS_FAILED, FailureDetails(FAILURE_CODE_INTERNAL_ERROR, "Playbook process exited unexpectedly with exit code 3"), {}))
@@ -0,0 +1,211 @@
+import json
+import threading
+import unittest
+import multiprocessing
+import yaml
+from unittest.mock import MagicMock, patch
+from ignition.service.config import ConfigurationPropertiesGroup
+from ignition.service.logging import logging_context
+from ansible.parsing.yaml.objects import AnsibleUnicode
+from ansibledriver.service.progress_events import BufferedProgressEventLogWriter, ProgressEventLogProperties, AnsibleYAMLProgressEventLogSerializer
+from ansibledriver.model.progress_events import PlaybookResultEvent, TaskCompletedOnHostEvent, TaskResultView
+
+
+class BlockingSerializer():
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.serialized = []
+
+    def serialize(self, event):
+        self.release.wait()
+        self.serialized.append((event.plays, logging_context.get('tracectx.transactionid')))
+        return 'event'
+
+
+class TestBufferedProgressEventLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = ProgressEventLogProperties()
+        self.properties.buffer_enabled = True
+        self.properties.buffer_size = 3
+        self.properties.batch_size = 2
+        self.properties.flush_interval_seconds = 0.05
+        self.configuration = MagicMock()
+        self.configuration.property_groups.get_property_group.return_value = self.properties
+        self.serializer = BlockingSerializer()
+
+    def tearDown(self):
+        logging_context.clear()
+
+    def __writer(self):
+        return BufferedProgressEventLogWriter(self.configuration, self.serializer)
+
+    def __add_events(self, writer, count):
+        for i in range(count):
+            writer.add(PlaybookResultEvent(plays=[i], host_stats={}))
+
+    def test_writes_synchronously_when_buffer_disabled(self):
+        self.properties.buffer_enabled = False
+        self.serializer.release.set()
+        writer = self.__writer()
+        self.__add_events(writer, 2)
+        self.assertEqual(self.serializer.serialized, [([0], ''), ([1], '')])
+        self.assertIsNone(writer.flusher)
+
+    def test_flush_writes_events_with_their_logging_context(self):
+        self.serializer.release.set()
+        writer = self.__writer()
+        logging_context.set_from_dict({'tracectx.transactionid': 'tx1'})
+        self.__add_events(writer, 5)
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(self.serializer.serialized, [([i], 'tx1') for i in range(5)])
+
+    def test_drop_oldest(self):
+        self.properties.overflow_policy = 'drop_oldest'
+        writer = self.__writer()
+        # the flusher takes the first event(s) and blocks serializing them, the rest fill the buffer
+        self.__add_events(writer, 10)
+        self.serializer.release.set()
+        self.assertTrue(writer.flush(timeout=5))
+        written = [plays[0] for plays, context in self.serializer.serialized]
+        self.assertEqual(written[-3:], [7, 8, 9])
+        self.assertLess(len(written), 10)
+
+    def test_sample(self):
+        self.properties.overflow_policy = 'sample'
+        self.properties.sample_rate = 2
+        self.properties.batch_size = 100
+        self.properties.flush_interval_seconds = 10
+        writer = self.__writer()
+        self.__add_events(writer, 7)
+        self.serializer.release.set()
+        self.assertTrue(writer.flush(timeout=5))
+        # events 3-6 overflow, 1 in 2 of them are kept in place of the oldest buffered event
+        self.assertEqual([plays[0] for plays, context in self.serializer.serialized], [2, 4, 6])
+
+    def test_block_waits_for_space(self):
+        writer = self.__writer()
+        adder = threading.Thread(target=self.__add_events, args=(writer, 10))
+        adder.start()
+        adder.join(0.2)
+        self.assertTrue(adder.is_alive())
+        self.serializer.release.set()
+        adder.join(5)
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual([plays[0] for plays, context in self.serializer.serialized], list(range(10)))
+
+    def test_flush_timeout(self):
+        writer = self.__writer()
+        self.__add_events(writer, 1)
+        self.assertFalse(writer.flush(timeout=0.1))
+        self.serializer.release.set()
+        self.assertTrue(writer.flush(timeout=5))
+
+    def __add_in_child(self, writer, sender):
+        self.__add_events(writer, 3)
+        sender.send(writer.flush(timeout=5))
+        sender.close()
+
+    def test_forked_process_uses_its_own_condition(self):
+        self.serializer.release.set()
+        writer = self.__writer()
+        self.__add_events(writer, 1)
+        receiver, sender = multiprocessing.Pipe(False)
+        # the child is forked while another thread (as the flusher may) holds the condition
+        held = threading.Event()
+        release = threading.Event()
+        def hold_condition():
+            with writer.condition:
+                held.set()
+                release.wait(5)
+        holder = threading.Thread(target=hold_condition)
+        holder.start()
+        held.wait(5)
+        child = multiprocessing.Process(target=self.__add_in_child, args=(writer, sender))
+        child.start()
+        release.set()
+        holder.join()
+        sender.close()
+        child.join(10)
+        if child.is_alive():
+            child.terminate()
+            self.fail('Forked process blocked on the condition of its parent')
+        self.assertTrue(receiver.recv())
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(self.serializer.serialized, [([0], '')])
+
+    def test_invalid_overflow_policy(self):
+        self.properties.overflow_policy = 'ignore'
+        with self.assertRaises(ValueError) as context:
+            self.__writer()
+        self.assertEqual(str(context.exception), 'Invalid progress event overflow_policy ignore, expected one of (\'block\', \'drop_oldest\', \'sample\')')
+
+
+class TestAnsibleYAMLProgressEventLogSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = ProgressEventLogProperties()
+        self.configuration = MagicMock()
+        self.configuration.property_groups.get_property_group.return_value = self.properties
+        self.event = TaskCompletedOnHostEvent(AnsibleUnicode('Install packages'), 'host1', {
+            'msg': AnsibleUnicode('All items completed'),
+            'changed': True,
+            'results': [{'msg': AnsibleUnicode('Installed gcc'), 'rc': 0}]
+        }, item_label=AnsibleUnicode('gcc'))
+
+    def __serializer(self, serializer_format):
+        self.properties.serializer_format = serializer_format
+        return AnsibleYAMLProgressEventLogSerializer(self.configuration)
+
+    def test_defaults_to_yaml(self):
+        serializer = AnsibleYAMLProgressEventLogSerializer()
+        self.assertEqual(serializer.serializer_format, 'yaml')
+        self.assertEqual(yaml.safe_load(serializer.serialize(self.event)), self.event.to_dict())
+
+    def test_yaml_c_output_matches_yaml(self):
+        self.assertEqual(self.__serializer('yaml_c').serialize(self.event), self.__serializer('yaml').serialize(self.event))
+
+    def test_json(self):
+        serialized = self.__serializer('json').serialize(self.event)
+        self.assertEqual(json.loads(serialized), self.event.to_dict())
+
+    def test_invalid_serializer_format(self):
+        with self.assertRaises(ValueError) as context:
+            self.__serializer('xml')
+        self.assertEqual(str(context.exception), 'Invalid progress event serializer_format xml, expected one of (\'yaml\', \'yaml_c\', \'json\')')
+
+
+class TestTaskResultView(unittest.TestCase):
+
+    def __task_result(self, items):
+        return {'msg': 'All items completed', 'changed': True, 'results': [{'msg': 'item {0}'.format(i), 'rc': 0} for i in range(items)]}
+
+    def test_converted_when_serialized(self):
+        task_result = self.__task_result(2)
+        event = TaskCompletedOnHostEvent('task', 'host1', TaskResultView(task_result))
+        # later changes to the result are seen, as nothing is copied before serializing
+        task_result['rc'] = 0
+        self.assertEqual(event._details()['taskResult'], {
+            'msg': 'All items completed', 'changed': True, 'failed': None, 'skipped': None, 'rc': 0,
+            'results': [{'msg': 'item {0}'.format(i), 'changed': None, 'failed': None, 'skipped': None, 'rc': 0, 'results': []} for i in range(2)]
+        })
+
+    def test_plain_task_result_is_not_limited(self):
+        event = TaskCompletedOnHostEvent('task', 'host1', self.__task_result(5))
+        self.assertEqual(len(event._details()['taskResult']['results']), 5)
+
+    def test_results_truncated(self):
+        converted = TaskResultView(self.__task_result(5), max_results=2).to_dict()
+        self.assertEqual([r['msg'] for r in converted['results']], ['item 0', 'item 1'])
+        self.assertEqual(converted['resultsTruncated'], 3)
+
+    def test_msg_truncated(self):
+        task_result = {'msg': 'x' * 10, 'results': [{'msg': 'y' * 5}, {'msg': 'z' * 3}]}
+        converted = TaskResultView(task_result, max_msg_length=4).to_dict()
+        self.assertEqual(converted['msg'], 'xxxx...')
+        self.assertEqual(converted['msgTruncatedCharacters'], 6)
+        self.assertEqual(converted['results'][0]['msg'], 'yyyy...')
+        self.assertEqual(converted['results'][0]['msgTruncatedCharacters'], 1)
+        self.assertEqual(converted['results'][1]['msg'], 'zzz')
+        self.assertNotIn('msgTruncatedCharacters', converted['results'][1])
@@ -0,0 +1,211 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from ignition.boot.config import BootstrapApplicationConfiguration, PropertyGroups
+from ignition.service.templating import Jinja2TemplatingService
+from ignition.model.lifecycle import LifecycleExecution, STATUS_COMPLETE, STATUS_FAILED
+from ignition.model.failure import FailureDetails, FAILURE_CODE_RESOURCE_NOT_FOUND
+from ansibledriver.service.ansible import AnsibleClient, AnsibleProperties, ResultCallback
+from ansibledriver.service.rendercontext import ExtendedResourceTemplateContextService
+from ansibledriver.service.process import AnsibleRequestHandler, WorkerState
+from ansibledriver.service.retry import UnreachableRetry, UnreachableRetryPolicy, RetryBudget, DelayedRetryQueue, UNREACHABLE_RETRY_STATE
+import ansibledriver.service.metrics as metrics
+from tests.unit.service.test_verbosity import RecordingEventLogger, mock_task, mock_result
+from tests.unit.helpers import FakeClock
+
+PLAYBOOK = '''---
+- hosts: all
+  gather_facts: no
+  tasks:
+  - name: first
+    set_fact:
+      output__first: "{{ inventory_hostname }}"
+  - name: second
+    set_fact:
+      output__second: "{{ inventory_hostname }}"
+'''
+
+
+class TestUnreachableRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = AnsibleProperties()
+        self.properties.unreachable_sleep_seconds = 5
+        self.properties.unreachable_backoff_multiplier = 2
+        self.properties.unreachable_max_sleep_seconds = 30
+        self.properties.unreachable_jitter = 0.5
+        self.properties.max_unreachable_retries = 10
+        self.properties.unreachable_retry_deadline_seconds = 60
+        self.clock = FakeClock(1000.0)
+
+    def __policy(self, random=lambda: 0):
+        return UnreachableRetryPolicy(self.properties, random=random, clock=self.clock)
+
+    def test_exponential_backoff_capped(self):
+        policy = self.__policy()
+        self.assertEqual([policy.backoff(attempt) for attempt in range(1, 6)], [5, 10, 20, 30, 30])
+
+    def test_jitter(self):
+        policy = self.__policy(random=lambda: 1)
+        self.assertEqual(policy.backoff(2), 5)
+        self.properties.unreachable_jitter = 0
+        self.assertEqual(self.__policy(random=lambda: 1).backoff(2), 10)
+
+    def test_no_sleep(self):
+        self.properties.unreachable_sleep_seconds = 0
+        self.assertEqual(self.__policy().next_delay(1, self.clock.now, self.clock.now), 0)
+
+    def test_time_taken_by_attempt_counts_towards_delay(self):
+        policy = self.__policy()
+        self.assertEqual(policy.next_delay(2, self.clock.now - 20, self.clock.now - 4), 6)
+        self.assertEqual(policy.next_delay(2, self.clock.now - 20, self.clock.now - 15), 0)
+
+    def test_max_attempts(self):
+        policy = self.__policy()
+        self.assertIsNotNone(policy.next_delay(9, self.clock.now, self.clock.now))
+        self.assertIsNone(policy.next_delay(10, self.clock.now, self.clock.now))
+
+    def test_deadline(self):
+        policy = self.__policy()
+        self.assertEqual(policy.next_delay(3, self.clock.now - 40, self.clock.now), 20)
+        self.assertIsNone(policy.next_delay(3, self.clock.now - 41, self.clock.now))
+        self.properties.unreachable_retry_deadline_seconds = 0
+        self.assertEqual(self.__policy().next_delay(3, self.clock.now - 3600, self.clock.now), 20)
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_limits_retries_in_window(self):
+        clock = FakeClock(1000.0)
+        budget = RetryBudget(2, 60, clock=clock)
+        self.assertTrue(budget.try_acquire())
+        clock.now += 30
+        self.assertTrue(budget.try_acquire())
+        self.assertFalse(budget.try_acquire())
+        # the first retry leaves the window
+        clock.now += 30
+        self.assertTrue(budget.try_acquire())
+        self.assertFalse(budget.try_acquire())
+
+    def test_unlimited(self):
+        budget = RetryBudget(0, 60)
+        for i in range(100):
+            self.assertTrue(budget.try_acquire())
+
+
+class TestDelayedRetryQueue(unittest.TestCase):
+
+    def test_take_due_in_due_order(self):
+        clock = FakeClock(1000.0)
+        queue = DelayedRetryQueue(clock=clock)
+        queue.put({'request_id': '1'}, 'result1', 30)
+        queue.put({'request_id': '2'}, 'result2', 10)
+        queue.put({'request_id': '3'}, 'result3', 10)
+        self.assertEqual(queue.take_due(), [])
+        clock.now += 10
+        self.assertEqual(queue.take_due(), [({'request_id': '2'}, 'result2'), ({'request_id': '3'}, 'result3')])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.take_all(), [({'request_id': '1'}, 'result1')])
+        self.assertEqual(len(queue), 0)
+
+
+class TestParkedRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.messaging_service = MagicMock()
+        self.ansible_client = MagicMock()
+        self.worker_state = WorkerState()
+        self.unreachable = LifecycleExecution('1', STATUS_FAILED, FailureDetails(FAILURE_CODE_RESOURCE_NOT_FOUND, 'unreachable'), {})
+        self.request = {'request_id': '1', 'lifecycle_name': 'Install', 'driver_files': MagicMock(), 'tenant_id': '1'}
+
+    def __handler(self, retry_budget=None):
+        return AnsibleRequestHandler(self.messaging_service, self.ansible_client, worker_state=self.worker_state, retry_budget=retry_budget)
+
+    def test_parks_request_until_due(self):
+        handler = self.__handler()
+        completed = LifecycleExecution('1', STATUS_COMPLETE, None, {})
+        self.ansible_client.run_lifecycle_playbook.side_effect = [UnreachableRetry(self.unreachable, 1, 100, 0), completed]
+        handler.handle_request(self.request)
+        self.messaging_service.send_lifecycle_execution.assert_not_called()
+        self.assertEqual(self.request[UNREACHABLE_RETRY_STATE], {'attempt': 1, 'first_attempt_at': 100, 'resume': None})
+        self.assertEqual(self.worker_state.parked_retries.value, 1)
+        self.assertEqual(self.worker_state.idle_seconds(0), 0)
+        self.ansible_client.remove_driver_files.assert_not_called()
+        handler.run_due_retries()
+        self.assertEqual(self.worker_state.parked_retries.value, 0)
+        self.messaging_service.send_lifecycle_execution.assert_called_once_with(completed, tenant_id='1')
+
+    def test_retry_not_run_before_due(self):
+        handler = self.__handler()
+        self.ansible_client.run_lifecycle_playbook.return_value = UnreachableRetry(self.unreachable, 1, 100, 60)
+        parked = metrics.REGISTRY.get_sample_value('ald_parked_retries')
+        handler.handle_request(self.request)
+        handler.run_due_retries()
+        self.assertEqual(self.ansible_client.run_lifecycle_playbook.call_count, 1)
+        self.assertEqual(self.worker_state.parked_retries.value, 1)
+        self.assertEqual(metrics.REGISTRY.get_sample_value('ald_parked_retries'), parked + 1)
+        handler.close()
+        self.assertEqual(metrics.REGISTRY.get_sample_value('ald_parked_retries'), parked)
+
+    def test_fails_when_budget_exhausted(self):
+        handler = self.__handler(retry_budget=RetryBudget(1, 60))
+        self.ansible_client.run_lifecycle_playbook.return_value = UnreachableRetry(self.unreachable, 1, 100, 0)
+        handler.handle_request(self.request)
+        handler.run_due_retries()
+        self.messaging_service.send_lifecycle_execution.assert_called_once_with(self.unreachable, tenant_id='1')
+        self.ansible_client.remove_driver_files.assert_called_once_with(self.request)
+        self.assertEqual(self.worker_state.parked_retries.value, 0)
+
+    def test_close_fails_parked_requests(self):
+        handler = self.__handler()
+        self.ansible_client.run_lifecycle_playbook.return_value = UnreachableRetry(self.unreachable, 1, 100, 60)
+        handler.handle_request(self.request)
+        handler.close()
+        self.messaging_service.send_lifecycle_execution.assert_called_once_with(self.unreachable, tenant_id='1')
+        self.ansible_client.remove_driver_files.assert_called_once_with(self.request)
+        self.assertEqual(self.worker_state.parked_retries.value, 0)
+
+
+class TestResumeRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = AnsibleProperties()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.playbook_path = os.path.join(self.tmp_dir, 'Install.yaml')
+        with open(self.playbook_path, 'w') as f:
+            f.write(PLAYBOOK)
+        self.inventory_path = os.path.join(self.tmp_dir, 'inventory')
+        with open(self.inventory_path, 'w') as f:
+            f.write('host1 ansible_connection=local\nhost2 ansible_connection=local\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __client(self):
+        property_groups = PropertyGroups()
+        property_groups.add_property_group(self.properties)
+        configuration = BootstrapApplicationConfiguration(app_name='test', property_sources=[], property_groups=property_groups, service_configurators=[], api_configurators=[], api_error_converter=None)
+        return AnsibleClient(configuration, templating=Jinja2TemplatingService(), render_context_service=ExtendedResourceTemplateContextService(), event_logger=RecordingEventLogger())
+
+    def test_resume_point(self):
+        callback = ResultCallback(self.properties, 'request', 'Install', RecordingEventLogger())
+        self.assertIsNone(callback.resume_point())
+        callback.properties['first'] = 'host1'
+        task = mock_task('second', 'task-2')
+        callback.v2_runner_on_unreachable(mock_result(task, 'host2', {'msg': 'timed out'}))
+        callback.v2_runner_on_unreachable(mock_result(task, 'host3', {'msg': 'timed out'}))
+        self.assertEqual(callback.resume_point(), {'task': 'second', 'hosts': ['host2', 'host3'], 'properties': {'first': 'host1'}, 'associated_topology': None})
+
+    def test_resumes_at_task_on_unreachable_hosts(self):
+        resume = {'task': 'second', 'hosts': ['host2'], 'properties': {'first': 'carried'}, 'associated_topology': None}
+        callback = self.__client().run_playbook('request', 'local', self.inventory_path, self.playbook_path, 'Install', {}, resume=resume)
+        self.assertTrue(callback.resumed)
+        # the first task is not run again, the second only runs on host2
+        self.assertEqual(callback.get_result().outputs, {'first': 'carried', 'second': 'host2'})
+
+    def test_not_resumed_when_task_not_found(self):
+        resume = {'task': 'third', 'hosts': ['host2'], 'properties': {}, 'associated_topology': None}
+        callback = self.__client().run_playbook('request', 'local', self.inventory_path, self.playbook_path, 'Install', {}, resume=resume)
+        self.assertFalse(callback.resumed)
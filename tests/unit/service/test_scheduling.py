@@ -0,0 +1,295 @@
+import random
+import unittest
+from multiprocessing import Process
+from unittest.mock import MagicMock
+from ignition.model.lifecycle import LifecycleExecution, STATUS_COMPLETE
+from ignition.utils.propvaluemap import PropValueMap
+from ansibledriver.service.process import ProcessProperties, AnsibleRequestHandler, WorkerState
+from ansibledriver.service.scheduling import SharedCounters, TenantFairScheduler, LocationLimiter, request_priority
+from ansibledriver.model.deploymentlocation import DeploymentLocation
+from tests.unit.helpers import FakeClock
+
+
+CLIENT_CONFIG = '''
+apiVersion: v1
+clusters:
+- cluster:
+    server: https://other:6443
+  name: other
+- cluster:
+    server: https://k8s:6443
+  name: k8s
+contexts:
+- context:
+    cluster: k8s
+    user: admin
+  name: admin@k8s
+current-context: admin@k8s
+'''
+
+
+def request(request_id, tenant_id, priority=None, location=None):
+    request = {'request_id': request_id, 'tenant_id': tenant_id, 'lifecycle_name': 'Install', 'driver_files': {}}
+    if location is not None:
+        request['deployment_location'] = location
+    if priority is not None:
+        request['priority'] = priority
+    return request
+
+
+def acquire_in_child(counters, key):
+    counters.try_acquire(key, 0)
+
+
+class TestSharedCounters(unittest.TestCase):
+
+    def test_limit(self):
+        counters = SharedCounters(slots=8)
+        self.assertTrue(counters.try_acquire('tenantA', 2))
+        self.assertTrue(counters.try_acquire('tenantA', 2))
+        self.assertFalse(counters.try_acquire('tenantA', 2))
+        self.assertTrue(counters.try_acquire('tenantB', 2))
+        counters.release('tenantA')
+        self.assertEqual(counters.get('tenantA'), 1)
+        self.assertTrue(counters.try_acquire('tenantA', 2))
+
+    def test_shared_with_forked_processes(self):
+        counters = SharedCounters()
+        child = Process(target=acquire_in_child, args=(counters, 'tenantA'))
+        child.start()
+        child.join()
+        self.assertEqual(counters.get('tenantA'), 1)
+
+    def test_slot_freed_when_released(self):
+        counters = SharedCounters(slots=4)
+        for i in range(100):
+            self.assertTrue(counters.try_acquire('tenant{0}'.format(i), 1))
+            self.assertFalse(counters.try_acquire('tenant{0}'.format(i), 1))
+            counters.release('tenant{0}'.format(i))
+        self.assertEqual(list(counters.keys), [0] * 4)
+
+    def test_overflow_when_full(self):
+        counters = SharedCounters(slots=1)
+        self.assertTrue(counters.try_acquire('tenantA', 1))
+        # no slot left, tenants B and C share the overflow count
+        self.assertTrue(counters.try_acquire('tenantB', 1))
+        self.assertFalse(counters.try_acquire('tenantB', 1))
+        self.assertFalse(counters.try_acquire('tenantC', 1))
+        counters.release('tenantB')
+        self.assertTrue(counters.try_acquire('tenantC', 1))
+        counters.release('tenantC')
+        counters.release('tenantA')
+        # tenant A's slot is free again
+        self.assertTrue(counters.try_acquire('tenantB', 1))
+        self.assertEqual(counters.get('tenantB'), 1)
+        self.assertEqual(counters.counts[1], 0)
+
+    def test_keys_found_after_others_freed(self):
+        counters = SharedCounters(slots=8)
+        expected = {}
+        generator = random.Random(7)
+        for i in range(2000):
+            key = 'tenant{0}'.format(generator.randrange(12))
+            if expected.get(key, 0) > 0 and generator.random() < 0.5:
+                counters.release(key)
+                expected[key] -= 1
+            elif len([k for k, count in expected.items() if count > 0]) < 8 or expected.get(key, 0) > 0:
+                self.assertTrue(counters.try_acquire(key, 0))
+                expected[key] = expected.get(key, 0) + 1
+            for k, count in expected.items():
+                self.assertEqual(counters.get(k), count)
+
+
+class TestRequestPriority(unittest.TestCase):
+
+    def test_priority(self):
+        self.assertEqual(request_priority({}), 0)
+        self.assertEqual(request_priority({'priority': '5'}), 5)
+        self.assertEqual(request_priority({'request_properties': PropValueMap({'priority': {'type': 'integer', 'value': 3}})}), 3)
+        self.assertEqual(request_priority({'priority': 'high'}), 0)
+
+
+class TestTenantFairScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = ProcessProperties()
+        self.properties.tenant_scheduling_enabled = True
+
+    def __run_all(self, scheduler):
+        order = []
+        request = scheduler.next_request()
+        while request is not None:
+            order.append(request['request_id'])
+            scheduler.request_finished(request)
+            request = scheduler.next_request()
+        return order
+
+    def test_tenants_take_turns(self):
+        scheduler = TenantFairScheduler(self.properties)
+        for i in range(4):
+            scheduler.add(request('a{0}'.format(i), 'A'))
+        scheduler.add(request('b0', 'B'))
+        scheduler.add(request('b1', 'B'))
+        self.assertEqual(self.__run_all(scheduler), ['a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+
+    def test_weights(self):
+        self.properties.tenant_weights = {'A': 2}
+        scheduler = TenantFairScheduler(self.properties)
+        for i in range(4):
+            scheduler.add(request('a{0}'.format(i), 'A'))
+            scheduler.add(request('b{0}'.format(i), 'B'))
+        self.assertEqual(self.__run_all(scheduler), ['a0', 'b0', 'a1', 'a2', 'b1', 'a3', 'b2', 'b3'])
+
+    def test_priority_first(self):
+        scheduler = TenantFairScheduler(self.properties)
+        scheduler.add(request('a0', 'A'))
+        scheduler.add(request('b0', 'B'))
+        scheduler.add(request('b1', 'B', priority=1))
+        self.assertEqual(self.__run_all(scheduler), ['b1', 'a0', 'b0'])
+
+    def test_tenant_cap(self):
+        self.properties.tenant_max_concurrent_requests = 2
+        self.properties.tenant_concurrency_caps = {'B': 1}
+        counters = SharedCounters()
+        scheduler = TenantFairScheduler(self.properties, counters)
+        for i in range(3):
+            scheduler.add(request('a{0}'.format(i), 'A'))
+            scheduler.add(request('b{0}'.format(i), 'B'))
+        started = [scheduler.next_request() for i in range(4)]
+        self.assertEqual([r['request_id'] if r is not None else None for r in started], ['a0', 'b0', 'a1', None])
+        self.assertEqual(counters.get('A'), 2)
+        scheduler.request_finished(started[1])
+        self.assertEqual(scheduler.next_request()['request_id'], 'b1')
+
+    def test_full(self):
+        self.properties.scheduler_queue_size = 2
+        scheduler = TenantFairScheduler(self.properties)
+        scheduler.add(request('a0', 'A'))
+        self.assertFalse(scheduler.full())
+        scheduler.add(request('a1', 'A'))
+        self.assertTrue(scheduler.full())
+        self.assertEqual([r['request_id'] for r in scheduler.take_all()], ['a0', 'a1'])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_requests_held_up_expire(self):
+        self.properties.scheduler_queue_size = 2
+        self.properties.scheduler_max_wait_seconds = 60
+        self.properties.tenant_max_concurrent_requests = 1
+        clock = FakeClock()
+        scheduler = TenantFairScheduler(self.properties, clock=clock)
+        scheduler.add(request('a0', 'A'))
+        self.assertEqual(scheduler.next_request()['request_id'], 'a0')
+        scheduler.add(request('a1', 'A'))
+        clock.now = 30
+        scheduler.add(request('a2', 'A'))
+        # tenant A is at its cap, so the requests read ahead fill the queue
+        self.assertIsNone(scheduler.next_request())
+        self.assertTrue(scheduler.full())
+        self.assertEqual(scheduler.take_expired(), [])
+        clock.now = 61
+        self.assertEqual([r['request_id'] for r in scheduler.take_expired()], ['a1'])
+        self.assertFalse(scheduler.full())
+        clock.now = 91
+        self.assertEqual([r['request_id'] for r in scheduler.take_expired()], ['a2'])
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler.added_at, {})
+
+    def test_requests_never_expire_without_max_wait(self):
+        self.properties.scheduler_max_wait_seconds = 0
+        clock = FakeClock()
+        scheduler = TenantFairScheduler(self.properties, clock=clock)
+        scheduler.add(request('a0', 'A'))
+        clock.now = 100000
+        self.assertEqual(scheduler.take_expired(), [])
+        self.assertEqual(len(scheduler), 1)
+
+
+class TestLocationLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = ProcessProperties()
+        self.properties.location_max_concurrent_requests = 1
+        self.properties.location_concurrency_limits = {'Openstack': {'max_concurrent_requests': 2, 'key': 'endpoint'}}
+        self.openstack1 = {'name': 'os1', 'type': 'Openstack', 'properties': {'os_auth_url': 'https://keystone:5000/v3'}}
+        self.openstack2 = {'name': 'os2', 'type': 'Openstack', 'properties': {'os_auth_url': 'https://keystone:5000/v3'}}
+        self.kubernetes = {'name': 'k8s', 'type': 'Kubernetes', 'properties': {'clientConfig': CLIENT_CONFIG}}
+
+    def test_endpoint(self):
+        self.assertEqual(DeploymentLocation.endpoint(self.openstack1), 'https://keystone:5000/v3')
+        self.assertEqual(DeploymentLocation.endpoint(self.kubernetes), 'https://k8s:6443')
+        self.assertEqual(DeploymentLocation.endpoint(self.openstack1, endpoint_property='name'), None)
+
+    def test_key_and_limit(self):
+        limiter = LocationLimiter(self.properties)
+        self.assertEqual(limiter.key_and_limit(request('1', 'A', location=self.openstack1)), ('endpoint:https://keystone:5000/v3', 2))
+        self.assertEqual(limiter.key_and_limit(request('1', 'A', location=self.kubernetes)), ('name:Kubernetes:k8s', 1))
+        self.assertFalse(LocationLimiter.enabled(ProcessProperties()))
+
+    def test_requests_beyond_location_limit_stay_queued(self):
+        scheduler = TenantFairScheduler(self.properties, location_limiter=LocationLimiter(self.properties))
+        scheduler.add(request('os1', 'A', location=self.openstack1))
+        scheduler.add(request('os2', 'A', location=self.openstack2))
+        scheduler.add(request('os3', 'A', location=self.openstack1))
+        scheduler.add(request('k8s1', 'A', location=self.kubernetes))
+        scheduler.add(request('k8s2', 'A', location=self.kubernetes))
+        started = [scheduler.next_request() for i in range(4)]
+        # the locations share an endpoint, limited to 2 requests
+        self.assertEqual([r['request_id'] if r is not None else None for r in started], ['os1', 'os2', 'k8s1', None])
+        self.assertEqual(len(scheduler), 2)
+        scheduler.request_finished(started[0])
+        self.assertEqual(scheduler.next_request()['request_id'], 'os3')
+        scheduler.request_finished(started[2])
+        self.assertEqual(scheduler.next_request()['request_id'], 'k8s2')
+
+
+class TestScheduledRequestHandler(unittest.TestCase):
+
+    def test_requests_run_when_dispatched(self):
+        messaging_service = MagicMock()
+        ansible_client = MagicMock()
+        ansible_client.run_lifecycle_playbook.side_effect = lambda r: LifecycleExecution(r['request_id'], STATUS_COMPLETE, None, {})
+        worker_state = WorkerState()
+        properties = ProcessProperties()
+        properties.tenant_scheduling_enabled = True
+        handler = AnsibleRequestHandler(messaging_service, ansible_client, worker_state=worker_state, scheduler=TenantFairScheduler(properties))
+        handler.handle_request(request('a0', 'A'))
+        handler.handle_request(request('a1', 'A'))
+        handler.handle_request(request('b0', 'B'))
+        ansible_client.run_lifecycle_playbook.assert_not_called()
+        self.assertEqual(worker_state.scheduled_requests.value, 3)
+        self.assertEqual(worker_state.idle_seconds(0), 0)
+        while handler.dispatch() > 0:
+            pass
+        self.assertEqual([c[1][0].request_id for c in messaging_service.send_lifecycle_execution.mock_calls], ['a0', 'b0', 'a1'])
+        self.assertEqual(worker_state.scheduled_requests.value, 0)
+
+    def test_close_fails_scheduled_requests(self):
+        messaging_service = MagicMock()
+        ansible_client = MagicMock()
+        handler = AnsibleRequestHandler(messaging_service, ansible_client, scheduler=TenantFairScheduler(ProcessProperties()))
+        handler.handle_request(request('a0', 'A'))
+        handler.close()
+        ansible_client.run_lifecycle_playbook.assert_not_called()
+        name, args, kwargs = messaging_service.send_lifecycle_execution.mock_calls[0]
+        self.assertEqual(args[0].failure_details.description, 'Driver worker stopped before the request was run')
+        ansible_client.remove_driver_files.assert_called_once()
+
+    def test_expired_requests_fail(self):
+        messaging_service = MagicMock()
+        ansible_client = MagicMock()
+        properties = ProcessProperties()
+        properties.scheduler_max_wait_seconds = 60
+        clock = FakeClock()
+        worker_state = WorkerState()
+        handler = AnsibleRequestHandler(messaging_service, ansible_client, worker_state=worker_state, scheduler=TenantFairScheduler(properties, clock=clock))
+        handler.handle_request(request('a0', 'A'))
+        handler.fail_expired_requests()
+        messaging_service.send_lifecycle_execution.assert_not_called()
+        clock.now = 61
+        handler.fail_expired_requests()
+        ansible_client.run_lifecycle_playbook.assert_not_called()
+        name, args, kwargs = messaging_service.send_lifecycle_execution.mock_calls[0]
+        self.assertEqual(args[0].request_id, 'a0')
+        self.assertEqual(args[0].failure_details.description, 'Request waited too long to be run by the driver')
+        ansible_client.remove_driver_files.assert_called_once()
+        self.assertEqual(worker_state.scheduled_requests.value, 0)
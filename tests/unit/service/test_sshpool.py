@@ -0,0 +1,169 @@
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from ansible.parsing.dataloader import DataLoader
+from ansible.inventory.manager import InventoryManager
+from ansible.vars.manager import VariableManager
+from ansibledriver.service.sshpool import SshControlPool
+from tests.unit.helpers import FakeClock
+
+INVENTORY = '''
+vm1 ansible_host=10.0.0.1 ansible_user=ubuntu ansible_ssh_private_key_file="{{ key_path }}"
+vm2 ansible_host=10.0.0.1 ansible_user=ubuntu ansible_ssh_private_key_file="{{ other_key_path }}"
+vm3 ansible_host=10.0.0.2 ansible_user=ubuntu ansible_password=secret
+local1 ansible_connection=local
+'''
+
+# stands in for ssh -O, logging each operation and removing the socket on stop and exit. Health checks fail when
+# CHECK_FAILS is set
+FAKE_SSH = '''#!/bin/sh
+echo "$2 ${4#ControlPath=}" >> "$(dirname "$0")/ssh.log"
+case "$2" in
+  check) [ -z "$CHECK_FAILS" ];;
+  stop|exit) rm -f "${4#ControlPath=}";;
+esac
+'''
+
+
+class TestSshControlPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ssh_command = os.path.join(self.tmp_dir, 'ssh')
+        with open(self.ssh_command, 'w') as f:
+            f.write(FAKE_SSH)
+        os.chmod(self.ssh_command, stat.S_IRWXU)
+        self.keys = {}
+        for name, content in [('key_path', 'key1'), ('other_key_path', 'key2'), ('same_key_path', 'key1')]:
+            self.keys[name] = os.path.join(self.tmp_dir, name)
+            with open(self.keys[name], 'w') as f:
+                f.write(content)
+        self.inventory_path = os.path.join(self.tmp_dir, 'inventory')
+        with open(self.inventory_path, 'w') as f:
+            f.write(INVENTORY)
+        self.clock = FakeClock(1000)
+
+    def tearDown(self):
+        os.environ.pop('CHECK_FAILS', None)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __pool(self, **kwargs):
+        return SshControlPool(os.path.join(self.tmp_dir, 'control'), clock=self.clock, ssh_command=self.ssh_command, **kwargs)
+
+    def __prepare(self, pool, key_path='key_path'):
+        loader = DataLoader()
+        inventory = InventoryManager(loader=loader, sources=self.inventory_path)
+        variable_manager = VariableManager(loader=loader, inventory=inventory)
+        variable_manager._extra_vars = {'key_path': self.keys[key_path], 'other_key_path': self.keys['other_key_path']}
+        control_paths = pool.prepare(inventory, variable_manager, loader, 'ssh')
+        return {host.name: host.vars.get('ansible_control_path', None) for host in inventory.get_hosts()}, control_paths
+
+    def __start_master(self, path):
+        # a file stands in for the socket of a master started by the playbook run
+        open(path, 'w').close()
+        os.utime(path, (self.clock.now, self.clock.now))
+
+    def __ssh_log(self):
+        log_path = os.path.join(self.tmp_dir, 'ssh.log')
+        if not os.path.exists(log_path):
+            return []
+        with open(log_path, 'r') as f:
+            return [tuple(line.split()) for line in f.read().splitlines()]
+
+    def test_control_path_by_host_user_and_credentials(self):
+        pool = self.__pool()
+        paths, control_paths = self.__prepare(pool)
+        self.assertIsNone(paths['local1'])
+        self.assertEqual(len(set(control_paths)), 3)
+        self.assertEqual(os.path.dirname(paths['vm1']), pool.control_dir)
+        # a different file holding the same key shares the master
+        same_key_paths, control_paths = self.__prepare(pool, key_path='same_key_path')
+        self.assertEqual(same_key_paths['vm1'], paths['vm1'])
+        self.assertEqual(same_key_paths['vm3'], paths['vm3'])
+        self.assertNotEqual(paths['vm1'], paths['vm2'])
+
+    def test_idle_and_least_recently_used_masters_stopped(self):
+        pool = self.__pool(max_connections=2, idle_seconds=600)
+        paths, control_paths = self.__prepare(pool)
+        for host in ['vm1', 'vm2']:
+            self.__start_master(paths[host])
+        pool.release([paths['vm1'], paths['vm2']])
+        self.assertEqual(len(pool), 2)
+        self.clock.now += 10
+        self.__start_master(paths['vm3'])
+        pool.release([paths['vm2'], paths['vm3']])
+        # vm1 is the least recently used
+        self.assertEqual(self.__ssh_log(), [('stop', paths['vm1'])])
+        self.assertEqual(len(pool), 2)
+        self.clock.now += 600
+        pool.release([paths['vm3']])
+        self.assertEqual([master for last_used, master in pool.masters()], [paths['vm3']])
+
+    def test_unhealthy_master_removed(self):
+        pool = self.__pool(health_check_seconds=60)
+        paths, control_paths = self.__prepare(pool)
+        self.__start_master(paths['vm1'])
+        self.__prepare(pool)
+        # used recently, not checked
+        self.assertEqual(self.__ssh_log(), [])
+        self.clock.now += 60
+        self.__prepare(pool)
+        self.assertTrue(os.path.exists(paths['vm1']))
+        os.environ['CHECK_FAILS'] = 'true'
+        self.__prepare(pool)
+        self.assertEqual(self.__ssh_log(), [('check', paths['vm1']), ('check', paths['vm1'])])
+        self.assertFalse(os.path.exists(paths['vm1']))
+
+    def test_close_exits_masters(self):
+        pool = self.__pool()
+        paths, control_paths = self.__prepare(pool)
+        self.__start_master(paths['vm1'])
+        pool.close()
+        self.assertEqual(self.__ssh_log(), [('exit', paths['vm1'])])
+        self.assertFalse(os.path.exists(pool.control_dir))
+
+    def __run_worker(self, pool, sender):
+        pool.claim()
+        paths, control_paths = self.__prepare(pool)
+        self.__start_master(paths['vm1'])
+        pool.close()
+        sender.send((pool.control_dir, paths['vm1']))
+        sender.close()
+
+    def test_forked_workers_own_their_masters(self):
+        pool = self.__pool()
+        results = []
+        for i in range(2):
+            receiver, sender = multiprocessing.Pipe(False)
+            worker = multiprocessing.Process(target=self.__run_worker, args=(pool, sender))
+            worker.start()
+            sender.close()
+            results.append(receiver.recv())
+            worker.join()
+        control_dirs = [control_dir for control_dir, master in results]
+        self.assertEqual(len(set(control_dirs + [pool.control_dir])), 3)
+        # each worker exits its masters when it closes
+        self.assertEqual(self.__ssh_log(), [('exit', master) for control_dir, master in results])
+        for control_dir in control_dirs:
+            self.assertFalse(os.path.exists(control_dir))
+
+    def __run_playbook_process(self, pool, paths):
+        self.__start_master(paths['vm2'])
+        pool.release([paths['vm2']])
+
+    def test_playbook_processes_leave_eviction_to_the_worker(self):
+        pool = self.__pool(max_connections=1)
+        paths, control_paths = self.__prepare(pool)
+        self.__start_master(paths['vm1'])
+        self.clock.now += 10
+        playbook_process = multiprocessing.Process(target=self.__run_playbook_process, args=(pool, paths))
+        playbook_process.start()
+        playbook_process.join()
+        # a sibling may still be using the masters beyond max_connections
+        self.assertEqual(self.__ssh_log(), [])
+        self.assertEqual(len(pool), 2)
+        pool.evict()
+        self.assertEqual(self.__ssh_log(), [('stop', paths['vm1'])])
@@ -0,0 +1,77 @@
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+from ansibledriver.service.supervision import RequestJournal, RestartBackoff, exit_reason
+from tests.unit.helpers import FakeClock
+
+
+class FakeDirectoryTree():
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+
+class TestRequestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.journal = RequestJournal.create(self.base_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def __request(self, request_id):
+        return {'request_id': request_id, 'tenant_id': 'tenant1', 'lifecycle_name': 'Install', 'driver_files': FakeDirectoryTree('/tmp/files_' + request_id)}
+
+    def test_records_requests_until_removed(self):
+        request1 = self.__request('1')
+        request2 = self.__request('2')
+        self.journal.add(request1)
+        self.journal.commit()
+        self.journal.add(request2)
+        self.journal.hold_slots(request1, ('tenant1', 'name:Openstack:core'))
+        entries = sorted(self.journal.entries(), key=lambda entry: entry['request_id'])
+        self.assertEqual([entry['request_id'] for entry in entries], ['1', '2'])
+        self.assertEqual([entry['committed'] for entry in entries], [True, False])
+        self.assertEqual(entries[0]['tenant_id'], 'tenant1')
+        self.assertEqual(entries[0]['driver_files'], '/tmp/files_1')
+        self.assertEqual(entries[0]['slots'], {'tenant': 'tenant1', 'location': 'name:Openstack:core'})
+        self.assertEqual(entries[1]['slots'], {})
+        self.journal.hold_slots(request1, None)
+        self.journal.remove(request2)
+        entries = self.journal.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['slots'], {})
+
+    def test_entries_readable_by_another_process(self):
+        self.journal.add(self.__request('1'))
+        # the parent has its own copy of the journal, without the entries written by the worker
+        parent_journal = RequestJournal(self.journal.journal_dir)
+        self.assertEqual(len(parent_journal), 1)
+        parent_journal.close()
+        self.assertFalse(os.path.exists(self.journal.journal_dir))
+        self.assertEqual(parent_journal.entries(), [])
+
+
+class TestRestartBackoff(unittest.TestCase):
+
+    def test_delay_doubles_while_workers_keep_dying(self):
+        clock = FakeClock()
+        backoff = RestartBackoff(1, 5, 300, clock=clock)
+        self.assertEqual([backoff.next_delay() for i in range(5)], [0, 1, 2, 4, 5])
+        clock.now = 299
+        self.assertEqual(backoff.next_delay(), 5)
+        # reset once no worker has died for reset_seconds
+        clock.now = 599
+        self.assertEqual(backoff.next_delay(), 0)
+
+
+class TestExitReason(unittest.TestCase):
+
+    def test_exit_reason(self):
+        self.assertEqual(exit_reason(-signal.SIGKILL), 'SIGKILL')
+        self.assertEqual(exit_reason(-signal.SIGSEGV), 'SIGSEGV')
+        self.assertEqual(exit_reason(1), 'exit code 1')
+        self.assertEqual(exit_reason(None), 'unknown')
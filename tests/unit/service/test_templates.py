@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+from ignition.service.templating import Jinja2TemplatingService
+from ignition.templating.exceptions import TemplatingError
+from ignition.utils.file import DirectoryTree
+from ansibledriver.service.templates import CachingTemplateRenderer, process_templates
+
+
+class TestCachingTemplateRenderer(unittest.TestCase):
+
+    def test_render_matches_templating_service(self):
+        templating = Jinja2TemplatingService()
+        renderer = CachingTemplateRenderer(templating, 4)
+        content = 'name: {{ name }}\n{% if flag %}flag: true{% endif %}\n'
+        context = {'name': 'test', 'flag': True}
+        self.assertEqual(renderer.render(content, context), templating.render(content, context))
+
+    @patch('ansibledriver.service.templates.metrics')
+    def test_compiled_template_reused(self, metrics):
+        renderer = CachingTemplateRenderer(Jinja2TemplatingService(), 4)
+        self.assertEqual(renderer.render('{{ a }}', {'a': '1'}), '1')
+        self.assertEqual(renderer.render('{{ a }}', {'a': '2'}), '2')
+        self.assertEqual(metrics.template_cache_misses.inc.call_count, 1)
+        self.assertEqual(metrics.template_cache_hits.inc.call_count, 1)
+
+    def test_template_errors_raised_as_templating_error(self):
+        renderer = CachingTemplateRenderer(Jinja2TemplatingService(), 4)
+        with self.assertRaises(TemplatingError):
+            renderer.render('{{ a ', {})
+
+    def test_other_templating_services_used_directly(self):
+        templating = MagicMock()
+        templating.render.return_value = 'rendered'
+        renderer = CachingTemplateRenderer(templating, 4)
+        self.assertEqual(renderer.render('{{ a }}', {'a': '1'}), 'rendered')
+        templating.render.assert_called_once_with('{{ a }}', {'a': '1'})
+
+
+class TestProcessTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __write(self, name, content, mode='w'):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, mode) as f:
+            f.write(content)
+        return path
+
+    def __read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_renders_templates(self):
+        path = self.__write('inventory', 'host: {{ host }}\n')
+        renderer = CachingTemplateRenderer(Jinja2TemplatingService(), 4)
+        process_templates(DirectoryTree(self.tmp_dir), renderer, {'host': 'localhost'})
+        self.assertEqual(self.__read(path), b'host: localhost')
+
+    def test_skips_plain_and_binary_files(self):
+        plain_path = self.__write('plain.txt', 'no templating here\n')
+        binary_path = self.__write('binary.bin', b'{{ host }}\0\xff', mode='wb')
+        templating = MagicMock()
+        process_templates(DirectoryTree(self.tmp_dir), templating, {'host': 'localhost'})
+        templating.render.assert_not_called()
+        self.assertEqual(self.__read(plain_path), b'no templating here\n')
+        self.assertEqual(self.__read(binary_path), b'{{ host }}\0\xff')
+
+    def test_does_not_write_unchanged_files(self):
+        path = self.__write('vars.yml', '{{ host }}')
+        inode = os.stat(path).st_ino
+        templating = MagicMock()
+        templating.render.return_value = '{{ host }}'
+        process_templates(DirectoryTree(self.tmp_dir), templating, {})
+        self.assertEqual(os.stat(path).st_ino, inode)
+
+    def test_does_not_modify_hard_linked_files(self):
+        path = self.__write('vars.yml', 'host: {{ host }}')
+        os.chmod(path, 0o750)
+        cached_path = os.path.join(self.tmp_dir, '..', os.path.basename(self.tmp_dir) + '-cached')
+        os.link(path, cached_path)
+        try:
+            renderer = CachingTemplateRenderer(Jinja2TemplatingService(), 4)
+            process_templates(DirectoryTree(self.tmp_dir), renderer, {'host': 'localhost'})
+            self.assertEqual(self.__read(path), b'host: localhost')
+            self.assertEqual(self.__read(cached_path), b'host: {{ host }}')
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o750)
+            self.assertEqual(os.listdir(self.tmp_dir), ['vars.yml'])
+        finally:
+            os.unlink(cached_path)
+
+
+class TestParallelProcessTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for i in range(20):
+            with open(os.path.join(self.tmp_dir, 'file{0:02d}.yml'.format(i)), 'w') as f:
+                f.write('value: {{ value }}-' + str(i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __break(self, *indexes):
+        for i in indexes:
+            with open(os.path.join(self.tmp_dir, 'file{0:02d}.yml'.format(i)), 'w') as f:
+                f.write('value: {{ value | missing' + str(i) + ' }}')
+
+    def __assert_rendered(self):
+        for i in range(20):
+            with open(os.path.join(self.tmp_dir, 'file{0:02d}.yml'.format(i)), 'r') as f:
+                self.assertEqual(f.read(), 'value: A-' + str(i))
+
+    def __process(self, mode):
+        renderer = CachingTemplateRenderer(Jinja2TemplatingService(), 4)
+        process_templates(DirectoryTree(self.tmp_dir), renderer, {'value': 'A'}, mode=mode, parallelism=3, parallel_threshold=10)
+
+    def test_threads(self):
+        self.__process('threads')
+        self.__assert_rendered()
+
+    def test_processes(self):
+        self.__process('processes')
+        self.__assert_rendered()
+
+    def test_error_from_first_failing_file(self):
+        for mode in ['sequential', 'threads', 'processes']:
+            with self.subTest(mode=mode):
+                self.__break(17, 3, 9)
+                with self.assertRaises(TemplatingError) as context:
+                    self.__process(mode)
+                self.assertEqual(str(context.exception), 'No filter named \'missing3\'.')
+                with open(os.path.join(self.tmp_dir, 'file02.yml'), 'r') as f:
+                    self.assertEqual(f.read(), 'value: A-2')
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError) as context:
+            self.__process('gpu')
+        self.assertEqual(str(context.exception), 'Invalid template rendering mode gpu, expected one of (\'sequential\', \'threads\', \'processes\')')
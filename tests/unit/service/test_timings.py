@@ -0,0 +1,83 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from ansibledriver.service.ansible import AnsibleProperties, ResultCallback
+from ansibledriver.service.timings import PlaybookTimings, TaskSummary
+from ansibledriver.model.progress_events import PlaybookResultEvent
+from tests.unit.service.test_verbosity import RecordingEventLogger, mock_task, mock_result
+from tests.unit.helpers import FakeClock
+
+
+class TestTaskSummary(unittest.TestCase):
+
+    def test_counts_and_durations(self):
+        times = iter([10.0, 10.5, 11.0, 12.5, 13.0])
+        summary = TaskSummary('task', clock=lambda: next(times))
+        summary.host_start('host1')
+        summary.host_start('host2')
+        summary.host_result('host1', 'ok', changed=True)
+        summary.host_result('host2', 'failed')
+        self.assertEqual(summary.host_counts, {'ok': 1, 'changed': 1, 'failed': 1, 'skipped': 0, 'unreachable': 0})
+        self.assertEqual(summary.host_durations, {'host1': 2.0, 'host2': 2.0})
+        self.assertEqual(summary.duration(), 3.0)
+
+
+class TestPlaybookTimings(unittest.TestCase):
+
+    def test_timings(self):
+        clock = FakeClock(0.0)
+        timings = PlaybookTimings(clock=clock)
+        timings.play_start('play')
+        install = timings.task_start('uuid1', 'install')
+        install.host_start('host1')
+        install.host_start('host2')
+        clock.now = 4.0
+        install.host_result('host1', 'ok')
+        clock.now = 10.0
+        install.host_result('host2', 'ok')
+        configure = timings.task_start('uuid2', 'configure')
+        configure.host_start('host1')
+        clock.now = 12.0
+        configure.host_result('host1', 'ok')
+        timings.finish()
+        self.assertEqual(timings.slowest_tasks(1), [{'taskName': 'install', 'durationSeconds': 10.0}])
+        self.assertEqual(timings.to_dict(), {
+            'durationSeconds': 12.0,
+            'plays': [{'playName': 'play', 'durationSeconds': 12.0}],
+            'tasks': [
+                {'taskName': 'install', 'durationSeconds': 10.0, 'slowestHost': 'host2', 'slowestHostDurationSeconds': 10.0},
+                {'taskName': 'configure', 'durationSeconds': 2.0, 'slowestHost': 'host1', 'slowestHostDurationSeconds': 2.0}
+            ],
+            'hosts': {'host1': 6.0, 'host2': 10.0}
+        })
+
+    def test_task_without_results(self):
+        timings = PlaybookTimings(clock=FakeClock(0.0))
+        timings.task_start('uuid1', 'install')
+        self.assertEqual(timings.to_dict()['tasks'], [{'taskName': 'install', 'durationSeconds': 0.0}])
+
+
+class TestResultCallbackTimings(unittest.TestCase):
+
+    def test_timings_reported(self):
+        properties = AnsibleProperties()
+        properties.slowest_tasks_count = 1
+        event_logger = RecordingEventLogger()
+        callback = ResultCallback(properties, 'request', 'Install', event_logger)
+        task = mock_task('install', 'uuid1')
+        callback.v2_playbook_on_task_start(task, False)
+        callback.v2_runner_on_ok(mock_result(task, 'host1', {}))
+        callback.v2_playbook_on_stats(MagicMock(processed={}))
+        playbook_result = [event for event in event_logger.events if isinstance(event, PlaybookResultEvent)][0]
+        self.assertEqual([task['taskName'] for task in playbook_result._details()['timings']['tasks']], ['install'])
+        self.assertEqual([task['taskName'] for task in callback.get_result().slowest_tasks], ['install'])
+
+    def test_task_metrics_labelled_by_module(self):
+        callback = ResultCallback(AnsibleProperties(), 'request', 'Install', RecordingEventLogger())
+        task = mock_task('install {{ item }} on web-17', 'uuid1')
+        task.action = 'ansible.builtin.command'
+        callback.v2_playbook_on_task_start(task, False)
+        callback.v2_runner_on_ok(mock_result(task, 'host1', {}))
+        with patch('ansibledriver.service.ansible.metrics') as metrics:
+            callback.v2_playbook_on_stats(MagicMock(processed={}))
+        metrics.playbook_task_duration_seconds.labels.assert_called_once_with('Install', 'ansible.builtin.command')
+        metrics.playbook_task_host_duration_seconds.labels.assert_called_once_with('Install', 'ansible.builtin.command')
@@ -0,0 +1,144 @@
+import unittest
+from unittest.mock import MagicMock
+from ansibledriver.service.ansible import AnsibleProperties, ResultCallback
+from ansibledriver.service.verbosity import ProgressEventFilter
+from ansibledriver.model.progress_events import PlaybookResultEvent, TaskStartedEvent, TaskSummaryEvent, TaskCompletedOnHostEvent, TaskFailedOnHostEvent, TaskStartedOnHostEvent, TaskSkippedOnHostEvent
+
+
+class RecordingEventLogger():
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, event):
+        self.events.append(event)
+
+
+def mock_task(name, uuid):
+    task = MagicMock()
+    task.get_name.return_value = name
+    task._uuid = uuid
+    task.no_log = False
+    task.args = {}
+    task.action = 'debug'
+    return task
+
+
+def mock_result(task, host_name, result):
+    task_result = MagicMock()
+    task_result._task = task
+    task_result._host.get_name.return_value = host_name
+    task_result._result = result
+    return task_result
+
+
+class TestProgressEventFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = AnsibleProperties()
+
+    def test_full(self):
+        event_filter = ProgressEventFilter(self.properties, 'Install')
+        self.assertTrue(event_filter.playbook_events())
+        self.assertTrue(event_filter.failure_events())
+        self.assertTrue(event_filter.task_events())
+        self.assertFalse(event_filter.task_summaries())
+        self.assertTrue(all(event_filter.host_event('uuid1', 'host{0}'.format(i)) for i in range(5)))
+
+    def test_failures(self):
+        self.properties.progress_event_verbosity = 'failures'
+        event_filter = ProgressEventFilter(self.properties, 'Install')
+        self.assertTrue(event_filter.playbook_events())
+        self.assertTrue(event_filter.failure_events())
+        self.assertFalse(event_filter.task_events())
+        self.assertFalse(event_filter.task_summaries())
+        self.assertFalse(event_filter.host_event('uuid1', 'host1'))
+
+    def test_summary(self):
+        self.properties.progress_event_verbosity = 'summary'
+        event_filter = ProgressEventFilter(self.properties, 'Install')
+        self.assertTrue(event_filter.task_events())
+        self.assertTrue(event_filter.task_summaries())
+        self.assertFalse(event_filter.host_event('uuid1', 'host1'))
+
+    def test_disabled(self):
+        self.properties.log_progress_events = False
+        event_filter = ProgressEventFilter(self.properties, 'Install')
+        self.assertFalse(event_filter.playbook_events())
+        self.assertFalse(event_filter.failure_events())
+        self.assertFalse(event_filter.task_summaries())
+        self.assertFalse(event_filter.host_event('uuid1', 'host1'))
+
+    def test_sample_rate_per_lifecycle(self):
+        self.properties.progress_event_sample_rate = 2
+        self.properties.progress_event_lifecycle_sample_rates = {'Install': 3}
+        install_filter = ProgressEventFilter(self.properties, 'Install')
+        self.assertEqual([install_filter.host_event('uuid1', 'host{0}'.format(i)) for i in range(6)], [True, False, False, True, False, False])
+        configure_filter = ProgressEventFilter(self.properties, 'Configure')
+        self.assertEqual([configure_filter.host_event('uuid1', 'host{0}'.format(i)) for i in range(4)], [True, False, True, False])
+
+    def test_invalid_verbosity(self):
+        self.properties.progress_event_verbosity = 'debug'
+        with self.assertRaises(ValueError) as context:
+            ProgressEventFilter(self.properties, 'Install')
+        self.assertEqual(str(context.exception), 'Invalid progress_event_verbosity debug, expected one of (\'playbook\', \'failures\', \'summary\', \'full\')')
+
+
+class TestResultCallbackVerbosity(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = AnsibleProperties()
+        self.event_logger = RecordingEventLogger()
+
+    def __run_tasks(self, callback):
+        first_task = mock_task('first', 'uuid1')
+        second_task = mock_task('second', 'uuid2')
+        callback.v2_playbook_on_task_start(first_task, False)
+        for host_name in ['host1', 'host2', 'host3']:
+            callback.v2_runner_on_start(MagicMock(**{'get_name.return_value': host_name}), first_task)
+            callback.v2_runner_on_ok(mock_result(first_task, host_name, {'changed': host_name == 'host1'}))
+        callback.v2_playbook_on_task_start(second_task, False)
+        callback.v2_runner_on_failed(mock_result(second_task, 'host1', {'msg': 'failed'}))
+
+    def test_summary_replaces_host_events(self):
+        self.properties.progress_event_verbosity = 'summary'
+        callback = ResultCallback(self.properties, 'request', 'Install', self.event_logger)
+        self.__run_tasks(callback)
+        callback.v2_playbook_on_stats(MagicMock(processed={}))
+        event_types = [type(event) for event in self.event_logger.events]
+        self.assertEqual(event_types, [TaskStartedEvent, TaskSummaryEvent, TaskStartedEvent, TaskFailedOnHostEvent, TaskSummaryEvent, PlaybookResultEvent])
+        first_summary = self.event_logger.events[1]._details()
+        self.assertEqual(first_summary['taskName'], 'first')
+        self.assertEqual(first_summary['hostCounts'], {'ok': 3, 'changed': 1, 'failed': 0, 'skipped': 0, 'unreachable': 0})
+        second_summary = self.event_logger.events[4]._details()
+        self.assertEqual(second_summary['hostCounts']['failed'], 1)
+
+    def test_sampled_host_events(self):
+        self.properties.progress_event_sample_rate = 2
+        callback = ResultCallback(self.properties, 'request', 'Install', self.event_logger)
+        self.__run_tasks(callback)
+        completed = [event.host_name for event in self.event_logger.events if isinstance(event, TaskCompletedOnHostEvent)]
+        started = [event.host_name for event in self.event_logger.events if isinstance(event, TaskStartedOnHostEvent)]
+        # the task is sampled on each host, so started and completed events are kept for the same hosts
+        self.assertEqual(completed, ['host1', 'host3'])
+        self.assertEqual(started, ['host1', 'host3'])
+        # failures are never sampled
+        self.assertEqual(len([event for event in self.event_logger.events if isinstance(event, TaskFailedOnHostEvent)]), 1)
+
+    def test_sampled_looped_task_events_kept_together(self):
+        self.properties.progress_event_sample_rate = 2
+        callback = ResultCallback(self.properties, 'request', 'Install', self.event_logger)
+        task = mock_task('loop', 'uuid1')
+        callback.v2_playbook_on_task_start(task, False)
+        for host_name in ['host1', 'host2', 'host3']:
+            callback.v2_runner_on_start(MagicMock(**{'get_name.return_value': host_name}), task)
+            for item in ['a', 'b', 'c']:
+                callback.v2_runner_item_on_ok(mock_result(task, host_name, {'item': item}))
+            callback.v2_runner_item_on_skipped(mock_result(task, host_name, {'item': 'd'}))
+            callback.v2_runner_on_ok(mock_result(task, host_name, {}))
+        host_events = [(type(event), event.host_name) for event in self.event_logger.events if type(event) is not TaskStartedEvent]
+        # every event of the task on host1 and host3, none of those on host2
+        expected = []
+        for host_name in ['host1', 'host3']:
+            expected += [(TaskStartedOnHostEvent, host_name)] + [(TaskCompletedOnHostEvent, host_name)] * 3 + [(TaskSkippedOnHostEvent, host_name), (TaskCompletedOnHostEvent, host_name)]
+        self.assertEqual(host_events, expected)